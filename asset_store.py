@@ -0,0 +1,118 @@
+from pathlib import Path
+import hashlib
+import mmap
+import os
+import pickle
+import struct
+
+
+## Bump this whenever the layout of the file, or of the sections setup writes into it, changes, so that setup has to be run again.
+STORE_VERSION = 1
+STORE_MAGIC = b'LV64STOR'
+STORE_ALIGNMENT = 16
+## Buffers smaller than this are left inside their section's pickle.  Out of band buffers are aligned, so very small ones would waste more than they save.
+MIN_OUT_OF_BAND_BYTES = 256
+
+## magic, version, table of contents offset, table of contents length.
+HEADER = struct.Struct( '<8sIQQ' )
+
+
+##################
+### STORE FILE ###
+##################
+
+## An asset store is HEADER, then each section, then the pickled table of contents.  A section is a pickle ( protocol 5 ) of one object, followed by the raw bytes of the numpy arrays it holds, each aligned to STORE_ALIGNMENT bytes.  The table of contents maps section name -> ( pickle offset, pickle length, [ ( buffer offset, buffer length ), ... ] ), so any one section can be unpickled straight out of a memory map with its arrays left in the map.
+
+def align( offset ):
+    return ( offset + STORE_ALIGNMENT - 1 ) // STORE_ALIGNMENT * STORE_ALIGNMENT
+
+
+def save_asset_store( sections, path ):
+    """Writes sections ( name -> object ) to an asset store at path.  The fingerprint in the table of contents is a sha1 of everything written, so it changes whenever any section does."""
+    path = Path( path )
+    temp_path = path.with_suffix( '.tmp' )
+    fingerprint = hashlib.sha1()
+    table = {}
+
+    with open( temp_path, 'wb' ) as f:
+        f.write( HEADER.pack( STORE_MAGIC, STORE_VERSION, 0, 0 ) )
+        for each_name, each_object in sections.items():
+            buffers = []
+            def buffer_callback( buffer ):
+                ## Returning True keeps a buffer in band.
+                if buffer.raw().nbytes < MIN_OUT_OF_BAND_BYTES:
+                    return True
+                buffers.append( buffer )
+                return False
+            section_bytes = pickle.dumps( each_object, protocol=5, buffer_callback=buffer_callback )
+
+            section_offset = align( f.tell() )
+            f.seek( section_offset )
+            f.write( section_bytes )
+            fingerprint.update( section_bytes )
+
+            buffer_entries = []
+            for each_buffer in buffers:
+                raw = each_buffer.raw()
+                buffer_offset = align( f.tell() )
+                f.seek( buffer_offset )
+                f.write( raw )
+                fingerprint.update( raw )
+                buffer_entries.append( ( buffer_offset, raw.nbytes ) )
+            table[ each_name ] = ( section_offset, len( section_bytes ), buffer_entries )
+
+        table_bytes = pickle.dumps( { 'fingerprint' : fingerprint.hexdigest(), 'sections' : table }, pickle.HIGHEST_PROTOCOL )
+        table_offset = f.tell()
+        f.write( table_bytes )
+        f.seek( 0 )
+        f.write( HEADER.pack( STORE_MAGIC, STORE_VERSION, table_offset, len( table_bytes ) ) )
+    os.replace( temp_path, path )
+
+
+
+class AssetStore():
+    """A memory mapped asset store.  Opening one only reads its table of contents.  get( name ) unpickles a section the first time it's asked for, and the numpy arrays in it are views of the map, so their bytes are only read from disk when they're used.
+
+    The map is copy on write, so arrays can be modified like any other without the file changing.  Objects are not shared between sections: an object reachable from two sections is a separate copy in each."""
+    def __init__( self, path ):
+        self.path = Path( path )
+        with open( self.path, 'rb' ) as f:
+            magic, version, table_offset, table_length = HEADER.unpack( f.read( HEADER.size ) )
+            assert magic == STORE_MAGIC, "Not an asset store: " + str( self.path )
+            assert version == STORE_VERSION, str( self.path ) + " was written by a different version of setup.py.  Please run setup.py again."
+            self.map = mmap.mmap( f.fileno(), 0, access=mmap.ACCESS_COPY )
+
+        table = pickle.loads( self.map[ table_offset : table_offset + table_length ] )
+        self.fingerprint = table[ 'fingerprint' ]
+        self.sections = table[ 'sections' ]
+        self.loaded = {}
+
+
+    def __contains__( self, name ):
+        return name in self.sections
+
+
+    def get_section_names( self ):
+        return list( self.sections )
+
+
+    def get_section_size( self, name ):
+        """Bytes the section takes in the file, including its arrays."""
+        _, section_length, buffer_entries = self.sections[ name ]
+        return section_length + sum( buffer_length for _, buffer_length in buffer_entries )
+
+
+    def get( self, name ):
+        loaded = self.loaded.get( name )
+        if loaded is None:
+            section_offset, section_length, buffer_entries = self.sections[ name ]
+            view = memoryview( self.map )
+            buffers = [ view[ buffer_offset : buffer_offset + buffer_length ] for buffer_offset, buffer_length in buffer_entries ]
+            loaded = pickle.loads( view[ section_offset : section_offset + section_length ], buffers=buffers )
+            self.loaded[ name ] = loaded
+        return loaded
+
+
+    def release( self, name ):
+        """Forgets a loaded section, so its objects can be freed once nothing else refers to them."""
+        self.loaded.pop( name, None )
@@ -0,0 +1,178 @@
+import pyglet
+import os
+import sys
+import json
+import math
+import time
+import platform
+import argparse
+import statistics
+import subprocess
+from pathlib import Path
+
+from parsers.stage_metrics import get_peak_rss_mb, reset_peak_rss
+
+
+## Bumped whenever what's measured, or how, changes, so results from different versions aren't compared.
+BENCHMARK_VERSION = 2
+## Results compared by -compare, as ( key, lower is better ).
+COMPARED_RESULTS = [ ( 'load_seconds_first', True ), ( 'load_seconds_best', True ), ( 'peak_rss_mb', True ), ( 'frame_ms_mean', True ), ( 'frame_ms_p95', True ), ( 'draw_calls', True ), ( 'vertices', True ) ]
+
+
+def get_git_commit( repo_dir ):
+    try:
+        return subprocess.run( [ 'git', 'rev-parse', 'HEAD' ], cwd=repo_dir, capture_output=True, text=True, check=True ).stdout.strip()
+    except:
+        return None
+
+
+def get_batch_counts( batch ):
+    """Vertices, triangles, and groups holding vertex lists of a level batch, along with the draw calls and group switches drawing it costs."""
+    from render_stats import count_batch
+    vertices = 0
+    indices = 0
+    for each_domain_map in batch.group_map.values():
+        for ( formats, mode, indexed ), domain in each_domain_map.items():
+            vertices += sum( domain.allocator.get_allocated_regions()[ 1 ] )
+            if indexed:
+                indices += sum( domain.index_allocator.get_allocated_regions()[ 1 ] )
+    draw_calls, group_switches, _ = count_batch( batch )
+    return { 'vertices' : vertices, 'triangles' : indices // 3, 'groups' : len( batch.group_map ), 'draw_calls' : draw_calls, 'group_switches' : group_switches }
+
+
+def get_camera_path( start_pos, start_yaw, frames ):
+    """The fixed camera path every level is drawn along: a full turn on the spot from Mario's start position, pitching up and down once.  Yields ( position, yaw, pitch )."""
+    for i in range( frames ):
+        progress = i / frames
+        yield start_pos, ( start_yaw + 360 * progress ) % 360, 20 * math.sin( 2 * math.pi * progress )
+
+
+def summarize_frame_times( frame_times ):
+    frame_ms = sorted( each_time * 1000 for each_time in frame_times )
+    return { 'frame_ms_mean' : statistics.mean( frame_ms ), 'frame_ms_median' : statistics.median( frame_ms ), 'frame_ms_p95' : frame_ms[ min( len( frame_ms ) - 1, int( 0.95 * len( frame_ms ) ) ) ], 'frame_ms_min' : frame_ms[ 0 ], 'frame_ms_max' : frame_ms[ -1 ] }
+
+
+def benchmark_level( window, level, loads, warmup_frames, frames ):
+    """Loads level loads times, timing Geometry.load_level, then draws the last load along the camera path.  Each frame is timed from on_draw until glFinish returns, so the GPU's work ( the CPU's, with llvmpipe ) is included."""
+    from pyglet.gl import glFinish
+    geometry = window.level_geometry
+    peak_rss_reset = reset_peak_rss()
+
+    load_times = []
+    for _ in range( loads ):
+        start_time = time.perf_counter()
+        level_batch = geometry.load_level( level )
+        load_times.append( time.perf_counter() - start_time )
+
+    window.load_new_level( level, level_batch=level_batch )
+    window.render_stats.invalidate_batch()
+    result = { 'load_seconds' : load_times, 'load_seconds_first' : load_times[ 0 ], 'load_seconds_best' : min( load_times ), 'textures' : len( geometry.level_textures ), 'skybox' : window.skybox_present }
+    result.update( get_batch_counts( window.level_batch ) )
+
+    frame_times = []
+    for ind, ( position, yaw, pitch ) in enumerate( get_camera_path( window.start_pos, window.start_yaw, warmup_frames + frames ) ):
+        window.camera.position = list( position )
+        window.camera.yaw = yaw
+        window.camera.pitch = pitch
+        window.switch_to()
+        start_time = time.perf_counter()
+        window.on_draw()
+        glFinish()
+        if ind >= warmup_frames:
+            frame_times.append( time.perf_counter() - start_time )
+        window.flip()
+    result.update( summarize_frame_times( frame_times ) )
+
+    ## Without a reset the peak may be left over from an earlier level.
+    result[ 'peak_rss_mb' ] = get_peak_rss_mb() if peak_rss_reset else None
+    return result
+
+
+def run_benchmark( mario_graphics_dir, levels, resolution, msaa, use_shaders, cull, lod_bias, occlusion, loads, warmup_frames, frames ):
+    from pyglet.gl import gl_info
+    from game_window import GameWindow
+
+    window = GameWindow( mario_graphics_dir, resolution=resolution, vsync=False, msaa=msaa, resizable=False, use_shaders=use_shaders, visible=False, cull=cull, lod_bias=lod_bias, occlusion=occlusion )
+    if not levels:
+        levels = sorted( window.level_geometry.start_positions )
+
+    results = { 'version' : BENCHMARK_VERSION, 'commit' : get_git_commit( mario_graphics_dir ), 'time' : time.strftime( "%Y-%m-%dT%H:%M:%S", time.localtime() ),
+        'platform' : platform.platform(), 'python' : platform.python_version(), 'pyglet' : pyglet.version, 'gl_vendor' : gl_info.get_vendor(), 'gl_renderer' : gl_info.get_renderer(), 'gl_version' : gl_info.get_version(),
+        'settings' : { 'resolution' : [ window.width, window.height ], 'msaa' : msaa, 'shaders' : window.level_geometry.use_shaders, 'cull' : cull, 'lod_bias' : lod_bias, 'occlusion' : occlusion, 'headless' : bool( pyglet.options[ 'headless' ] ), 'loads' : loads, 'warmup_frames' : warmup_frames, 'frames' : frames },
+        'levels' : {} }
+
+    for each_level in levels:
+        print( "Benchmarking", each_level )
+        results[ 'levels' ][ each_level ] = benchmark_level( window, each_level, loads, warmup_frames, frames )
+
+    window.close()
+    return results
+
+
+def compare_results( baseline_path, results_path ):
+    """Prints how each level's results changed from baseline_path to results_path, as a percentage.  Changes for the worse are marked with a *."""
+    with open( baseline_path ) as f:
+        baseline = json.load( f )
+    with open( results_path ) as f:
+        results = json.load( f )
+    if baseline[ 'version' ] != results[ 'version' ]:
+        print( "Warning: the results are from different benchmark versions and may not be comparable." )
+    if baseline[ 'settings' ] != results[ 'settings' ]:
+        print( "Warning: the results were run with different settings.", baseline[ 'settings' ], results[ 'settings' ] )
+
+    print( "{:<18}".format( 'level' ) + ''.join( "{:>20}".format( each_key ) for each_key, _ in COMPARED_RESULTS ) )
+    for each_level, each_result in results[ 'levels' ].items():
+        baseline_result = baseline[ 'levels' ].get( each_level )
+        if baseline_result is None:
+            continue
+        row = "{:<18}".format( each_level )
+        for each_key, lower_is_better in COMPARED_RESULTS:
+            old_value = baseline_result.get( each_key )
+            new_value = each_result.get( each_key )
+            if not old_value or new_value is None:
+                row += "{:>20}".format( '-' )
+                continue
+            change = ( new_value - old_value ) / old_value * 100
+            worse = change > 0 if lower_is_better else change < 0
+            row += "{:>19.1f}%".format( change ) if not worse else "{:>18.1f}%*".format( change )
+        print( row )
+
+
+
+if __name__ == '__main__':
+    description = 'Level Viewer 64 benchmark\n\nLoads and draws every level ( or the levels given ) in a hidden window, and writes load times, peak memory, batch sizes, and frame times to a JSON file.  Every level is drawn along the same scripted camera path, so results from different commits can be compared with -compare.\n\nExample usages:\npython3 benchmark.py\npython3 benchmark.py -levels bob wf -frames 600\nLIBGL_ALWAYS_SOFTWARE=1 python3 benchmark.py -headless\npython3 benchmark.py -compare benchmarks/old.json benchmarks/new.json\n\nNote: -headless draws with EGL and needs no display, e.g. on a CPU only Linux box with Mesa llvmpipe.'
+    parser = argparse.ArgumentParser( description=description, formatter_class=argparse.RawTextHelpFormatter )
+    parser.add_argument( '-levels', nargs='+', metavar='level', help='levels to benchmark (default: every level)' )
+    parser.add_argument( '-res', '--resolution', nargs=2, type=int, metavar=( 'x', 'y' ), default=[1280, 720], help='resolution of the hidden window (default: 1280x720)' )
+    parser.add_argument( '-msaa', type=int, metavar='samples', help='number of MSAA samples per pixel (default: 1)', default=1 )
+    parser.add_argument( '-shaders', action='store_true', help='draw with the atlas shader' )
+    parser.add_argument( '-nocull', action='store_true', help='draw the whole level every frame, rather than only the parts in view' )
+    parser.add_argument( '-lodbias', type=float, metavar='bias', default=1.0, help='multiplies camera distances before choosing level of detail (default: 1.0)' )
+    parser.add_argument( '-occlusion', action='store_true', help='also skip the parts of the level hidden behind the rest of it, using GL occlusion queries' )
+    parser.add_argument( '-headless', action='store_true', help='draw with EGL and no display' )
+    parser.add_argument( '-loads', type=int, default=2, help='number of times each level is loaded, the first of which may bake it (default: 2)' )
+    parser.add_argument( '-warmup', type=int, default=10, help='number of frames drawn before timing starts (default: 10)' )
+    parser.add_argument( '-frames', type=int, default=300, help='number of frames timed along the camera path (default: 300)' )
+    parser.add_argument( '-o', '--output', type=Path, help='JSON file to write (default: benchmarks/<date>.json)' )
+    parser.add_argument( '-compare', nargs=2, type=Path, metavar=( 'baseline', 'results' ), help='compare two JSON files instead of benchmarking' )
+    args = parser.parse_args()
+
+    if args.compare:
+        compare_results( *args.compare )
+        sys.exit()
+
+    ## Must be set before pyglet.gl is first imported.
+    if args.headless:
+        pyglet.options[ 'headless' ] = True
+    pyglet.options[ 'shadow_window' ] = False
+
+    mario_graphics_dir = Path( os.path.realpath( __file__ ) ).parent
+    results = run_benchmark( mario_graphics_dir, args.levels, args.resolution, args.msaa, args.shaders, not args.nocull, args.lodbias, args.occlusion, max( args.loads, 1 ), args.warmup, max( args.frames, 1 ) )
+
+    output_path = args.output
+    if output_path is None:
+        output_path = mario_graphics_dir / 'benchmarks' / ( time.strftime( "%Y_%m_%d_%H%M%S", time.localtime() ) + '.json' )
+    os.makedirs( output_path.parent, exist_ok=True )
+    with open( output_path, 'w' ) as f:
+        json.dump( results, f, indent=1 )
+    print( "Results written to", output_path )
@@ -0,0 +1,319 @@
+import ctypes
+import math
+
+import numpy as np
+import pyglet
+from pyglet.gl import *
+from pyglet.graphics.vertexdomain import IndexedVertexDomain
+
+from gl_state import gl_state
+from spatial_index import build_spatial_index
+from rooms import find_floor
+
+
+## Occlusion query boxes are grown by this much on every side, so a flat unit's box isn't hidden by the unit itself.
+OCCLUSION_BOX_MARGIN = 4
+## Units whose box the camera is within this many near plane distances of aren't queried, since the near plane could clip the box away.
+OCCLUSION_NEAR_MARGIN = 4
+## The corners of a box are numbered with bit 0 for max x, bit 1 for max y, and bit 2 for max z.  These are the corners of its 12 triangles.
+BOX_TRIANGLE_CORNERS = [ 0, 2, 1, 1, 2, 3,  4, 5, 6, 5, 7, 6,  0, 1, 4, 1, 5, 4,  2, 6, 3, 3, 6, 7,  0, 4, 2, 2, 4, 6,  1, 3, 5, 3, 7, 5 ]
+
+
+def get_frustum_planes( position, yaw, pitch, fov, aspect, near, far ):
+    """The six planes of the view frustum GameWindow.on_draw sets up, as a ( 6, 4 ) array of ( a, b, c, d ) with the normals pointing inwards, so a point p is inside when a * x + b * y + c * z + d >= 0 for every plane.  The matrices are built the same way glRotatef, glTranslatef, and gluPerspective build them, so no GL state has to be read back."""
+    pitch_radians = math.radians( pitch )
+    yaw_radians = math.radians( yaw )
+    rotate_x = np.array( [ [ 1, 0, 0, 0 ], [ 0, math.cos( pitch_radians ), -math.sin( pitch_radians ), 0 ], [ 0, math.sin( pitch_radians ), math.cos( pitch_radians ), 0 ], [ 0, 0, 0, 1 ] ] )
+    rotate_y = np.array( [ [ math.cos( yaw_radians ), 0, math.sin( yaw_radians ), 0 ], [ 0, 1, 0, 0 ], [ -math.sin( yaw_radians ), 0, math.cos( yaw_radians ), 0 ], [ 0, 0, 0, 1 ] ] )
+    translate = np.identity( 4 )
+    translate[ : 3, 3 ] = position
+    f = 1 / math.tan( math.radians( fov ) / 2 )
+    projection = np.array( [ [ f / aspect, 0, 0, 0 ], [ 0, f, 0, 0 ], [ 0, 0, ( far + near ) / ( near - far ), 2 * far * near / ( near - far ) ], [ 0, 0, -1, 0 ] ] )
+
+    ## Gribb and Hartmann: each plane is the last row of the clip matrix plus or minus one of the others.
+    clip = projection @ rotate_x @ rotate_y @ translate
+    return np.array( [ clip[ 3 ] + clip[ 0 ], clip[ 3 ] - clip[ 0 ], clip[ 3 ] + clip[ 1 ], clip[ 3 ] - clip[ 1 ], clip[ 3 ] + clip[ 2 ], clip[ 3 ] - clip[ 2 ] ] )
+
+
+
+class OcclusionQueries():
+    """GL occlusion queries on the bounding boxes of a level's cull units.  After the level is drawn, issue() draws the box of each unit that was in view, without writing colour or depth, and counts the samples that pass the depth test.  A unit whose box has no samples pass is hidden behind the rest of the level.
+
+    Results are read by get_occluded() in the next frame, rather than waiting for the GPU to finish this one, so a unit that comes out from behind something is drawn a frame late.  Queries whose results still aren't ready then count as visible."""
+    def __init__( self, cull_boxes ):
+        self.cull_boxes = np.asarray( cull_boxes, dtype=np.float32 ).reshape( -1, 2, 3 )
+        boxes = self.cull_boxes + np.array( [ -OCCLUSION_BOX_MARGIN, OCCLUSION_BOX_MARGIN ], dtype=np.float32 )[ None, :, None ]
+        corner_bits = ( np.arange( 8 )[ :, None ] >> np.arange( 3 ) ) & 1
+        corners = np.where( corner_bits[ None ] == 1, boxes[ :, 1, None ], boxes[ :, 0, None ] )
+        self.vertices = np.ascontiguousarray( corners[ :, BOX_TRIANGLE_CORNERS ].reshape( -1, 3 ) )
+        self.query_ids = ( GLuint * len( self.cull_boxes ) )()
+        if len( self.cull_boxes ):
+            glGenQueries( len( self.cull_boxes ), self.query_ids )
+        ## Units queried in the last frame, whose results haven't been read yet.
+        self.queried = np.zeros( 0, dtype=np.intp )
+
+
+    def __del__( self ):
+        try:
+            glDeleteQueries( len( self.cull_boxes ), self.query_ids )
+        except:
+            pass
+
+
+    def reset( self ):
+        """Forgets the queries of the last frame, so that nothing is occluded until the next issue()."""
+        self.queried = np.zeros( 0, dtype=np.intp )
+
+
+    def get_occluded( self ):
+        """Whether each unit was hidden in the last frame, from the queries issued then.  Units that weren't queried, or whose queries aren't finished, aren't occluded."""
+        occluded = np.zeros( len( self.cull_boxes ), dtype=bool )
+        result = GLuint()
+        for each_unit in self.queried.tolist():
+            glGetQueryObjectuiv( self.query_ids[ each_unit ], GL_QUERY_RESULT_AVAILABLE, ctypes.byref( result ) )
+            if result.value:
+                glGetQueryObjectuiv( self.query_ids[ each_unit ], GL_QUERY_RESULT, ctypes.byref( result ) )
+                occluded[ each_unit ] = result.value == 0
+        self.queried = np.zeros( 0, dtype=np.intp )
+        return occluded
+
+
+    def issue( self, units, camera_position, near ):
+        """Queries the boxes of units against the depth buffer of the level that was just drawn.  Boxes the camera is in or next to aren't queried, and stay visible."""
+        boxes = self.cull_boxes[ units ]
+        reach = OCCLUSION_BOX_MARGIN + OCCLUSION_NEAR_MARGIN * near
+        camera_position = np.asarray( camera_position, dtype=np.float32 )
+        near_camera = ( ( boxes[ :, 0 ] - reach <= camera_position ) & ( camera_position <= boxes[ :, 1 ] + reach ) ).all( axis=1 )
+        empty = ( boxes[ :, 0 ] > boxes[ :, 1 ] ).any( axis=1 )
+        self.queried = np.asarray( units, dtype=np.intp )[ ~near_camera & ~empty ]
+        if not len( self.queried ):
+            return
+
+        ## Only depth testing should decide whether a box's samples pass, and nothing is written.  The polygon offset pulls the boxes towards the camera, for the same reason as the margin.
+        glPushAttrib( GL_ENABLE_BIT | GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT | GL_POLYGON_BIT )
+        glPushClientAttrib( GL_CLIENT_VERTEX_ARRAY_BIT )
+        glUseProgram( 0 )
+        for cap in [ GL_TEXTURE_2D, GL_LIGHTING, GL_BLEND, GL_ALPHA_TEST, GL_CULL_FACE, GL_STENCIL_TEST, GL_SCISSOR_TEST ]:
+            glDisable( cap )
+        glEnable( GL_DEPTH_TEST )
+        glDepthFunc( GL_LEQUAL )
+        glDepthMask( GL_FALSE )
+        glColorMask( GL_FALSE, GL_FALSE, GL_FALSE, GL_FALSE )
+        glPolygonMode( GL_FRONT_AND_BACK, GL_FILL )
+        glEnable( GL_POLYGON_OFFSET_FILL )
+        glPolygonOffset( -1, -4 )
+
+        glBindBuffer( GL_ARRAY_BUFFER, 0 )
+        glEnableClientState( GL_VERTEX_ARRAY )
+        glVertexPointer( 3, GL_FLOAT, 0, self.vertices.ctypes.data )
+        vertex_count = len( BOX_TRIANGLE_CORNERS )
+        for each_unit in self.queried.tolist():
+            glBeginQuery( GL_SAMPLES_PASSED, self.query_ids[ each_unit ] )
+            glDrawArrays( GL_TRIANGLES, each_unit * vertex_count, vertex_count )
+            glEndQuery( GL_SAMPLES_PASSED )
+
+        glPopClientAttrib()
+        glPopAttrib()
+        ## The program and the state the pops restored were changed behind gl_state's back.
+        gl_state.invalidate()
+
+
+
+class LevelBatch( pyglet.graphics.Batch ):
+    """A batch that only draws the parts of a level that are in view.
+
+    A level is split into cull units: each display list of an area's own geo, and each object, waterbox, painting, and moving texture.  Every unit has a bounding box, and each unit's triangles are a contiguous range of indices in each chunk it's in.  cull() finds the units in the view frustum with the level's SpatialIndex, and the domains of the batch then draw just the index ranges of visible units with one glMultiDrawElements, in place of pyglet's draw of everything in the domain.
+
+    Units from a geo's GEO_RENDER_RANGE branches are only drawn when the camera's distance from them, times the level of detail bias, is within their range, so far away objects switch to their low detail branch or aren't drawn at all.  uncull() draws every unit in view or not, but still picks one branch of each level of detail.
+
+    In levels split into rooms, cull() also works out which room the camera is in from the collision floor under it, and only draws the units that can be seen from that room.  The camera stays in the last room it was in while there's no room floor under it.
+
+    With occlusion on, cull() also skips the units that OcclusionQueries found hidden behind the rest of the level in the last frame, and query_occlusion() queries the units in view once the level is drawn.  Until cull() or uncull() is called, every unit in range of a camera at the unit's own position is drawn."""
+    def __init__( self ):
+        super().__init__()
+        self.cull_boxes = np.zeros( ( 0, 2, 3 ), dtype=np.float32 )
+        self.cull_areas = np.zeros( 0, dtype=np.uint16 )
+        self.spatial_index = build_spatial_index( self.cull_boxes )
+        self.cull_ranges = np.zeros( ( 0, 2 ), dtype=np.float32 )
+        self.cull_origins = np.zeros( ( 0, 3 ), dtype=np.float32 )
+        ## Units with a render range.
+        self.ranged_units = np.zeros( 0, dtype=np.intp )
+        ## domain -> ( index starts, index counts, units ), with starts relative to the domain's index buffer.
+        self.domain_ranges = {}
+        self.room_floors = np.zeros( ( 0, 3, 3 ), dtype=np.float32 )
+        self.room_floor_rooms = np.zeros( 0, dtype=np.intp )
+        self.room_units = np.zeros( ( 0, 0 ), dtype=bool )
+        self.current_room = None
+        self.occlusion_queries = None
+        ## Units to query for occlusion once the level is drawn, or None when occlusion is off.
+        self.query_units = None
+        self.visible = None
+
+        ## Counts for the last cull.
+        self.units_visible = 0
+        self.units_culled = 0
+        self.units_out_of_range = 0
+        self.units_in_other_rooms = 0
+        self.units_occluded = 0
+        self.indices_drawn = 0
+        self.draw_calls = 0
+
+
+    def set_cull_units( self, cull_boxes, cull_areas, spatial_index, cull_ranges, cull_origins ):
+        self.cull_boxes = np.asarray( cull_boxes, dtype=np.float32 )
+        self.cull_areas = np.asarray( cull_areas, dtype=np.intp )
+        self.spatial_index = spatial_index
+        self.cull_ranges = np.asarray( cull_ranges, dtype=np.float32 )
+        self.cull_origins = np.asarray( cull_origins, dtype=np.float32 )
+        self.ranged_units = np.flatnonzero( np.isfinite( self.cull_ranges ).any( axis=1 ) )
+        self.occlusion_queries = None
+        self.uncull()
+
+
+    def set_rooms( self, room_floors, room_floor_rooms, room_units ):
+        self.room_floors = np.asarray( room_floors, dtype=np.float32 )
+        self.room_floor_rooms = np.asarray( room_floor_rooms, dtype=np.intp )
+        self.room_units = np.asarray( room_units, dtype=bool )
+        self.current_room = None
+
+
+    def update_current_room( self, camera_position ):
+        if camera_position is None or not len( self.room_units ):
+            return
+        floor = find_floor( self.room_floors, camera_position )
+        if floor != -1 and self.room_floor_rooms[ floor ] != -1:
+            self.current_room = int( self.room_floor_rooms[ floor ] )
+
+
+    def add_cull_ranges( self, vertex_list, starts, counts, units ):
+        """Registers the index ranges of each unit within vertex_list.  starts are relative to the vertex list's indices."""
+        domain = vertex_list.domain
+        starts = np.asarray( starts, dtype=np.intp ) + vertex_list.index_start
+        counts = np.asarray( counts, dtype=np.intp )
+        units = np.asarray( units, dtype=np.intp )
+        if domain in self.domain_ranges:
+            old_starts, old_counts, old_units = self.domain_ranges[ domain ]
+            starts = np.concatenate( [ old_starts, starts ] )
+            counts = np.concatenate( [ old_counts, counts ] )
+            units = np.concatenate( [ old_units, units ] )
+        else:
+            domain.draw = lambda mode, vertex_list=None: self.draw_domain( domain, mode, vertex_list )
+        order = np.argsort( starts, kind='stable' )
+        self.domain_ranges[ domain ] = ( starts[ order ], counts[ order ], units[ order ] )
+
+
+    def get_units_in_range( self, camera_position, lod_bias ):
+        """Whether each of ranged_units is within its render range of camera_position ( in world space ), or of its own position if camera_position is None."""
+        ranges = self.cull_ranges[ self.ranged_units ]
+        if camera_position is None:
+            distances = np.zeros( len( self.ranged_units ), dtype=np.float32 )
+        else:
+            distances = np.linalg.norm( self.cull_origins[ self.ranged_units ] - np.asarray( camera_position, dtype=np.float32 ), axis=1 ) * lod_bias
+        return ( ranges[ :, 0 ] <= distances ) & ( distances < ranges[ :, 1 ] )
+
+
+    def apply_render_ranges( self, camera_position, lod_bias ):
+        in_range = self.get_units_in_range( camera_position, lod_bias )
+        self.units_out_of_range = int( np.count_nonzero( ~in_range & self.visible[ self.ranged_units ] ) )
+        self.visible[ self.ranged_units ] &= in_range
+        self.units_visible = int( np.count_nonzero( self.visible ) )
+        self.units_culled = len( self.visible ) - self.units_visible
+        self.indices_drawn = 0
+        self.draw_calls = 0
+
+
+    def apply_occlusion( self, occlusion ):
+        self.units_occluded = 0
+        if not occlusion:
+            self.query_units = None
+            if self.occlusion_queries is not None:
+                self.occlusion_queries.reset()
+            return
+        if self.occlusion_queries is None:
+            self.occlusion_queries = OcclusionQueries( self.cull_boxes )
+        self.query_units = np.flatnonzero( self.visible )
+        occluded = self.occlusion_queries.get_occluded() & self.visible
+        self.units_occluded = int( np.count_nonzero( occluded ) )
+        self.visible &= ~occluded
+        self.units_visible -= self.units_occluded
+        self.units_culled += self.units_occluded
+
+
+    def query_occlusion( self, camera_position, near ):
+        """Issues the occlusion queries for the next cull.  Call this right after the level is drawn, with the same camera, and the distance to its near plane."""
+        if self.query_units is not None:
+            self.occlusion_queries.issue( self.query_units, camera_position, near )
+
+
+    def cull( self, planes, camera_position=None, lod_bias=1.0, occlusion=False ):
+        """Draws only the units inside the frustum planes that are in range of camera_position, and can be seen from its room.  A larger lod_bias switches to low detail branches, and stops drawing objects, closer to the camera.  With occlusion, units hidden in the last frame are skipped as well."""
+        self.visible = np.zeros( len( self.cull_boxes ), dtype=bool )
+        self.visible[ self.spatial_index.query_frustum( planes ) ] = True
+        self.update_current_room( camera_position )
+        self.units_in_other_rooms = 0
+        if self.current_room is not None:
+            room_units = self.room_units[ self.current_room ]
+            self.units_in_other_rooms = int( np.count_nonzero( self.visible & ~room_units ) )
+            self.visible &= room_units
+        self.apply_render_ranges( camera_position, lod_bias )
+        self.apply_occlusion( occlusion and camera_position is not None )
+
+
+    def uncull( self, camera_position=None, lod_bias=1.0 ):
+        """Draws every unit in range of camera_position, in every room.  Without any render ranges, domains are drawn whole."""
+        self.units_in_other_rooms = 0
+        self.apply_occlusion( False )
+        if not len( self.ranged_units ):
+            self.visible = None
+            self.units_visible = len( self.cull_boxes )
+            self.units_culled = 0
+            self.units_out_of_range = 0
+            return
+        self.visible = np.ones( len( self.cull_boxes ), dtype=bool )
+        self.apply_render_ranges( camera_position, lod_bias )
+
+
+    def draw_domain( self, domain, mode, vertex_list=None ):
+        starts, counts, units = self.domain_ranges[ domain ]
+        if self.visible is None or vertex_list is not None:
+            IndexedVertexDomain.draw( domain, mode, vertex_list )
+            self.draw_calls += 1
+            return
+
+        ## Domains with nothing visible don't draw at all.
+        visible = self.visible[ units ]
+        starts = starts[ visible ]
+        if not len( starts ):
+            return
+        counts = counts[ visible ]
+        self.indices_drawn += int( counts.sum() )
+        self.draw_calls += 1
+
+        ## Ranges of neighbouring visible units are merged, so a domain that's entirely in view is still one range.
+        ends = starts + counts
+        breaks = np.flatnonzero( starts[ 1 : ] != ends[ : -1 ] ) + 1
+        merged_starts = starts[ np.concatenate( [ [ 0 ], breaks ] ) ]
+        merged_ends = ends[ np.concatenate( [ breaks - 1, [ len( ends ) - 1 ] ] ) ]
+        primcount = len( merged_starts )
+
+        ## Same as IndexedVertexDomain.draw, but with the visible ranges.
+        glPushClientAttrib( GL_CLIENT_VERTEX_ARRAY_BIT )
+        for buffer, attributes in domain.buffer_attributes:
+            buffer.bind()
+            for attribute in attributes:
+                attribute.enable()
+                attribute.set_pointer( attribute.buffer.ptr )
+        domain.index_buffer.bind()
+
+        offsets = merged_starts * domain.index_element_size + domain.index_buffer.ptr
+        if primcount == 1:
+            glDrawElements( mode, int( merged_ends[ 0 ] - merged_starts[ 0 ] ), domain.index_gl_type, int( offsets[ 0 ] ) )
+        else:
+            pointers = ( ctypes.POINTER( GLvoid ) * primcount )( *( GLintptr * primcount )( *offsets.tolist() ) )
+            sizes = ( GLsizei * primcount )( *( merged_ends - merged_starts ).tolist() )
+            glMultiDrawElements( mode, sizes, domain.index_gl_type, pointers, primcount )
+
+        domain.index_buffer.unbind()
+        for buffer, _ in domain.buffer_attributes:
+            buffer.unbind()
+        glPopClientAttrib()
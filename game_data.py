@@ -0,0 +1,98 @@
+from collections import ChainMap, OrderedDict
+
+import asset_store
+
+
+## The asset store the game loads, in the pickles directory.
+GAME_DATA_FILENAME = 'game_data.store'
+## The intro is baked like a level, under this name.
+INTRO = 'intro'
+## Display lists of the intro's logo and copyright.
+INTRO_DISPLAY_LISTS = [ 'intro_seg7_dl_0700B3A0', 'intro_seg7_dl_0700C6A0' ]
+
+## Sections of the game data store.  Each level, and the intro, has a section of its own, named by get_level_section_name, with its LevelScript and the display lists only it uses.  The actors section has everything shared between levels: the actor geo and every display list used by actors or by more than one level.
+START_POSITIONS_SECTION = 'start_positions'
+TEXTURES_SECTION = 'textures'
+ACTORS_SECTION = 'actors'
+INTRO_SECTION = 'intro'
+
+
+def get_level_section_name( level ):
+    if level == INTRO:
+        return INTRO_SECTION
+    return 'level/' + level
+
+
+def get_geo_dl_names( geo ):
+    return [ each_geo_dl.dl_name for each_geo_dl in geo.geo_dls or [] ]
+
+
+def get_level_dl_names( level_script ):
+    """Names of the display lists a level's own geo and paintings draw.  Objects drawn with actor geo aren't included."""
+    dl_names = set()
+    for each_geo in level_script.geo_dict.values():
+        dl_names.update( get_geo_dl_names( each_geo ) )
+    for each_area in level_script.areas:
+        for each_painting in each_area.paintings:
+            dl_names.add( each_painting.normal_dl )
+    return dl_names
+
+
+def split_game_data( level_scripts, geo_dict, gfx_display_dict, texture_dict, obj_name_to_geo_dict, special_dict ):
+    """Splits the game dicts into asset store sections, so that a level can be baked by loading only its own section and the actors section.  Display lists that nothing draws are left out."""
+    actor_dl_names = set()
+    for each_geo in geo_dict.values():
+        actor_dl_names.update( get_geo_dl_names( each_geo ) )
+
+    level_dl_names = { each_level : get_level_dl_names( each_level_script ) for each_level, each_level_script in level_scripts.items() }
+    level_counts = {}
+    for each_dl_names in level_dl_names.values():
+        for each_name in each_dl_names:
+            level_counts[ each_name ] = level_counts.get( each_name, 0 ) + 1
+    shared_dl_names = actor_dl_names | { each_name for each_name, each_count in level_counts.items() if each_count > 1 }
+
+    sections = {
+        START_POSITIONS_SECTION : { each_level : each_level_script.mario_pos for each_level, each_level_script in level_scripts.items() },
+        TEXTURES_SECTION : texture_dict,
+        INTRO_SECTION : { 'gfx_display_dict' : { each_name : gfx_display_dict[ each_name ] for each_name in INTRO_DISPLAY_LISTS } },
+        ACTORS_SECTION : { 'geo_dict' : geo_dict, 'obj_name_to_geo_dict' : obj_name_to_geo_dict, 'special_dict' : special_dict, 'gfx_display_dict' : { each_name : gfx_display_dict[ each_name ] for each_name in sorted( shared_dl_names ) if each_name in gfx_display_dict } },
+    }
+    for each_level, each_level_script in level_scripts.items():
+        dl_names = sorted( level_dl_names[ each_level ] - shared_dl_names )
+        sections[ get_level_section_name( each_level ) ] = { 'level_script' : each_level_script, 'gfx_display_dict' : { each_name : gfx_display_dict[ each_name ] for each_name in dl_names if each_name in gfx_display_dict } }
+    return sections
+
+
+
+class GameData():
+    """The game data store, loaded a section at a time.  Opening it only reads the table of contents and the start positions.  The sections of the last max_levels levels asked for are kept, and older ones are released, so memory follows the levels that have been visited recently rather than the whole game."""
+    def __init__( self, path, max_levels=4 ):
+        self.store = asset_store.AssetStore( path )
+        self.fingerprint = self.store.fingerprint
+        self.start_positions = self.store.get( START_POSITIONS_SECTION )
+        self.max_levels = max_levels
+        self.levels = OrderedDict()
+
+
+    def get_level( self, level ):
+        section = self.levels.get( level )
+        if section is None:
+            section = self.store.get( get_level_section_name( level ) )
+            self.levels[ level ] = section
+            while len( self.levels ) > self.max_levels:
+                oldest_level, _ = self.levels.popitem( last=False )
+                self.store.release( get_level_section_name( oldest_level ) )
+        else:
+            self.levels.move_to_end( level )
+        return section
+
+
+    def get_game_dicts( self, level ):
+        """The dicts a LevelBaker takes, with just what's needed to bake level ( or the intro ).  level_scripts only has level in it."""
+        level_section = self.get_level( level )
+        texture_dict = self.store.get( TEXTURES_SECTION )
+        if level == INTRO:
+            return {}, {}, level_section[ 'gfx_display_dict' ], texture_dict, {}, {}
+        actors = self.store.get( ACTORS_SECTION )
+        gfx_display_dict = ChainMap( level_section[ 'gfx_display_dict' ], actors[ 'gfx_display_dict' ] )
+        return { level : level_section[ 'level_script' ] }, actors[ 'geo_dict' ], gfx_display_dict, texture_dict, actors[ 'obj_name_to_geo_dict' ], actors[ 'special_dict' ]
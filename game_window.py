@@ -9,12 +9,15 @@ import util_math
 from skybox import Skybox
 from camera import FirstPersonCamera
 from geometry import Geometry
+from gl_state import gl_state
+from culling import get_frustum_planes
+from render_stats import RenderStats
 from menus import Button, Slider, Menu, PauseMenu, IntroMenu, MainPauseMenu, OptionsMenu, LevelSelectMenu
 
 
 class GameWindow( pyglet.window.Window ):
     """Main game class.  Contains main game parameters as well as the level geometry, camera, level batch (for the drawing of levels and objects), and fps display."""
-    def __init__( self, mario_graphics_dir, fullscreen=False, resolution=None, y_inv=False, vsync=False, msaa=1, resizable=True, show_fps=False, font=None ):
+    def __init__( self, mario_graphics_dir, fullscreen=False, resolution=None, y_inv=False, vsync=False, msaa=1, resizable=True, show_fps=False, font=None, use_shaders=False, visible=True, cull=True, lod_bias=1.0, occlusion=False ):
         self.mario_graphics_dir = mario_graphics_dir
         self.screenshot_dir = mario_graphics_dir / 'screenshots'
         os.makedirs( self.screenshot_dir, exist_ok=True )
@@ -34,6 +37,12 @@ class GameWindow( pyglet.window.Window ):
         self.wireframe = False
         self.load_textures = True
         self.load_skyboxes = True
+        ## Skip drawing the parts of the level outside the view frustum.
+        self.cull = cull
+        ## Camera distances are multiplied by this before being compared to render ranges, so larger values switch objects to low detail, and stop drawing them, closer to the camera.
+        self.lod_bias = lod_bias
+        ## Also skip the parts of the level that occlusion queries found hidden behind the rest of it.  Only used along with cull.
+        self.occlusion = occlusion
 
         ## MSAA.
         config = self.get_config( msaa )
@@ -45,7 +54,7 @@ class GameWindow( pyglet.window.Window ):
         border_style = self.get_border_style( fullscreen )
 
         ## Init pyglet window.
-        super().__init__( self.x_res, self.y_res, "Mario 64", resizable=resizable, vsync=vsync, fullscreen=False, config=config, style=border_style )
+        super().__init__( self.x_res, self.y_res, "Mario 64", resizable=resizable, vsync=vsync, fullscreen=False, config=config, style=border_style, visible=visible )
 
         if fullscreen:
             self.set_location( 0, 0 )
@@ -58,7 +67,7 @@ class GameWindow( pyglet.window.Window ):
         self.set_opengl_state()
 
         ## Geometry
-        self.level_geometry = Geometry( self.mario_graphics_dir )
+        self.level_geometry = Geometry( self.mario_graphics_dir, use_shaders=use_shaders )
         self.level_geometry.toggle_group_textures( self.load_textures )
         self.skybox_dict = { 'wdw':'wdw', 'ttm':'water', 'thi':'water', 'ddd':'water', 'hmc':None, 'bits':'bits', 'ccm':'ccm', 'pss':None, 'jrb':'clouds', 'rr':'cloud_floor', 'bitfs':'bitfs', 'cotmc':None, 'bowser_1':'bidw', 'wmotr':'cloud_floor', 'ttc':None, 'lll':'bitfs', 'totwc':'cloud_floor', 'wf':'cloud_floor', 'ssl':'ssl', 'sa':'cloud_floor', 'vcutm':None, 'bob':'water', 'castle_courtyard':'water', 'sl':'ccm', 'bitdw':'bidw', 'bbh':'bbh', 'castle_inside':None, 'bowser_3':'bits', 'bowser_2':'bitfs', 'castle_grounds':'water' }
 
@@ -67,6 +76,9 @@ class GameWindow( pyglet.window.Window ):
         self.fps_display = pyglet.window.FPSDisplay( self )
         self.fps_display.update_period = 0.2
 
+        ## Render statistics.  F3 shows them, F4 exports them.
+        self.render_stats = RenderStats( self, mario_graphics_dir / 'stats', font=self.font )
+
         ## Camera
         self.start_area = None
         self.start_yaw = None
@@ -140,7 +152,7 @@ class GameWindow( pyglet.window.Window ):
 
 
     def set_start_pos( self ):
-        self.start_area, self.start_yaw, *self.start_pos = self.level_geometry.level_scripts[ self.current_level ].mario_pos
+        self.start_area, self.start_yaw, *self.start_pos = self.level_geometry.start_positions[ self.current_level ]
         for i in range( 3 ):
             self.start_pos[ i ] = -1 * self.start_pos[ i ]
 
@@ -159,7 +171,8 @@ class GameWindow( pyglet.window.Window ):
         return level_batch
 
 
-    def load_new_level( self, level, areas=True ):
+    def load_new_level( self, level, areas=True, level_batch=None ):
+        """Switches to level, starting the camera at Mario's start position.  level_batch is the level's batch if it's already been loaded with Geometry.load_level."""
         if self.in_intro:
             self.in_intro = False
             self.exclusive_mouse = True
@@ -168,7 +181,7 @@ class GameWindow( pyglet.window.Window ):
             self.push_handlers( self.camera.input_handler )
         self.current_level = level
         self.set_start_pos()
-        self.level_batch = self.level_geometry.load_level( level )
+        self.level_batch = level_batch if level_batch is not None else self.level_geometry.load_level( level )
         ## Reset camera position to the new start_pos.
         self.camera.position = self.start_pos
         self.camera.yaw = self.start_yaw
@@ -196,6 +209,14 @@ class GameWindow( pyglet.window.Window ):
         if symbol == pyglet.window.key.ESCAPE:
             self.pause_game()
             return True
+        ## Show/hide the render statistics overlay.
+        if symbol == pyglet.window.key.F3:
+            self.render_stats.toggle_overlay()
+            return True
+        ## Export the recorded render statistics.
+        if symbol == pyglet.window.key.F4:
+            print( "Render statistics written to", self.render_stats.export() )
+            return True
 
 
     def on_resize( self, width, height ):
@@ -213,12 +234,15 @@ class GameWindow( pyglet.window.Window ):
 
 
     def on_draw( self ):
+        self.render_stats.begin_frame( self.level_batch )
         glClear( GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT )
 
         ## Draw skybox first.
+        self.render_stats.start( 'skybox' )
         if self.load_skyboxes:
             if self.skybox_present:
                 self.skybox.update_and_draw( self.camera.yaw, self.camera.pitch )
+        self.render_stats.stop( 'skybox' )
     
         """
         Set the scene based on the camera's pitch, yaw, and position.
@@ -240,25 +264,48 @@ class GameWindow( pyglet.window.Window ):
         gluPerspective( self.fov, self.x_res / self.y_res, 10, self.draw_distance )
         glTexEnvi( GL_TEXTURE_ENV, GL_TEXTURE_ENV_MODE, GL_MODULATE )
 
-        ## Draw the actual level.
+        ## Work out which parts of the level are in view and in range, with the same camera and projection.  The camera's position is negated, so negate it back to get its place in the level.
+        self.render_stats.start( 'cull' )
+        camera_world_position = [ -each_coordinate for each_coordinate in self.camera.position ]
+        if self.cull:
+            self.level_batch.cull( get_frustum_planes( self.camera.position, self.camera.yaw, self.camera.pitch, self.fov, self.x_res / self.y_res, 10, self.draw_distance ), camera_world_position, self.lod_bias, self.occlusion )
+        else:
+            self.level_batch.uncull( camera_world_position, self.lod_bias )
+        self.render_stats.stop( 'cull' )
+
+        ## Draw the actual level.  Everything drawn before it changes GL state behind gl_state's back, so start the frame with a blank shadow.
+        self.render_stats.start( 'level' )
+        gl_state.begin_frame()
         self.level_batch.draw()
+        self.render_stats.stop( 'level' )
+
+        ## Query which of the units in view are hidden behind what was just drawn, for the next frame's cull.
+        self.render_stats.start( 'occlude' )
+        self.level_batch.query_occlusion( camera_world_position, 10 )
+        self.render_stats.stop( 'occlude' )
 
         ## Draw the menu, if applicable.
+        self.render_stats.start( 'menu' )
         if self.paused or self.in_intro:
             self.pause_menu.draw()
+        self.render_stats.stop( 'menu' )
     
-        ## Draw the FPS display, if applicable.
-        if self.show_fps:
+        ## Draw the FPS display and render statistics, if applicable.
+        if self.show_fps or self.render_stats.show_overlay:
             if self.wireframe:
                 glPolygonMode( GL_FRONT_AND_BACK, GL_FILL )
-            self.fps_display.draw()
+            if self.show_fps:
+                self.fps_display.draw()
+            self.render_stats.draw_overlay()
             if self.wireframe:
                 glPolygonMode( GL_FRONT_AND_BACK, GL_LINE )
 
 
     def on_update( self, dt ):
         if not self.paused:
+            self.render_stats.start( 'camera' )
             self.camera.update( dt )
+            self.render_stats.stop( 'camera' )
 
 
     def register_menu_event_types( self ):
@@ -271,6 +318,7 @@ class GameWindow( pyglet.window.Window ):
         OptionsMenu.register_event_type( 'toggle_wireframe' )
         OptionsMenu.register_event_type( 'toggle_textures' )
         OptionsMenu.register_event_type( 'toggle_fps' )
+        OptionsMenu.register_event_type( 'toggle_occlusion' )
         ## Slider Events
         OptionsMenu.register_event_type( 'set_fov' )
         OptionsMenu.register_event_type( 'set_mouse_sensitivity' )
@@ -282,6 +330,7 @@ class GameWindow( pyglet.window.Window ):
         self.pause_menu.options_menu.set_handler( 'toggle_wireframe', self.toggle_wireframe )
         self.pause_menu.options_menu.set_handler( 'toggle_textures', self.toggle_textures )
         self.pause_menu.options_menu.set_handler( 'toggle_fps', self.toggle_fps )
+        self.pause_menu.options_menu.set_handler( 'toggle_occlusion', self.toggle_occlusion )
         self.pause_menu.options_menu.set_handler( 'go_back', self.pause_menu.go_back )
         ## OptionsMenu Sliders
         self.pause_menu.options_menu.set_handler( 'set_fov', self.set_fov )
@@ -370,6 +419,10 @@ class GameWindow( pyglet.window.Window ):
         self.toggle_bool( 'show_fps' )
 
 
+    def toggle_occlusion( self ):
+        self.toggle_bool( 'occlusion' )
+
+
     def toggle_skyboxes( self ):
         self.toggle_bool( 'load_skyboxes' )
 
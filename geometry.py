@@ -1,40 +1,50 @@
 import pyglet
 from pyglet.gl import *
-import math
-import pickle
+from pyglet.graphics import vertexattribute
+import ctypes
+import os
 
-from parsers.level_script_parser import LevelScript, LevelGeo, LevelGeoDisplayList, Area, Obj, WaterBox
-from parsers.level_fixes import get_extra_scale
-from parsers.geo_parser import Geo, GeoDisplayList, Animation
-from parsers.model_parser import Vertex, Vtx, Gfx, GfxDrawList, Light, RenderSettings
-from parsers.movtex_tri_parser import Movtex_Tri
+import numpy as np
 
-import util_math
-from groups import TextureEnableGroup, TextureBindGroup, Layer0Group, Layer1Group, Layer2Group, Layer3Group, Layer4Group, Layer5Group, Layer6Group, Layer7Group, RenderSettingsGroup
+import level_bake
+import culling
+import shaders
+from game_data import GameData, GAME_DATA_FILENAME
+from texture_manager import TextureManager
+from groups import TextureEnableGroup, TextureBindGroup, AtlasShaderGroup, Layer0Group, Layer1Group, Layer2Group, Layer3Group, Layer4Group, Layer5Group, Layer6Group, Layer7Group, RenderSettingsGroup
 
 
 
 class Geometry():
-    def __init__( self, mario_graphics_dir ):
+    def __init__( self, mario_graphics_dir, use_shaders=False ):
         self.mario_graphics_dir = mario_graphics_dir
         self.load_dicts()
 
-        self.layer_dict = { 'LAYER_FORCE' : 0, 'LAYER_OPAQUE' : 1, 'LAYER_OPAQUE_DECAL' : 2, 'LAYER_OPAQUE_INTER' : 3, 'LAYER_ALPHA' : 4, 'LAYER_TRANSPARENT' : 5, 'LAYER_TRANSPARENT_DECAL' : 6, 'LAYER_TRANSPARENT_INTER' : 7 }
-        self.reverse_layer_dict = { 0: 'LAYER_FORCE', 1: 'LAYER_OPAQUE', 2: 'LAYER_OPAQUE_DECAL', 3: 'LAYER_OPAQUE_INTER', 4: 'LAYER_ALPHA', 5: 'LAYER_TRANSPARENT', 6: 'LAYER_TRANSPARENT_DECAL', 7: 'LAYER_TRANSPARENT_INTER' }
+        ## With shaders, textured draw lists are drawn from a single atlas with the overflow behaviour done in the atlas shader.  G_TEXTURE_GEN draw lists and untextured draw lists still use the fixed function pipeline.
+        self.atlas_program = shaders.make_atlas_program() if use_shaders else None
+        self.use_shaders = self.atlas_program is not None
+
+        self.layer_dict = level_bake.LAYER_DICT
 
         self.batch = None
-        self.texture_atlas = None
-        ## We don't want to create new texture groups for the same texture, so we'll make a texture_group_dict which has keys texture_filename and values TextureBindGroup
-        self.texture_group_dict = {}
-        self.texture_atlas_dict = {}
+        self.spatial_index = None
+        ## Png filenames of the textures the current batch uses.
+        self.level_textures = []
+        ## Groups of the current batch, keyed by layer, texture, and render state, so each distinct group is only made once.
+        self.group_cache = {}
+        ## Textures, and the atlas, stay on the GPU from one level to the next.
+        self.texture_manager = TextureManager( self.mario_graphics_dir / 'texture_cache' )
         self.build_groups()
 
 
     def load_dicts( self ):
-        pickle_dir = self.mario_graphics_dir / 'pickles'
+        ## Only the store's table of contents and the start positions are read here.  Levels are normally mapped from their baked files, so a level's game data is only loaded if it has to be baked.
+        self.game_data = GameData( self.mario_graphics_dir / 'pickles' / GAME_DATA_FILENAME )
+        ## Baked levels are tied to the exact game data they were baked from.
+        self.fingerprint = self.game_data.fingerprint
+        self.start_positions = self.game_data.start_positions
 
-        with open( pickle_dir / 'game_dicts.pickle', 'rb' ) as f:
-            self.level_scripts, self.geo_dict, self.gfx_display_dict, self.texture_dict, self.obj_name_to_geo_dict, self.special_dict = pickle.load( f )
+        self.baked_dir = self.mario_graphics_dir / 'baked'
 
 
     def build_groups( self ):
@@ -58,349 +68,153 @@ class Geometry():
 
 
     def load_intro( self ):
-        ## Reset batch and texture_group_dict.
-        self.texture_atlas = pyglet.image.atlas.TextureAtlas()
-        self.texture_atlas_dict = {}
-        self.batch = pyglet.graphics.Batch()
-        self.texture_group_dict = {}
-        logo_dl = 'intro_seg7_dl_0700B3A0'
-        copyright_dl = 'intro_seg7_dl_0700C6A0'
-
-        ## Add logo to batch.
-        for each_gfx_draw_list in self.gfx_display_dict[ logo_dl ]:
-            current_layer = 'LAYER_OPAQUE'
-            current_transformation = util_math.identity_mat()
-            self.add_drawlist_to_batch( each_gfx_draw_list, current_layer, current_transformation )
-
-        ## Add copyright to batch.
-        for each_gfx_draw_list in self.gfx_display_dict[ copyright_dl ]:
-            if each_gfx_draw_list.name == 'intro_seg7_vertex_0700B420':
-                current_layer = 'LAYER_OPAQUE'
-                current_transformation = util_math.identity_mat()
-                self.add_drawlist_to_batch( each_gfx_draw_list, current_layer, current_transformation )
-
-        return self.batch
+        return self.upload_baked_level( self.get_baked_level( level_bake.INTRO, self.use_shaders ) )
 
 
-    def load_object( self, obj, level_to_load, current_area_offset ):
-        if 'LEVEL_GEOMETRY' in obj.model or 'special_level_geo' in obj.model:
-            if obj.type == 'SPECIAL_OBJECT':
-                try:
-                    geo_name = level_to_load.level_geo[ self.special_dict[ obj.model ] ]
-                    geo_to_load = level_to_load.geo_dict[ geo_name ]
-                except:
-                    geo_name = self.obj_name_to_geo_dict[ obj.model ]
-                    geo_to_load = self.geo_dict[ geo_name ]
-            else:
-                geo_name = level_to_load.level_geo[ obj.model ]
-                geo_to_load = level_to_load.geo_dict[ geo_name ]
-            self.process_geo_to_batch( geo_to_load, current_area_offset, obj_position=obj.position, obj_rotation=obj.angle )
-        else:
+    def get_baked_level( self, level, use_shaders ):
+        """Loads a level's baked file, baking it first ( and saving the result for next time ) if there's no up to date baked file."""
+        baked_path = self.baked_dir / level_bake.get_baked_filename( level, use_shaders )
+        baked_level = level_bake.load_baked_level( baked_path, self.fingerprint )
+        if baked_level is None:
+            baked_level = level_bake.make_baker( self.game_data, level ).bake_level( level, use_shaders )
+            baked_level.fingerprint = self.fingerprint
             try:
-                geo_name = self.obj_name_to_geo_dict[ obj.model ]
-                extra_scale = get_extra_scale( obj.model, obj.beh, obj.behParam, geo_name ) or 1.0
-                geo_to_load = self.geo_dict[ geo_name ]
-                self.process_geo_to_batch( geo_to_load, current_area_offset, obj_position=obj.position, obj_rotation=obj.angle, obj_scale=extra_scale )
-            except Exception as e:
+                os.makedirs( self.baked_dir, exist_ok=True )
+                level_bake.save_baked_level( baked_level, baked_path )
+            except OSError:
                 pass
-                #print( e )
+        return baked_level
 
 
     def load_level( self, level ):
-        ## Reset batch, atlas, texture_atlas_dict, and texture_group_dict.
-        self.batch = pyglet.graphics.Batch()
-        self.texture_atlas = pyglet.image.atlas.TextureAtlas()
-        ## texture_atlas_dict will keep track of TextureRegions in the atlas.
-        self.texture_atlas_dict = {}
-        self.texture_group_dict = {}
-
-        level_to_load = self.level_scripts[ level ]
-        for area in level_to_load.areas:
-            current_area_offset = area.offset
-
-            ## First load strictly area geo.  Note that this excludes objects and special objects that may be part of the level geometry.
-            for geo_to_load in area.geo:
-                root_area_geo = level_to_load.geo_dict[ geo_to_load ]
-                self.process_geo_to_batch( root_area_geo, current_area_offset )
-
-            ## Next, load any objects with acts.
-            for each_obj in area.objs_with_acts:
-                self.load_object( each_obj, level_to_load, current_area_offset )
-
-            ## Next, load any objects.
-            for each_obj in area.objs:
-                self.load_object( each_obj, level_to_load, current_area_offset )
-
-            ## Next, load any special objects.
-            for each_special_obj in area.special_objs:
-                self.load_object( each_special_obj, level_to_load, current_area_offset )
-
-            ## Next, load any macro objects.
-            for each_macro_obj in area.macro_objs:
-                self.load_object( each_macro_obj, level_to_load, current_area_offset )
-
-            ## Next, load any movtex objects.
-            for each_movtex_obj in area.movtex:
-                if isinstance( each_movtex_obj, WaterBox ):
-                    ## If the movtex object is a waterbox, load waterbox.
-                    self.add_waterbox_to_batch( each_movtex_obj, current_area_offset )
-
-                elif isinstance( each_movtex_obj, Movtex_Tri ):
-                    ## If the movtex object is a movtex tri, load it.
-                    self.add_movtex_tri_to_batch( each_movtex_obj, current_area_offset )
-
-            ## Load any paintings.
-            for each_painting in area.paintings:
-                self.add_painting_to_batch( each_painting, current_area_offset )
-
-
-        return self.batch
-
-
-
-    def process_geo_to_batch( self, geo, area_offset, obj_position=[ 0, 0, 0 ], obj_rotation=[ 0, 0, 0 ], obj_scale=1.0 ):
-        #shadows = geo.shadows
-        geo_dls = geo.geo_dls
-
-        for each_geo_dl in geo_dls:
-
-            current_layer = each_geo_dl.layer
-            if type( current_layer ) is int:
-                current_layer = self.reverse_layer_dict[ current_layer ]
-
-            current_translation = [ 0, 0, 0 ]
-            ## Update translation by area offset and obj_position.:
-            for i in range( 3 ):
-                current_translation[ i ] += area_offset[ i ] + obj_position[ i ]
-            translate_mat = util_math.translate_mat( current_translation[ 0 ], current_translation[ 1 ], current_translation[ 2 ] )
-            
-            transform = each_geo_dl.transformation
-            obj_scale_mat = util_math.scale_mat( obj_scale )
-            obj_rot_x = util_math.rotate_around_x( obj_rotation[ 0 ] )
-            obj_rot_y = util_math.rotate_around_y( obj_rotation[ 1 ] )
-            obj_rot_z = util_math.rotate_around_z( obj_rotation[ 2 ] )
-
-            transformation_mat = transform @ obj_scale_mat @ obj_rot_y @ obj_rot_x @ obj_rot_z @ translate_mat
-
-            for each_gfx_draw_list in self.gfx_display_dict[ each_geo_dl.dl_name ]:
-                ## Values in gfx_draw_dict are GfxDrawLists, which have attributes render_settings, positions, triangles, texel_coordinates, and colors.
-                self.add_drawlist_to_batch( each_gfx_draw_list, current_layer, transformation_mat )
-
-
-    def add_drawlist_to_batch( self, gfx_draw_list, current_layer, transformation_matrix ):
-
-        current_group = getattr( self, 'layer' + str( self.layer_dict[ current_layer ] ) + 'group' )
-        current_texture_enable = gfx_draw_list.render_settings.texture_enable and gfx_draw_list.render_settings.current_texture
-
-        current_texels = [ util_math.s10_5_to_int( i ) + 0.5  for i in gfx_draw_list.texel_coordinates ]
-
-        if current_texture_enable:
-
-            if self.texture_dict.get( gfx_draw_list.render_settings.current_texture ) is not None:
-                texture_filename = self.texture_dict[ gfx_draw_list.render_settings.current_texture ]
-                if self.texture_group_dict.get( texture_filename ):
-                    current_texture_info = self.texture_group_dict[ texture_filename ]
-                    current_texture = current_texture_info[ 0 ]
-
-                    s_scale = current_texture_info[ 1 ]
-                    t_scale = current_texture_info[ 2 ]
-                    s_setting = current_texture_info[ 3 ]
-                    t_setting = current_texture_info[ 4 ]
-
-                    if gfx_draw_list.render_settings.texture_settings[ 9 ] != s_setting or gfx_draw_list.render_settings.texture_settings[ 6 ] != t_setting:
-                        #print( "Using texture with wrong overflow behavior!", gfx_draw_list.render_settings.current_texture )
-                        pass
-
-                    current_parent = getattr( self, 'texture_enable_group_' + str( self.layer_dict[ current_layer ] ) )
-                    current_group = TextureBindGroup( current_texture, current_parent )
-                else:
-                    current_texture_image = pyglet.image.load( texture_filename )
-                    ## We load everything to the atlas as well as to its own texture.  This is wasteful, but textures are so small, there's not much more overhead.  With upcoming pyglet 2.0, we'll be able to just add everything to a single texture atlas and then use shaders regardless of texture coordinate overflow behavior.
-                    self.texture_atlas_dict[ texture_filename ] = self.texture_atlas.add( current_texture_image )
-                    current_texture = current_texture_image.get_texture()
-                    s_scale = current_texture_image.width
-                    t_scale = current_texture_image.height
-                    s_setting = gfx_draw_list.render_settings.texture_settings[ 9 ]
-                    t_setting = gfx_draw_list.render_settings.texture_settings[ 6 ]
-
-                    self.texture_group_dict[ texture_filename ] = [ current_texture, s_scale, t_scale, s_setting, t_setting ]
-
-                    current_parent = getattr( self, 'texture_enable_group_' + str( self.layer_dict[ current_layer ] ) )
-                    current_group = TextureBindGroup( current_texture, current_parent )
-
-                    ## Bind the texture and change texture coordinate overflow settings
-                    glEnable( GL_TEXTURE_2D )
-                    glBindTexture( GL_TEXTURE_2D, current_texture.id )
-
-                    if 'G_TX_CLAMP' in s_setting:
-                        glTexParameteri( GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE )
-                    elif 'G_TX_MIRROR' in s_setting:
-                        glTexParameteri( GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_MIRRORED_REPEAT )
-                    else:
-                        glTexParameteri( GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_REPEAT )
-                    if 'G_TX_CLAMP' in t_setting:
-                        glTexParameteri( GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE )
-                    elif 'G_TX_MIRROR' in t_setting:
-                        glTexParameteri( GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_MIRRORED_REPEAT )
-                    else:
-                        glTexParameteri( GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_REPEAT )
-
-            else:
-                raise ValueError( "texture_dict missing texture!!!" )
-
-
-            ## Convert N64 texel (ST-)coordinates to OpenGL (UV-) coordinates.
-            texture_render_s_scale = gfx_draw_list.render_settings.texture_render_settings[ 0 ] / 65535
-            texture_render_t_scale = gfx_draw_list.render_settings.texture_render_settings[ 1 ] / 65535
-            for i in range( len( current_texels ) ):
-                ## Fix s_scale.
-                if i % 2 == 0:
-                    current_texels[ i ] = texture_render_s_scale * current_texels[ i ] / s_scale
-
-                ## Fix t_scale.
+        try:
+            return self.upload_baked_level( self.get_baked_level( level, self.use_shaders ) )
+        except pyglet.image.atlas.AllocatorException:
+            if not self.use_shaders:
+                raise
+            ## Shaded levels need every texture in one atlas.
+            print( "The textures of", level, "don't fit in the atlas, drawing it without shaders." )
+            return self.upload_baked_level( self.get_baked_level( level, False ) )
+
+
+    def get_group( self, key, make_group ):
+        """Returns the group for key, calling make_group to make it the first time key is asked for."""
+        group = self.group_cache.get( key )
+        if group is None:
+            group = make_group()
+            self.group_cache[ key ] = group
+        return group
+
+
+    def get_chunk_group( self, chunk, texture ):
+        """Returns the interned group a chunk is drawn with.  texture is the texture or atlas region the chunk binds, if it's textured and not shaded."""
+        layer = chunk.layer
+        if chunk.shaded:
+            atlas_texture = self.texture_manager.texture_atlas.texture
+            key = ( layer, 'shader', atlas_texture.id, chunk.lit )
+            group = self.get_group( key, lambda: AtlasShaderGroup( self.atlas_program, atlas_texture, chunk.lit, self.texture_enable_groups[ layer ] ) )
+        elif texture is not None:
+            ## Every region of the atlas binds the same texture, so they all share a group.
+            key = ( layer, 'texture', texture.id )
+            group = self.get_group( key, lambda: TextureBindGroup( texture, self.texture_enable_groups[ layer ] ) )
+        else:
+            key = ( layer, )
+            group = getattr( self, 'layer' + str( layer ) + 'group' )
+
+        render_settings = chunk.render_settings
+        if render_settings is not None:
+            parent = group
+            group = self.get_group( key + ( render_settings.render_state_key(), ), lambda: RenderSettingsGroup( parent, render_settings.geometry_mode, render_settings.current_lights, render_settings.combine_mode, render_settings.env_colour ) )
+
+        return group
+
+
+    def upload_baked_level( self, baked_level ):
+        """Builds a new batch from a BakedLevel.  Every chunk becomes one vertex list, copied straight from the chunk's arrays into the batch's buffers.  The batch is a LevelBatch, which knows the index ranges and bounding boxes of the level's cull units."""
+        self.batch = culling.LevelBatch()
+        self.batch.set_cull_units( baked_level.cull_boxes, baked_level.cull_areas, baked_level.spatial_index, baked_level.cull_ranges, baked_level.cull_origins )
+        self.batch.set_rooms( baked_level.room_floors, baked_level.room_floor_rooms, baked_level.room_units )
+        ## Kept for queries about where things are in the level, like picking and camera collision.
+        self.spatial_index = baked_level.spatial_index
+        self.level_textures = list( baked_level.textures )
+        ## Textures may have been released since the last level, so groups aren't kept from one level to the next.
+        self.group_cache = {}
+        self.texture_manager.begin_level( baked_level.textures )
+
+        ## Atlas regions of the level's textures as ( s min, t min, s size, t size ), indexed by the texture_ids of shaded chunks.
+        texture_rects = np.zeros( ( len( baked_level.textures ), 4 ), dtype=np.float32 )
+        for ind, ( texture_filename, each_texture ) in enumerate( baked_level.textures.items() ):
+            if each_texture[ 4 ]:
+                region_tex_coords = self.texture_manager.get_atlas_region( texture_filename ).tex_coords
+                texture_rects[ ind ] = ( region_tex_coords[ 0 ], region_tex_coords[ 1 ], region_tex_coords[ 3 ] - region_tex_coords[ 0 ], region_tex_coords[ 7 ] - region_tex_coords[ 1 ] )
+
+        for each_chunk in baked_level.chunks:
+            current_texels = each_chunk.tex_coords
+            current_texture = None
+            shader_data = []
+
+            if each_chunk.shaded:
+                shader_data = [ ( shaders.TILE_RECT_FORMAT, texture_rects[ each_chunk.texture_ids ] ), ( shaders.TILE_SETTINGS_FORMAT, each_chunk.tile_settings ) ]
+
+            elif each_chunk.texture is not None:
+                if each_chunk.atlas:
+                    current_texture = self.texture_manager.get_atlas_region( each_chunk.texture )
+
+                    ## Convert the texture's texel coordinates to the coordinates of the texture region within the atlas.  Baked arrays are read only, so this makes a copy.
+                    region_tex_coords = current_texture.tex_coords
+                    region_min = np.array( [ region_tex_coords[ 0 ], region_tex_coords[ 1 ] ], dtype=np.float32 )
+                    region_max = np.array( [ region_tex_coords[ 3 ], region_tex_coords[ 7 ] ], dtype=np.float32 )
+                    current_texels = current_texels * ( region_max - region_min ) + region_min
                 else:
-                    current_texels[ i ] = ( ( texture_render_t_scale * current_texels[ i ] / t_scale ) * ( - 1 ) + 1 )
-
-            ## Check to see if the values of all texel coordinates are between 0 and 1.
-            test_bool = True
-            for i in current_texels:
-                if i > 1 or i < 0:
-                    test_bool = False
-                    break
-
-            if test_bool and not gfx_draw_list.render_settings.geometry_mode.get( 'G_TEXTURE_GEN' ):
-                ## Then we can use the texture_atlas version of the image.
-                current_texture = self.texture_atlas_dict[ texture_filename ]
-                current_parent = getattr( self, 'texture_enable_group_' + str( self.layer_dict[ current_layer ] ) )
-                current_group = TextureBindGroup( current_texture, current_parent )
-
-                ## Next, we have to convert our original texel coordinates to the coordinates of the texture region within the atlas.
-                region_tex_coords = current_texture.tex_coords
-                region_s_min = region_tex_coords[ 0 ]
-                region_s_max = region_tex_coords[ 3 ]
-                region_t_min = region_tex_coords[ 1 ]
-                region_t_max = region_tex_coords[ 7 ]
-                for ind in range( 0, len( current_texels ), 2 ):
-                    ## s-coordinate
-                    current_texels[ ind ] = current_texels[ ind ] * ( region_s_max - region_s_min ) + region_s_min
-                    ## t-coordinate
-                    current_texels[ ind + 1 ] = current_texels[ ind + 1 ] * ( region_t_max - region_t_min ) + region_t_min
-
-
-        current_positions = gfx_draw_list.positions.copy()
-        current_positions = util_math.mat_to_positions( util_math.positions_to_mat( current_positions ) @ transformation_matrix )
-
-        current_triangles = gfx_draw_list.triangles
-        current_colours = gfx_draw_list.colors
-        current_count = len( current_colours ) // 4
-
-        current_render_group = RenderSettingsGroup( current_group, gfx_draw_list.render_settings.geometry_mode, gfx_draw_list.render_settings.current_lights, gfx_draw_list.render_settings.combine_mode, gfx_draw_list.render_settings.env_colour )
-
-        if current_render_group.enable_lighting:
-            ## Send normals to the GPU.
-            current_normals = [ val for ind,val in enumerate( current_colours ) if ind % 4 != 3 ]
-            ## Convert the list from unsigned representation of two's complement to floats.
-            current_normals = util_math.convert_twos_comp_list( current_normals )
-            current_normals = util_math.mat_to_positions( util_math.normalize( util_math.normals_to_mat( current_normals ) @ transformation_matrix ) )
-            self.batch.add_indexed( current_count, GL_TRIANGLES, current_render_group, current_triangles, ( 'v3f', current_positions ), ( 't2f', current_texels ), ( 'n3f', current_normals ) )
+                    current_texture = self.texture_manager.get_texture( each_chunk.texture )
 
-        else:
-            ## Send colours to the GPU.
-            if gfx_draw_list.render_settings.env_colour is not None:
-                ## Then we need to change the current_colours alphas to the alpha in env_colour.
-                alpha = gfx_draw_list.render_settings.env_colour[ 3 ]
-                for i in range( 3, len( current_colours ), 4 ):
-                    current_colours[ i ] = alpha
-            self.batch.add_indexed( current_count, GL_TRIANGLES, current_render_group, current_triangles, ( 'v3f', current_positions ), ( 't2f', current_texels ), ( 'c4B', current_colours ) )
-
-
-    def add_painting_to_batch( self, painting, area_offset ):
-        ## Painting_scale is a value that is hard coded into the game.  A painting is scaled by painting.size / painting_scale.
-        painting_scale = 614.0
-        rot_y_angle = painting.yaw
-        rot_x_angle = painting.pitch
-        translate_x = painting.posx
-        translate_y = painting.posy
-        translate_z = painting.posz
-        translate_matrix = util_math.translate_mat( translate_x + area_offset[ 0 ], translate_y + area_offset[ 1 ], translate_z + area_offset[ 2 ] )
-        scale_size = painting.size / painting_scale
-        scale_matrix = util_math.scale_mat( scale_size )
-        rot_x_matrix = util_math.rotate_around_x( rot_x_angle )
-        rot_y_matrix = util_math.rotate_around_y( rot_y_angle )
-        transformation_matrix = scale_matrix @ rot_y_matrix @ rot_x_matrix @ translate_matrix
-
-        current_layer = painting.layer
-
-        for each_gfx_draw_list in self.gfx_display_dict[ painting.normal_dl ]:
-            self.add_drawlist_to_batch( each_gfx_draw_list, current_layer, transformation_matrix )
-
-
-
-    def add_waterbox_to_batch( self, waterbox, area_offset ):
-        current_layer = 'LAYER_TRANSPARENT_INTER'
-
-        if self.texture_dict.get( waterbox.texture ) is not None:
-            texture_filename = self.texture_dict[ waterbox.texture ]
-            if self.texture_group_dict.get( texture_filename ):
-                current_texture_info = self.texture_group_dict[ texture_filename ]
-                current_texture = current_texture_info[ 0 ]
-                s_scale = current_texture_info[ 1 ]
-                t_scale = current_texture_info[ 2 ]
-                s_setting = current_texture_info[ 3 ]
-                t_setting = current_texture_info[ 4 ]
-
-                current_parent = getattr( self, 'texture_enable_group_' + str( self.layer_dict[ current_layer ] ) )
-                current_group = TextureBindGroup( current_texture, current_parent )
+            current_group = self.get_chunk_group( each_chunk, current_texture )
 
+            if each_chunk.lit:
+                vertex_list = add_arrays_to_batch( self.batch, current_group, each_chunk.indices, ( 'v3f', each_chunk.positions ), ( 't2f', current_texels ), ( 'n3f', each_chunk.normals ), *shader_data )
             else:
-                current_texture_image = pyglet.image.load( texture_filename )
-                self.texture_atlas_dict[ texture_filename ] = self.texture_atlas.add( current_texture_image )
-                current_texture = current_texture_image.get_texture()
-                current_parent = getattr( self, 'texture_enable_group_' + str( self.layer_dict[ current_layer ] ) )
-                current_group = TextureBindGroup( current_texture, current_parent )
-                s_scale = current_texture_image.width
-                t_scale = current_texture_image.height
-                self.texture_group_dict[ texture_filename ] = [ current_texture, s_scale, t_scale, 'G_TX_WRAP | G_TX_NOMIRROR', 'G_TX_WRAP | G_TX_NOMIRROR' ]
-
-
-        current_count = 4
-        current_positions = area_offset * 4
-        current_colours = []
-        current_texels = []
-
-        if waterbox.rotation_direction == 0:
-            rot_offset = [ 0, 16384, -32768, -16384 ]
-        elif waterbox.rotation_direction == 1:
-            rot_offset = [ 0, -16384, -32768, 16384 ]
-        
-        for i in range( current_count ):
-
-            vx, vy, vz = getattr( waterbox, 'vert' + str( 1 + i ) )
-            current_positions[ 3 * i ] += vx
-            current_positions[ 3 * i + 1 ] += vy
-            current_positions[ 3 * i + 2 ] += vz
-            
-            s = ( 32 * waterbox.scale - 1.0 ) * math.sin( rot_offset[ i ] * math.pi  / 32768 )
-            t = ( 32 * waterbox.scale - 1.0 ) * math.cos( rot_offset[ i ] * math.pi  / 32768 )
-            current_texels += [ s, t ]
-
-            current_colours += waterbox.colour
-
-
-        for i in range( len( current_texels ) ):
-            ## Fix s_scale.
-            if i % 2 == 0:
-                current_texels[ i ] = current_texels[ i ] / s_scale
-
-            ## Fix t_scale.
-            else:
-                current_texels[ i ] = ( current_texels[ i ] / t_scale ) * ( - 1 ) + 1
+                vertex_list = add_arrays_to_batch( self.batch, current_group, each_chunk.indices, ( 'v3f', each_chunk.positions ), ( 't2f', current_texels ), ( 'c4B', each_chunk.colours ), *shader_data )
+            if vertex_list is not None:
+                self.batch.add_cull_ranges( vertex_list, each_chunk.cull_starts, each_chunk.cull_counts, each_chunk.cull_units )
 
-        current_triangles = [ 0, 1, 2, 0, 2, 3 ]
+        return self.batch
 
-        self.batch.add_indexed( current_count, GL_TRIANGLES, current_group, current_triangles, ( 'v3f', current_positions ), ( 't2f', current_texels ), ( 'c4B', current_colours ) )
 
 
-    def add_movtex_tri_to_batch( self, each_movtex_obj, current_area_offset ):
-        transformation_matrix = util_math.translate_mat( current_area_offset[ 0 ], current_area_offset[ 1 ], current_area_offset[ 2 ] )
-        self.add_drawlist_to_batch( each_movtex_obj.drawlist, each_movtex_obj.layer, transformation_matrix )
+def get_domain_attribute( domain, attribute_format ):
+    """The attribute of domain that attribute_format, such as 'v3f' or '1g4f', describes."""
+    attribute = vertexattribute.create_attribute( attribute_format )
+    if isinstance( attribute, vertexattribute.GenericAttribute ):
+        return domain.attribute_names[ 'generic' ][ attribute.index ]
+    if isinstance( attribute, vertexattribute.MultiTexCoordAttribute ):
+        return domain.attribute_names[ 'multi_tex_coords' ][ attribute.texture ]
+    return domain.attribute_names[ attribute.plural ]
+
+
+def add_arrays_to_batch( batch, group, indices, *data ):
+    """Same as batch.add_indexed( count, GL_TRIANGLES, group, indices, *data ), except that data are ( format, numpy array ) pairs which are copied directly into the vertex list's buffers rather than being converted from python lists.  Arrays are converted to the type of their format, and must have exactly count vertices' worth of it.  This relies on pyglet 1.5's private Batch._get_domain, and on its domains keeping a separate region per attribute."""
+    count = len( data[ 0 ][ 1 ] )
+    if count == 0:
+        return None
+
+    formats = tuple( each_format for each_format, _ in data )
+    domain = batch._get_domain( True, GL_TRIANGLES, group, formats )
+    vertex_list = domain.create( count, len( indices ) )
+
+    for each_format, array in data:
+        attribute = get_domain_attribute( domain, each_format )
+        region = attribute.get_region( attribute.buffer, vertex_list.start, count )
+        ## Kept in a local so that the copy, if one is made, lives until memmove is done with it.
+        contiguous = np.ascontiguousarray( array, dtype=np.dtype( attribute.c_type ) )
+        if contiguous.nbytes != ctypes.sizeof( region.array ):
+            raise ValueError( "Array for " + each_format + " has " + str( contiguous.nbytes ) + " bytes, but its region has " + str( ctypes.sizeof( region.array ) ) )
+        ctypes.memmove( region.array, contiguous.ctypes.data, contiguous.nbytes )
+        region.invalidate()
+
+    ## Indices in the baked file are relative to the chunk, but the index buffer is shared by the whole domain.
+    index_region = domain.get_index_region( vertex_list.index_start, len( indices ) )
+    index_array = np.asarray( indices, dtype=np.uint32 ) + np.uint32( vertex_list.start )
+    ctypes.memmove( index_region.array, index_array.ctypes.data, index_array.nbytes )
+    index_region.invalidate()
+
+    return vertex_list
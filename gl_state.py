@@ -0,0 +1,121 @@
+from pyglet.gl import *
+
+
+class GLState():
+    """A shadow of the GL state that the batch groups change, so that a call setting state to what it already is can be skipped.  Crossing into ctypes costs far more than a dict lookup, and pyglet calls set_state and unset_state on every group switch.
+
+    The shadow only knows about changes made through it.  Other code ( skyboxes, menus, pyglet's text ) changes the same state directly, so begin_frame forgets everything before the level batch is drawn.  issued and elided count the calls made and skipped since the last begin_frame, texture_binds counts the glBindTexture calls among them, and the last_ counts are for the previous frame."""
+    def __init__( self ):
+        self.caps = {}
+        self.values = {}
+        self.issued = 0
+        self.elided = 0
+        self.last_issued = 0
+        self.last_elided = 0
+        self.texture_binds = 0
+        self.last_texture_binds = 0
+
+
+    def invalidate( self ):
+        self.caps = {}
+        self.values = {}
+
+
+    def begin_frame( self ):
+        self.invalidate()
+        self.last_issued = self.issued
+        self.last_elided = self.elided
+        self.issued = 0
+        self.elided = 0
+        self.last_texture_binds = self.texture_binds
+        self.texture_binds = 0
+
+
+    def set_value( self, key, value ):
+        """Records key as value.  Returns True if it was already value, in which case the call can be skipped."""
+        if self.values.get( key ) == value:
+            self.elided += 1
+            return True
+        self.values[ key ] = value
+        self.issued += 1
+        return False
+
+
+    def enable( self, cap ):
+        if self.caps.get( cap ) is True:
+            self.elided += 1
+            return
+        self.caps[ cap ] = True
+        self.issued += 1
+        glEnable( cap )
+
+
+    def disable( self, cap ):
+        if self.caps.get( cap ) is False:
+            self.elided += 1
+            return
+        self.caps[ cap ] = False
+        self.issued += 1
+        glDisable( cap )
+
+
+    def depth_mask( self, flag ):
+        if not self.set_value( 'depth_mask', flag ):
+            glDepthMask( flag )
+
+
+    def polygon_offset( self, factor, units ):
+        if not self.set_value( 'polygon_offset', ( factor, units ) ):
+            glPolygonOffset( factor, units )
+
+
+    def alpha_func( self, func, ref ):
+        if not self.set_value( 'alpha_func', ( func, ref ) ):
+            glAlphaFunc( func, ref )
+
+
+    def bind_texture( self, target, texture_id ):
+        if not self.set_value( ( 'texture', target ), texture_id ):
+            self.texture_binds += 1
+            glBindTexture( target, texture_id )
+
+
+    def use_program( self, program_id ):
+        if not self.set_value( 'program', program_id ):
+            glUseProgram( program_id )
+
+
+    def uniform( self, program_id, location, setter, *values ):
+        """setter( location, *values ), e.g. glUniform1i, for the uniform at location in the program that's in use."""
+        if not self.set_value( ( 'uniform', program_id, location ), values ):
+            setter( location, *values )
+
+
+    def light( self, light, pname, array, values ):
+        """glLightfv( light, pname, array ).  values is array as a tuple, which callers work out once rather than on every call."""
+        if not self.set_value( ( 'light', light, pname ), values ):
+            glLightfv( light, pname, array )
+
+
+    def material( self, face, pname, array, values ):
+        """glMaterialfv( face, pname, array ).  GL_FRONT_AND_BACK is tracked as both faces."""
+        if face == GL_FRONT_AND_BACK:
+            if self.values.get( ( 'material', GL_FRONT, pname ) ) == values and self.values.get( ( 'material', GL_BACK, pname ) ) == values:
+                self.elided += 1
+                return
+            self.values[ ( 'material', GL_FRONT, pname ) ] = values
+            self.values[ ( 'material', GL_BACK, pname ) ] = values
+            self.issued += 1
+            glMaterialfv( face, pname, array )
+        elif not self.set_value( ( 'material', face, pname ), values ):
+            glMaterialfv( face, pname, array )
+
+
+    def tex_gen( self, coord, pname, array, values ):
+        if not self.set_value( ( 'tex_gen', coord, pname ), values ):
+            glTexGeniv( coord, pname, array )
+
+
+
+## The shadow of the one GL context the game draws with.
+gl_state = GLState()
@@ -4,6 +4,7 @@ import pyglet
 from pyglet.gl import *
 
 import util_math
+from gl_state import gl_state
 
 
 class TextureEnableGroup( pyglet.graphics.Group ):
@@ -13,12 +14,12 @@ class TextureEnableGroup( pyglet.graphics.Group ):
 
     def set_state( self ):
         if self.load_textures:
-            glEnable( GL_TEXTURE_2D )
+            gl_state.enable( GL_TEXTURE_2D )
         else:
-            glDisable( GL_TEXTURE_2D )
+            gl_state.disable( GL_TEXTURE_2D )
 
     def unset_state( self ):
-        glDisable( GL_TEXTURE_2D )
+        gl_state.disable( GL_TEXTURE_2D )
 
     def toggle_textures( self, texture_bool ):
         self.load_textures = texture_bool
@@ -32,7 +33,7 @@ class TextureBindGroup( pyglet.graphics.Group ):
         self.texture = texture
 
     def set_state( self ):
-        glBindTexture( GL_TEXTURE_2D, self.texture.id )
+        gl_state.bind_texture( GL_TEXTURE_2D, self.texture.id )
 
     # No unset_state method required.
 
@@ -46,13 +47,44 @@ class TextureBindGroup( pyglet.graphics.Group ):
         return hash( ( self.texture.id, self.texture.target ) )
 
 
+class AtlasShaderGroup( pyglet.graphics.Group ):
+    ## Draws shaded chunks, which can use any texture in the atlas, with the atlas shader.  The parent should be set to a TextureEnableGroup under the appropriate LayerNGroup.
+    def __init__( self, program, atlas_texture, lighting, parent ):
+        super( AtlasShaderGroup, self ).__init__( parent )
+        self.program = program
+        self.texture = atlas_texture
+        self.lighting = bool( lighting )
+        self.half_texel = ( 0.5 / atlas_texture.width, 0.5 / atlas_texture.height )
+
+    def set_state( self ):
+        gl_state.use_program( self.program.id )
+        gl_state.bind_texture( GL_TEXTURE_2D, self.texture.id )
+        gl_state.uniform( self.program.id, self.program.get_uniform_location( 'atlas' ), glUniform1i, 0 )
+        gl_state.uniform( self.program.id, self.program.get_uniform_location( 'lighting' ), glUniform1i, self.lighting )
+        gl_state.uniform( self.program.id, self.program.get_uniform_location( 'texture_enable' ), glUniform1i, self.parent.load_textures )
+        gl_state.uniform( self.program.id, self.program.get_uniform_location( 'half_texel' ), glUniform2f, *self.half_texel )
+
+    def unset_state( self ):
+        gl_state.use_program( 0 )
+
+    def __eq__( self, other ):
+        return ( self.__class__ is other.__class__ and
+                self.program is other.program and
+                self.texture.id == other.texture.id and
+                self.lighting == other.lighting and
+                self.parent == other.parent )
+
+    def __hash__( self ):
+        return hash( ( self.program.id, self.texture.id, self.lighting ) )
+
+
 class Layer0Group( pyglet.graphics.OrderedGroup ):
     ## Layer FORCE
     def __init__( self ):
         super( Layer0Group, self ).__init__( 0 )
 
     def set_state( self ):
-        glEnable( GL_DEPTH_TEST )
+        gl_state.enable( GL_DEPTH_TEST )
         pass
 
     def unset_state( self ):
@@ -65,8 +97,8 @@ class Layer1Group( pyglet.graphics.OrderedGroup ):
         super( Layer1Group, self ).__init__( 1 )
 
     def set_state( self ):
-        glEnable( GL_DEPTH_TEST )
-        glDepthMask( GL_TRUE )
+        gl_state.enable( GL_DEPTH_TEST )
+        gl_state.depth_mask( GL_TRUE )
 
     def unset_state( self ):
         pass
@@ -78,15 +110,15 @@ class Layer2Group( pyglet.graphics.OrderedGroup ):
         super( Layer2Group, self ).__init__( 2 )
 
     def set_state( self ):
-        glEnable( GL_DEPTH_TEST )
-        glDepthMask( GL_FALSE )
-        glPolygonOffset( -2, -2 )
-        glEnable( GL_POLYGON_OFFSET_FILL )
+        gl_state.enable( GL_DEPTH_TEST )
+        gl_state.depth_mask( GL_FALSE )
+        gl_state.polygon_offset( -2, -2 )
+        gl_state.enable( GL_POLYGON_OFFSET_FILL )
 
     def unset_state( self ):
-        glDepthMask( GL_TRUE )
-        glPolygonOffset( 0, 0 )
-        glDisable( GL_POLYGON_OFFSET_FILL )
+        gl_state.depth_mask( GL_TRUE )
+        gl_state.polygon_offset( 0, 0 )
+        gl_state.disable( GL_POLYGON_OFFSET_FILL )
 
 
 class Layer3Group( pyglet.graphics.OrderedGroup ):
@@ -95,7 +127,7 @@ class Layer3Group( pyglet.graphics.OrderedGroup ):
         super( Layer3Group, self ).__init__( 3 )
 
     def set_state( self ):
-        glDepthMask( GL_TRUE )
+        gl_state.depth_mask( GL_TRUE )
 
     def unset_state( self ):
         pass
@@ -107,12 +139,12 @@ class Layer4Group( pyglet.graphics.OrderedGroup ):
         super( Layer4Group, self ).__init__( 4 )
 
     def set_state( self ):
-        #glEnable( GL_BLEND )
-        glEnable( GL_ALPHA_TEST )
-        glAlphaFunc( GL_GREATER, 0.49 )
+        #gl_state.enable( GL_BLEND )
+        gl_state.enable( GL_ALPHA_TEST )
+        gl_state.alpha_func( GL_GREATER, 0.49 )
 
     def unset_state( self ):
-        glDisable( GL_ALPHA_TEST )
+        gl_state.disable( GL_ALPHA_TEST )
 
 
 class Layer5Group( pyglet.graphics.OrderedGroup ):
@@ -121,11 +153,11 @@ class Layer5Group( pyglet.graphics.OrderedGroup ):
         super( Layer5Group, self ).__init__( 5 )
 
     def set_state( self ):
-        glEnable( GL_BLEND )
-        glDepthMask( GL_FALSE )
+        gl_state.enable( GL_BLEND )
+        gl_state.depth_mask( GL_FALSE )
 
     def unset_state( self ):
-        glDepthMask( GL_TRUE )
+        gl_state.depth_mask( GL_TRUE )
 
 
 class Layer6Group( pyglet.graphics.OrderedGroup ):
@@ -134,15 +166,15 @@ class Layer6Group( pyglet.graphics.OrderedGroup ):
         super( Layer6Group, self ).__init__( 6 )
 
     def set_state( self ):
-        glEnable( GL_BLEND )
-        glDepthMask( GL_FALSE )
-        glPolygonOffset( -2, -2 )
-        glEnable( GL_POLYGON_OFFSET_FILL )
+        gl_state.enable( GL_BLEND )
+        gl_state.depth_mask( GL_FALSE )
+        gl_state.polygon_offset( -2, -2 )
+        gl_state.enable( GL_POLYGON_OFFSET_FILL )
 
     def unset_state( self ):
-        glPolygonOffset( 0, 0 )
-        glDepthMask( GL_TRUE )
-        glDisable( GL_POLYGON_OFFSET_FILL )
+        gl_state.polygon_offset( 0, 0 )
+        gl_state.depth_mask( GL_TRUE )
+        gl_state.disable( GL_POLYGON_OFFSET_FILL )
 
 
 class Layer7Group( pyglet.graphics.OrderedGroup ):
@@ -151,17 +183,17 @@ class Layer7Group( pyglet.graphics.OrderedGroup ):
         super( Layer7Group, self ).__init__( 7 )
 
     def set_state( self ):
-        glEnable( GL_BLEND )
-        glDepthMask( GL_FALSE )
-        glPolygonOffset( -2, -2 )
-        glEnable( GL_POLYGON_OFFSET_FILL )
+        gl_state.enable( GL_BLEND )
+        gl_state.depth_mask( GL_FALSE )
+        gl_state.polygon_offset( -2, -2 )
+        gl_state.enable( GL_POLYGON_OFFSET_FILL )
 
     def unset_state( self ):
-        glPolygonOffset( 0, 0 )
-        glDisable( GL_POLYGON_OFFSET_FILL )
-        glDisable( GL_BLEND )
-        glDepthMask( GL_TRUE )
-        glDisable( GL_DEPTH_TEST )
+        gl_state.polygon_offset( 0, 0 )
+        gl_state.disable( GL_POLYGON_OFFSET_FILL )
+        gl_state.disable( GL_BLEND )
+        gl_state.depth_mask( GL_TRUE )
+        gl_state.disable( GL_DEPTH_TEST )
 
 
 class RenderSettingsGroup( pyglet.graphics.Group ):
@@ -177,6 +209,10 @@ class RenderSettingsGroup( pyglet.graphics.Group ):
         self.env_tuple = ( 0.0, 0.0, 0.0, 0.0 )
         self.env_colour = None
         self.parse_render_info( geometry_mode, combine_mode, current_lights, env_colour )
+        ## The values of the ctypes arrays, for gl_state to compare against.
+        self.ambient_values = tuple( self.ambient )
+        self.diffuse_values = tuple( self.diffuse_colors )
+        self.tex_gen_values = None if self.tex_gen_arr is None else tuple( self.tex_gen_arr )
         self.set_state_setter()
 
 
@@ -233,39 +269,39 @@ class RenderSettingsGroup( pyglet.graphics.Group ):
         pass
 
     def tex_gen_lighting_no_transparency_set_state( self ):
-        glTexGeniv( GL_S, GL_TEXTURE_GEN_MODE, self.tex_gen_arr )
-        glEnable( GL_TEXTURE_GEN_S )
-        glEnable( GL_LIGHTING )
-        glLightfv( GL_LIGHT0, GL_AMBIENT, self.ambient )
-        glLightfv( GL_LIGHT0, GL_DIFFUSE, self.diffuse_colors )
-        glEnable( GL_LIGHT0 )
+        gl_state.tex_gen( GL_S, GL_TEXTURE_GEN_MODE, self.tex_gen_arr, self.tex_gen_values )
+        gl_state.enable( GL_TEXTURE_GEN_S )
+        gl_state.enable( GL_LIGHTING )
+        gl_state.light( GL_LIGHT0, GL_AMBIENT, self.ambient, self.ambient_values )
+        gl_state.light( GL_LIGHT0, GL_DIFFUSE, self.diffuse_colors, self.diffuse_values )
+        gl_state.enable( GL_LIGHT0 )
 
     def tex_gen_lighting_no_transparency_unset_state( self ):
-        glDisable( GL_TEXTURE_GEN_S )
-        glDisable( GL_LIGHT0 )
-        glDisable( GL_LIGHTING )
+        gl_state.disable( GL_TEXTURE_GEN_S )
+        gl_state.disable( GL_LIGHT0 )
+        gl_state.disable( GL_LIGHTING )
 
     def lighting_no_transparency_set_state( self ):
-        glEnable( GL_LIGHTING )
-        glLightfv( GL_LIGHT0, GL_AMBIENT, self.ambient )
-        glLightfv( GL_LIGHT0, GL_DIFFUSE, self.diffuse_colors )
-        glEnable( GL_LIGHT0 )
+        gl_state.enable( GL_LIGHTING )
+        gl_state.light( GL_LIGHT0, GL_AMBIENT, self.ambient, self.ambient_values )
+        gl_state.light( GL_LIGHT0, GL_DIFFUSE, self.diffuse_colors, self.diffuse_values )
+        gl_state.enable( GL_LIGHT0 )
 
     def lighting_no_transparency_unset_state( self ):
-        glDisable( GL_LIGHT0 )
-        glDisable( GL_LIGHTING )
+        gl_state.disable( GL_LIGHT0 )
+        gl_state.disable( GL_LIGHTING )
 
     def lighting_transparency_set_state( self ):
-        glEnable( GL_LIGHTING )
-        glLightfv( GL_LIGHT0, GL_AMBIENT, self.ambient )
-        glLightfv( GL_LIGHT0, GL_DIFFUSE, self.diffuse_colors )
-        glEnable( GL_LIGHT0 )
-        glMaterialfv( GL_FRONT, GL_AMBIENT_AND_DIFFUSE, self.env_colour )
+        gl_state.enable( GL_LIGHTING )
+        gl_state.light( GL_LIGHT0, GL_AMBIENT, self.ambient, self.ambient_values )
+        gl_state.light( GL_LIGHT0, GL_DIFFUSE, self.diffuse_colors, self.diffuse_values )
+        gl_state.enable( GL_LIGHT0 )
+        gl_state.material( GL_FRONT, GL_AMBIENT_AND_DIFFUSE, self.env_colour, self.env_tuple )
 
     def lighting_transparency_unset_state( self ):
-        glDisable( GL_LIGHT0 )
-        glDisable( GL_LIGHTING )
-        glMaterialfv( GL_FRONT_AND_BACK, GL_AMBIENT_AND_DIFFUSE, self.reset_mat_colour )
+        gl_state.disable( GL_LIGHT0 )
+        gl_state.disable( GL_LIGHTING )
+        gl_state.material( GL_FRONT_AND_BACK, GL_AMBIENT_AND_DIFFUSE, self.reset_mat_colour, ( 1.0, 1.0, 1.0, 1.0 ) )
 
 
     def set_state_setter( self ):
@@ -293,6 +329,7 @@ class RenderSettingsGroup( pyglet.graphics.Group ):
         return ( self.__class__ is other.__class__ and
                 self.parent == other.parent and
                 self.enable_lighting == other.enable_lighting and
+                bool( self.texture_gen ) == bool( other.texture_gen ) and
                 self.combine_mode == other.combine_mode and
                 self.env_tuple == other.env_tuple and
                 tuple( self.ambient ) == tuple( other.ambient ) and
@@ -300,4 +337,4 @@ class RenderSettingsGroup( pyglet.graphics.Group ):
                 tuple( self.diffuse_colors ) == tuple( other.diffuse_colors ) )
                 
     def __hash__( self ):
-        return hash( ( self.parent, self.enable_lighting, self.combine_mode, self.env_tuple, tuple( self.ambient ), tuple( self.diffuse_direction ), tuple( self.diffuse_colors ) ) )
+        return hash( ( self.parent, self.enable_lighting, bool( self.texture_gen ), self.combine_mode, self.env_tuple, tuple( self.ambient ), tuple( self.diffuse_direction ), tuple( self.diffuse_colors ) ) )
@@ -0,0 +1,678 @@
+from pathlib import Path
+import math
+import os
+import pickle
+import struct
+
+import numpy as np
+
+from parsers.level_script_parser import WaterBox
+from parsers.level_fixes import get_extra_scale
+from parsers.movtex_tri_parser import Movtex_Tri
+
+from game_data import GameData, GAME_DATA_FILENAME, INTRO, INTRO_DISPLAY_LISTS
+from spatial_index import SpatialIndex, build_spatial_index, SPATIAL_INDEX_ARRAYS
+from rooms import find_floor, get_adjacent_rooms
+import util_math
+
+
+LAYER_DICT = { 'LAYER_FORCE' : 0, 'LAYER_OPAQUE' : 1, 'LAYER_OPAQUE_DECAL' : 2, 'LAYER_OPAQUE_INTER' : 3, 'LAYER_ALPHA' : 4, 'LAYER_TRANSPARENT' : 5, 'LAYER_TRANSPARENT_DECAL' : 6, 'LAYER_TRANSPARENT_INTER' : 7 }
+
+## Bump this whenever the baked output or the file format changes, so that old baked files are ignored.
+BAKE_VERSION = 8
+BAKE_MAGIC = b'LV64BAKE'
+BAKE_ALIGNMENT = 16
+
+## Names of the arrays in a BakedChunk, in the order they're stored.
+CHUNK_ARRAYS = [ 'positions', 'tex_coords', 'normals', 'colours', 'texture_ids', 'tile_settings', 'indices', 'cull_units', 'cull_starts', 'cull_counts' ]
+
+## Textures first seen on a waterbox always repeat.
+WATERBOX_WRAP = 'G_TX_WRAP | G_TX_NOMIRROR'
+
+
+def get_baked_filename( level, shaders=False ):
+    if shaders:
+        return level + '.shaded.bake'
+    return level + '.bake'
+
+
+def read_png_size( filename ):
+    """Reads the width and height of a png from its IHDR chunk without decoding the image."""
+    with open( filename, 'rb' ) as f:
+        header = f.read( 24 )
+    assert header[ : 8 ] == b'\x89PNG\r\n\x1a\n', "Not a png: " + str( filename )
+    return struct.unpack( '>II', header[ 16 : 24 ] )
+
+
+def get_tile_int( value ):
+    """Tile masks and shifts are either numbers or names like G_TX_NOMASK and G_TX_NOLOD, all of which are 0."""
+    if type( value ) is int:
+        return value
+    return 0
+
+
+def get_shift_scale( shift ):
+    """N64 tile shifts scale texel coordinates down by 2 ** shift for shifts 1 to 10, and up by 2 ** ( 16 - shift ) for 11 to 15."""
+    if shift <= 0:
+        return 1.0
+    if shift <= 10:
+        return 1.0 / ( 1 << shift )
+    return float( 1 << ( 16 - shift ) )
+
+
+def get_wrap_mode( setting ):
+    """Packs a G_TX_ overflow setting into the number the atlas shader expects: 2 for clamp, plus 1 for mirror."""
+    return 2.0 * ( 'G_TX_CLAMP' in setting ) + ( 'G_TX_MIRROR' in setting )
+
+
+def get_mask_period( mask, size ):
+    """The length of a tile mask's wrap period as a fraction of the texture.  No mask wraps on the whole texture."""
+    if mask <= 0:
+        return 1.0
+    return min( 1.0, ( 1 << mask ) / size )
+
+
+def get_layer_index( layer ):
+    if type( layer ) is int:
+        return layer
+    return LAYER_DICT[ layer ]
+
+
+def get_group_key( render_settings ):
+    """Draw lists that agree on this can share a vertex list.  Waterboxes have no render settings."""
+    if render_settings is None:
+        return None
+    return render_settings.render_state_key()
+
+
+
+class BakedChunk():
+    """Every triangle of a level that is drawn with the same layer, texture, and render settings, in world space and ready to upload.
+
+    texture is a png filename, or None if the chunk is untextured.  If atlas is True, tex_coords are relative to the texture and have to be mapped into the texture's region of the atlas when uploaded.  render_settings is None for waterboxes, which are drawn without a RenderSettingsGroup.  Lit chunks have normals and unlit chunks have colours.
+
+    Shaded chunks are drawn with the atlas shader and can mix any number of textures.  Their texture is None, each vertex has the index of its texture in the level's textures in texture_ids, and its overflow behaviour ( s mode, t mode, s period, t period ) in tile_settings.
+
+    The triangles of each cull unit are contiguous in indices.  cull_units, cull_starts, and cull_counts list the units in the chunk along with where their indices start and how many there are."""
+    def __init__( self, layer, texture, atlas, render_settings, shaded=False ):
+        self.layer = layer
+        self.texture = texture
+        self.atlas = atlas
+        self.shaded = shaded
+        self.render_settings = render_settings
+        self.lit = render_settings is not None and bool( render_settings.geometry_mode[ 'G_LIGHTING' ] )
+        self.positions = None   ## float32 ( n, 3 )
+        self.tex_coords = None  ## float32 ( n, 2 )
+        self.normals = None     ## float32 ( n, 3 ), lit only
+        self.colours = None     ## uint8 ( n, 4 ), unlit only
+        self.texture_ids = None     ## uint16 ( n, ), shaded only
+        self.tile_settings = None   ## float32 ( n, 4 ), shaded only
+        self.indices = None     ## uint32
+        self.cull_units = None  ## uint32
+        self.cull_starts = None ## uint32
+        self.cull_counts = None ## uint32
+        self.parts = []
+
+
+    def add_part( self, positions, tex_coords, normals_or_colours, triangles, texture_id=None, tile_settings=None, cull_unit=0 ):
+        self.parts.append( ( positions, tex_coords, normals_or_colours, triangles, texture_id, tile_settings, cull_unit ) )
+
+
+    def finish( self ):
+        """Concatenates the parts into the chunk's arrays, offsetting each part's triangles by the number of vertices before it.  Parts are ordered by cull unit first, which keeps the order they were added in except where place_textures merged chunks."""
+        self.parts.sort( key=lambda each_part: each_part[ 6 ] )
+        part_units = np.array( [ each_part[ 6 ] for each_part in self.parts ], dtype=np.uint32 )
+        part_index_counts = np.array( [ len( each_part[ 3 ] ) for each_part in self.parts ], dtype=np.uint32 )
+        unit_firsts = np.flatnonzero( np.diff( part_units, prepend=np.uint32( part_units[ 0 ] ) + 1 ) )
+        self.cull_units = part_units[ unit_firsts ]
+        self.cull_starts = ( np.cumsum( part_index_counts ) - part_index_counts )[ unit_firsts ].astype( np.uint32 )
+        self.cull_counts = np.add.reduceat( part_index_counts, unit_firsts ).astype( np.uint32 )
+
+        offsets = np.cumsum( [ 0 ] + [ len( each_part[ 0 ] ) for each_part in self.parts[ : -1 ] ] )
+        self.positions = np.concatenate( [ each_part[ 0 ] for each_part in self.parts ] ).astype( np.float32 )
+        self.tex_coords = np.concatenate( [ each_part[ 1 ] for each_part in self.parts ] ).astype( np.float32 )
+        if self.lit:
+            self.normals = np.concatenate( [ each_part[ 2 ] for each_part in self.parts ] ).astype( np.float32 )
+        else:
+            self.colours = np.concatenate( [ each_part[ 2 ] for each_part in self.parts ] ).astype( np.uint8 )
+        if self.shaded:
+            self.texture_ids = np.concatenate( [ np.full( len( each_part[ 0 ] ), each_part[ 4 ], dtype=np.uint16 ) for each_part in self.parts ] )
+            self.tile_settings = np.concatenate( [ np.tile( np.asarray( each_part[ 5 ], dtype=np.float32 ), ( len( each_part[ 0 ] ), 1 ) ) for each_part in self.parts ] )
+        self.indices = np.concatenate( [ np.asarray( each_part[ 3 ], dtype=np.uint32 ) + offset for each_part, offset in zip( self.parts, offsets ) ] ).astype( np.uint32 )
+        self.parts = []
+
+
+
+class BakedLevel():
+    """The chunks of a level along with the textures they use.  textures maps png filename -> ( width, height, s_setting, t_setting, atlas, standalone ), in the order the textures were first used, which is also the order of the texture_ids of shaded chunks.  The settings are the overflow behaviour of the first draw list that used the texture, and atlas and standalone say whether the texture is used from the atlas and from a texture of its own.
+
+    cull_boxes is a float32 ( units, 2, 3 ) array of the world space ( min, max ) bounding box of each cull unit, and cull_areas is the index of the area each unit is in.  spatial_index is a SpatialIndex over cull_boxes.  cull_ranges has the ( near, far ) camera distances from the geo's GEO_RENDER_RANGE that each unit is drawn between ( -inf, inf for units that are always drawn ), measured from the unit's point in cull_origins.
+
+    Levels split into rooms have the collision floors of their rooms in room_floors, along with the room each floor is in ( -1 for none ) in room_floor_rooms.  Rooms are numbered across every area of the level, and room_units is a ( rooms, units ) bool array of the units that can be seen from each room."""
+    def __init__( self, textures, chunks, fingerprint=None, cull_boxes=None, cull_areas=None, spatial_index=None, cull_ranges=None, cull_origins=None, room_floors=None, room_floor_rooms=None, room_units=None ):
+        self.textures = textures
+        self.chunks = chunks
+        self.fingerprint = fingerprint
+        self.cull_boxes = cull_boxes
+        self.cull_areas = cull_areas
+        self.spatial_index = spatial_index
+        self.cull_ranges = cull_ranges
+        self.cull_origins = cull_origins
+        self.room_floors = room_floors
+        self.room_floor_rooms = room_floor_rooms
+        self.room_units = room_units
+
+
+
+class LevelBaker():
+    """Walks a level the same way the game used to when building its batch, but instead of adding every draw list to pyglet, transforms everything to world space with numpy and merges draw lists that share a group into one chunk.  Doesn't touch OpenGL, so it runs in setup as well as in the game."""
+    def __init__( self, level_scripts, geo_dict, gfx_display_dict, texture_dict, obj_name_to_geo_dict, special_dict ):
+        self.level_scripts = level_scripts
+        self.geo_dict = geo_dict
+        self.gfx_display_dict = gfx_display_dict
+        self.texture_dict = texture_dict
+        self.obj_name_to_geo_dict = obj_name_to_geo_dict
+        self.special_dict = special_dict
+        self.texture_sizes = {}
+        self.reset()
+
+
+    def reset( self, shaders=False ):
+        self.shaders = shaders
+        self.chunks = {}
+        self.textures = {}
+        self.texture_ids = {}
+        self.shaded_textures = set()
+        ## Cull units are numbered in the order they're added.  cull_unit is the unit being added to, and unit_areas, unit_ranges, and unit_origins the area, render range, and the point the render range is measured from of each unit.
+        self.cull_unit = -1
+        self.unit_areas = []
+        self.unit_ranges = []
+        self.unit_origins = []
+        self.current_area = 0
+        ## ( area index, area, room_dl_names, display list name -> unit ) of each area split into rooms.
+        self.room_areas = []
+
+
+    def new_cull_unit( self, render_range=None, origin=None ):
+        self.unit_areas.append( self.current_area )
+        self.unit_ranges.append( render_range if render_range is not None else ( -np.inf, np.inf ) )
+        self.unit_origins.append( origin if origin is not None else ( 0.0, 0.0, 0.0 ) )
+        self.cull_unit = len( self.unit_areas ) - 1
+
+
+    def place_textures( self ):
+        """Decides once per texture whether it lives in the atlas or in a texture of its own, so no texture is uploaded twice.  A texture can only go in the atlas if every chunk that uses it can, i.e. all of its texel coordinates are between 0 and 1 and none of its draw lists use G_TEXTURE_GEN.  Atlas chunks of textures that can't are merged into the matching standalone chunk."""
+        standalone = { key[ 1 ] for key in self.chunks if key[ 1 ] is not None and not key[ 2 ] }
+        chunks = {}
+        for key, each_chunk in self.chunks.items():
+            layer, texture, atlas, shaded, group_key = key
+            if atlas and texture in standalone:
+                key = ( layer, texture, False, shaded, group_key )
+                if key in self.chunks:
+                    self.chunks[ key ].parts += each_chunk.parts
+                    continue
+                each_chunk.atlas = False
+            chunks[ key ] = each_chunk
+        self.chunks = chunks
+
+        ## Textures of shaded chunks always go in the atlas.  Only shaded levels can have a texture in both places, when it's also used with G_TEXTURE_GEN.
+        in_atlas = { key[ 1 ] for key in self.chunks if key[ 1 ] is not None and key[ 2 ] } | self.shaded_textures
+        for texture_filename, ( width, height, s_setting, t_setting ) in self.textures.items():
+            self.textures[ texture_filename ] = ( width, height, s_setting, t_setting, texture_filename in in_atlas, texture_filename in standalone )
+
+
+    def get_cull_boxes( self ):
+        """Bounding boxes of the cull units, from the positions of every part added to them.  Units without any vertices get an empty box ( min inf, max -inf ), which is never in view."""
+        cull_boxes = np.empty( ( len( self.unit_areas ), 2, 3 ), dtype=np.float32 )
+        cull_boxes[ :, 0 ] = np.inf
+        cull_boxes[ :, 1 ] = -np.inf
+        for each_chunk in self.chunks.values():
+            for each_part in each_chunk.parts:
+                if len( each_part[ 0 ] ):
+                    cull_boxes[ each_part[ 6 ], 0 ] = np.minimum( cull_boxes[ each_part[ 6 ], 0 ], each_part[ 0 ].min( axis=0 ) )
+                    cull_boxes[ each_part[ 6 ], 1 ] = np.maximum( cull_boxes[ each_part[ 6 ], 1 ], each_part[ 0 ].max( axis=0 ) )
+        return cull_boxes
+
+
+    def get_rooms( self, cull_boxes ):
+        """Works out which units can be seen from each room.  Returns ( room_floors, room_floor_rooms, room_units ), as described in BakedLevel.
+
+        From a room, only its own geo_switch_area case of its area's geo is drawn.  Every other unit of the area is given the room of the floor under the centre of its box, and is drawn from the rooms next to that room, or from every room if there's no floor under it.  Units of other areas with rooms are never drawn, and units of areas without rooms always are."""
+        unit_areas = np.array( self.unit_areas, dtype=np.intp )
+        room_floors = []
+        room_floor_rooms = []
+        room_units = []
+        room_area_units = []
+        for area_index, area, room_dl_names, dl_units in self.room_areas:
+            first_room = len( room_units )
+            floors = area.floors + np.asarray( area.offset, dtype=np.float32 )
+            ## Room number r is case r - 1.  Rooms without a case keep the camera in the room it was in.
+            floor_cases = area.floor_rooms.astype( np.intp ) - 1
+            room_floors.append( floors )
+            room_floor_rooms.append( np.where( ( floor_cases >= 0 ) & ( floor_cases < len( room_dl_names ) ), floor_cases + first_room, -1 ) )
+
+            area_units = np.flatnonzero( unit_areas == area_index )
+            room_area_units.append( area_units )
+            case_units = [ [ dl_units[ each_name ] for each_name in each_names if each_name in dl_units ] for each_names in room_dl_names ]
+            switched_units = { each_unit for each_units in case_units for each_unit in each_units }
+            unit_rooms = {}
+            for each_unit in area_units:
+                if each_unit in switched_units or not ( cull_boxes[ each_unit, 0 ] <= cull_boxes[ each_unit, 1 ] ).all():
+                    continue
+                ## As for the camera, floors of room 0 ( no room ) or of rooms without a case don't put a unit in a room.
+                floor = find_floor( floors, cull_boxes[ each_unit ].mean( axis=0 ) )
+                if floor != -1 and 1 <= area.floor_rooms[ floor ] <= len( room_dl_names ):
+                    unit_rooms[ each_unit ] = int( area.floor_rooms[ floor ] )
+
+            for each_units, each_adjacent_rooms in zip( case_units, get_adjacent_rooms( room_dl_names ) ):
+                visible_units = np.ones( len( unit_areas ), dtype=bool )
+                visible_units[ list( switched_units ) ] = False
+                visible_units[ each_units ] = True
+                visible_units[ [ each_unit for each_unit, each_room in unit_rooms.items() if each_room not in each_adjacent_rooms ] ] = False
+                room_units.append( visible_units )
+
+        ## Hide the units of every other area with rooms.
+        room = 0
+        for ind, each_area_units in enumerate( room_area_units ):
+            other_units = np.concatenate( [ np.zeros( 0, dtype=np.intp ) ] + [ each_units for other_ind, each_units in enumerate( room_area_units ) if other_ind != ind ] )
+            room_count = len( self.room_areas[ ind ][ 2 ] )
+            for each_room_units in room_units[ room : room + room_count ]:
+                each_room_units[ other_units ] = False
+            room += room_count
+
+        if not room_units:
+            return np.zeros( ( 0, 3, 3 ), dtype=np.float32 ), np.zeros( 0, dtype=np.int32 ), np.zeros( ( 0, len( unit_areas ) ), dtype=bool )
+        return np.concatenate( room_floors ).astype( np.float32 ), np.concatenate( room_floor_rooms ).astype( np.int32 ), np.array( room_units )
+
+
+    def finish( self ):
+        self.place_textures()
+        cull_boxes = self.get_cull_boxes()
+        room_floors, room_floor_rooms, room_units = self.get_rooms( cull_boxes )
+        chunks = []
+        for each_chunk in self.chunks.values():
+            if not each_chunk.parts:
+                continue
+            each_chunk.finish()
+            if len( each_chunk.indices ):
+                chunks.append( each_chunk )
+        baked_level = BakedLevel( self.textures, chunks, cull_boxes=cull_boxes, cull_areas=np.array( self.unit_areas, dtype=np.uint16 ), spatial_index=build_spatial_index( cull_boxes ),
+            cull_ranges=np.array( self.unit_ranges, dtype=np.float32 ).reshape( -1, 2 ), cull_origins=np.array( self.unit_origins, dtype=np.float32 ).reshape( -1, 3 ),
+            room_floors=room_floors, room_floor_rooms=room_floor_rooms, room_units=room_units )
+        self.reset()
+        return baked_level
+
+
+    def bake_intro( self, shaders=False ):
+        self.reset( shaders )
+        logo_dl, copyright_dl = INTRO_DISPLAY_LISTS
+        self.new_cull_unit()
+
+        ## Add logo.
+        for each_gfx_draw_list in self.gfx_display_dict[ logo_dl ]:
+            self.add_drawlist( each_gfx_draw_list, 'LAYER_OPAQUE', util_math.identity_mat() )
+
+        ## Add copyright.
+        for each_gfx_draw_list in self.gfx_display_dict[ copyright_dl ]:
+            if each_gfx_draw_list.name == 'intro_seg7_vertex_0700B420':
+                self.add_drawlist( each_gfx_draw_list, 'LAYER_OPAQUE', util_math.identity_mat() )
+
+        return self.finish()
+
+
+    def bake_level( self, level, shaders=False ):
+        """Bakes every area of a level, or the intro if level is INTRO.  If shaders is True, textured draw lists are baked for the atlas shader, except those that use G_TEXTURE_GEN, which the shader doesn't do."""
+        if level == INTRO:
+            return self.bake_intro( shaders )
+        self.reset( shaders )
+        level_to_load = self.level_scripts[ level ]
+        for area_index, area in enumerate( level_to_load.areas ):
+            current_area_offset = area.offset
+            self.current_area = area_index
+
+            ## First load strictly area geo.  Note that this excludes objects and special objects that may be part of the level geometry.  Each of its display lists is culled on its own.
+            dl_units = {}
+            room_dl_names = []
+            for geo_to_load in area.geo:
+                root_area_geo = level_to_load.geo_dict[ geo_to_load ]
+                self.process_geo( root_area_geo, current_area_offset, unit_per_dl=True, dl_units=dl_units )
+                room_dl_names += root_area_geo.room_dl_names
+            if area.floors is not None and room_dl_names:
+                self.room_areas.append( ( area_index, area, room_dl_names, dl_units ) )
+
+            ## Next, load any objects with acts.
+            for each_obj in area.objs_with_acts:
+                self.load_object( each_obj, level_to_load, current_area_offset )
+
+            ## Next, load any objects.
+            for each_obj in area.objs:
+                self.load_object( each_obj, level_to_load, current_area_offset )
+
+            ## Next, load any special objects.
+            for each_special_obj in area.special_objs:
+                self.load_object( each_special_obj, level_to_load, current_area_offset )
+
+            ## Next, load any macro objects.
+            for each_macro_obj in area.macro_objs:
+                self.load_object( each_macro_obj, level_to_load, current_area_offset )
+
+            ## Next, load any movtex objects.
+            for each_movtex_obj in area.movtex:
+                if isinstance( each_movtex_obj, WaterBox ):
+                    self.add_waterbox( each_movtex_obj, current_area_offset )
+
+                elif isinstance( each_movtex_obj, Movtex_Tri ):
+                    self.add_movtex_tri( each_movtex_obj, current_area_offset )
+
+            ## Load any paintings.
+            for each_painting in area.paintings:
+                self.add_painting( each_painting, current_area_offset )
+
+        return self.finish()
+
+
+    def load_object( self, obj, level_to_load, current_area_offset ):
+        if 'LEVEL_GEOMETRY' in obj.model or 'special_level_geo' in obj.model:
+            if obj.type == 'SPECIAL_OBJECT':
+                try:
+                    geo_name = level_to_load.level_geo[ self.special_dict[ obj.model ] ]
+                    geo_to_load = level_to_load.geo_dict[ geo_name ]
+                except:
+                    geo_name = self.obj_name_to_geo_dict[ obj.model ]
+                    geo_to_load = self.geo_dict[ geo_name ]
+            else:
+                geo_name = level_to_load.level_geo[ obj.model ]
+                geo_to_load = level_to_load.geo_dict[ geo_name ]
+            self.process_geo( geo_to_load, current_area_offset, obj_position=obj.position, obj_rotation=obj.angle )
+        else:
+            try:
+                geo_name = self.obj_name_to_geo_dict[ obj.model ]
+                extra_scale = get_extra_scale( obj.model, obj.beh, obj.behParam, geo_name ) or 1.0
+                geo_to_load = self.geo_dict[ geo_name ]
+                self.process_geo( geo_to_load, current_area_offset, obj_position=obj.position, obj_rotation=obj.angle, obj_scale=extra_scale )
+            except:
+                pass
+
+
+    def get_object_matrix( self, area_offset, obj_position, obj_rotation, obj_scale ):
+        """Returns the part of an object's transformation that is shared by all of its display lists: scale, rotate around y, x, then z, and translate to the object's position in the area."""
+        translate_mat = util_math.translate_mat( area_offset[ 0 ] + obj_position[ 0 ], area_offset[ 1 ] + obj_position[ 1 ], area_offset[ 2 ] + obj_position[ 2 ] )
+        obj_scale_mat = util_math.scale_mat( obj_scale )
+        obj_rot_x = util_math.rotate_around_x( obj_rotation[ 0 ] )
+        obj_rot_y = util_math.rotate_around_y( obj_rotation[ 1 ] )
+        obj_rot_z = util_math.rotate_around_z( obj_rotation[ 2 ] )
+        return obj_scale_mat @ obj_rot_y @ obj_rot_x @ obj_rot_z @ translate_mat
+
+
+    def process_geo( self, geo, area_offset, obj_position=[ 0, 0, 0 ], obj_rotation=[ 0, 0, 0 ], obj_scale=1.0, unit_per_dl=False, dl_units=None ):
+        """Adds every display list of a geo as one cull unit for each render range in it, or as one cull unit per display list if unit_per_dl is True.  Render ranges are measured from the object's position.  If a dl_units dict is given, the unit of each display list is put in it by name."""
+        #shadows = geo.shadows
+        geo_dls = geo.geo_dls
+        if not geo_dls:
+            return
+
+        ## The object matrix is the same for every display list, so each display list's full transformation is its geo transformation times the object matrix, all done in one stacked multiply.
+        object_mat = self.get_object_matrix( area_offset, obj_position, obj_rotation, obj_scale )
+        transformation_mats = np.array( [ each_geo_dl.transformation for each_geo_dl in geo_dls ] ) @ object_mat
+
+        ## Values in gfx_draw_dict are GfxDrawLists, which have attributes render_settings, positions, triangles, texel_coordinates, and colors.
+        draw_lists = []
+        owners = []
+        for ind, each_geo_dl in enumerate( geo_dls ):
+            for each_gfx_draw_list in self.gfx_display_dict[ each_geo_dl.dl_name ]:
+                draw_lists.append( each_gfx_draw_list )
+                owners.append( ind )
+        if not draw_lists:
+            return
+
+        ## Transform the vertices of all of a display list's draw lists with one multiply by its transformation.  Only lit chunks use normals, so add_drawlist works those out for the draw lists that need them.
+        counts = [ len( each_gfx_draw_list.positions ) for each_gfx_draw_list in draw_lists ]
+        ends = np.cumsum( counts )
+        owner_firsts = np.flatnonzero( np.diff( owners, prepend=-1 ) )
+        positions = util_math.positions_to_mat( np.concatenate( [ each_gfx_draw_list.positions for each_gfx_draw_list in draw_lists ] ) )
+        owner_positions = np.split( positions, ends[ owner_firsts[ 1 : ] - 1 ] )
+        world_positions = np.concatenate( [ each_positions @ transformation_mats[ owners[ each_first ] ] for each_first, each_positions in zip( owner_firsts, owner_positions ) ] )
+
+        units = {}
+        for each_gfx_draw_list, ind, end, count in zip( draw_lists, owners, ends, counts ):
+            unit_key = ind if unit_per_dl else geo_dls[ ind ].render_range
+            if unit_key not in units:
+                self.new_cull_unit( geo_dls[ ind ].render_range, object_mat[ 3, : 3 ] )
+                units[ unit_key ] = self.cull_unit
+            self.cull_unit = units[ unit_key ]
+            if dl_units is not None:
+                dl_units[ geo_dls[ ind ].dl_name ] = self.cull_unit
+            self.add_drawlist( each_gfx_draw_list, geo_dls[ ind ].layer, transformation_mats[ ind ], world_positions[ end - count : end ] )
+
+
+    def get_texture_size( self, texture_filename, s_setting, t_setting ):
+        """Returns the size of a texture, and records it as used by this level.  The overflow settings of the first use are kept."""
+        if texture_filename not in self.textures:
+            if texture_filename not in self.texture_sizes:
+                self.texture_sizes[ texture_filename ] = read_png_size( texture_filename )
+            width, height = self.texture_sizes[ texture_filename ]
+            self.textures[ texture_filename ] = ( width, height, s_setting, t_setting )
+            self.texture_ids[ texture_filename ] = len( self.texture_ids )
+        return self.textures[ texture_filename ][ : 2 ]
+
+
+    def get_chunk( self, layer, texture, atlas, render_settings, shaded=False ):
+        key = ( layer, texture, atlas, shaded, get_group_key( render_settings ) )
+        chunk = self.chunks.get( key )
+        if chunk is None:
+            chunk = BakedChunk( layer, texture, atlas, render_settings, shaded )
+            self.chunks[ key ] = chunk
+        return chunk
+
+
+    def add_drawlist( self, gfx_draw_list, current_layer, transformation_matrix, world_positions=None, world_normals=None ):
+        """Adds a draw list to the chunk for its group.  world_positions and world_normals are the draw list's positions and normals already multiplied by transformation_matrix, as ( -1, 4 ) arrays.  If they aren't given, they're computed here."""
+        render_settings = gfx_draw_list.render_settings
+        current_texture_enable = render_settings.texture_enable and render_settings.current_texture
+        texture_filename = None
+        use_atlas = False
+        shaded = False
+
+        ## S10.5 texel coordinates, offset by half a texel.  Column 0 is s and column 1 is t.
+        current_texels = gfx_draw_list.texel_coordinates / 32.0 + 0.5
+
+        if current_texture_enable:
+            texture_filename = self.texture_dict.get( render_settings.current_texture )
+            if texture_filename is None:
+                raise ValueError( "texture_dict missing texture!!!" )
+            s_scale, t_scale = self.get_texture_size( texture_filename, render_settings.texture_settings[ 9 ], render_settings.texture_settings[ 6 ] )
+
+            ## Convert N64 texel (ST-)coordinates to OpenGL (UV-) coordinates.
+            texture_render_s_scale = render_settings.texture_render_settings[ 0 ] / 65535
+            texture_render_t_scale = render_settings.texture_render_settings[ 1 ] / 65535
+            current_texels[ :, 0 ] *= texture_render_s_scale / s_scale
+            current_texels[ :, 1 ] = 1 - current_texels[ :, 1 ] * ( texture_render_t_scale / t_scale )
+
+            if self.shaders and not render_settings.geometry_mode.get( 'G_TEXTURE_GEN' ):
+                ## The atlas shader does the overflow behaviour itself, so every texture can share the atlas.  Tile shifts scale the N64 coordinates, which start from the top of the texture.
+                texture_settings = render_settings.texture_settings
+                current_texels[ :, 0 ] *= get_shift_scale( get_tile_int( texture_settings[ 11 ] ) )
+                current_texels[ :, 1 ] = 1 - ( 1 - current_texels[ :, 1 ] ) * get_shift_scale( get_tile_int( texture_settings[ 8 ] ) )
+                tile_settings = ( get_wrap_mode( texture_settings[ 9 ] ), get_wrap_mode( texture_settings[ 6 ] ), get_mask_period( get_tile_int( texture_settings[ 10 ] ), s_scale ), get_mask_period( get_tile_int( texture_settings[ 7 ] ), t_scale ) )
+                self.shaded_textures.add( texture_filename )
+                shaded = True
+                use_atlas = True
+
+            else:
+                ## If all texel coordinates are between 0 and 1, the texture doesn't overflow, so the texture_atlas version of the image can be used.
+                use_atlas = bool( ( ( current_texels >= 0 ) & ( current_texels <= 1 ) ).all() ) and not render_settings.geometry_mode.get( 'G_TEXTURE_GEN' )
+
+        if world_positions is None:
+            world_positions = util_math.positions_to_mat( gfx_draw_list.positions ) @ transformation_matrix
+
+        if shaded:
+            chunk = self.get_chunk( get_layer_index( current_layer ), None, True, render_settings, shaded=True )
+            shaded_part = ( self.texture_ids[ texture_filename ], tile_settings )
+        else:
+            chunk = self.get_chunk( get_layer_index( current_layer ), texture_filename, use_atlas, render_settings )
+            shaded_part = ( None, None )
+
+        if chunk.lit:
+            if world_normals is None:
+                world_normals = util_math.normalize( util_math.normals_to_mat( util_math.convert_twos_comp_array( gfx_draw_list.colors[ :, : 3 ] ) ) @ transformation_matrix )
+            chunk.add_part( world_positions[ :, : 3 ], current_texels, world_normals[ :, : 3 ], gfx_draw_list.triangles, *shaded_part, cull_unit=self.cull_unit )
+
+        else:
+            current_colours = gfx_draw_list.colors
+            if render_settings.env_colour is not None:
+                ## Then we need to change the current_colours alphas to the alpha in env_colour.  The draw list's colours are shared, so change a copy.
+                current_colours = current_colours.copy()
+                current_colours[ :, 3 ] = render_settings.env_colour[ 3 ]
+            chunk.add_part( world_positions[ :, : 3 ], current_texels, current_colours, gfx_draw_list.triangles, *shaded_part, cull_unit=self.cull_unit )
+
+
+    def add_painting( self, painting, area_offset ):
+        ## Painting_scale is a value that is hard coded into the game.  A painting is scaled by painting.size / painting_scale.
+        painting_scale = 614.0
+        translate_matrix = util_math.translate_mat( painting.posx + area_offset[ 0 ], painting.posy + area_offset[ 1 ], painting.posz + area_offset[ 2 ] )
+        scale_matrix = util_math.scale_mat( painting.size / painting_scale )
+        rot_x_matrix = util_math.rotate_around_x( painting.pitch )
+        rot_y_matrix = util_math.rotate_around_y( painting.yaw )
+        transformation_matrix = scale_matrix @ rot_y_matrix @ rot_x_matrix @ translate_matrix
+
+        self.new_cull_unit()
+        for each_gfx_draw_list in self.gfx_display_dict[ painting.normal_dl ]:
+            self.add_drawlist( each_gfx_draw_list, painting.layer, transformation_matrix )
+
+
+    def add_waterbox( self, waterbox, area_offset ):
+        texture_filename = self.texture_dict.get( waterbox.texture )
+        if texture_filename is None:
+            return
+        s_scale, t_scale = self.get_texture_size( texture_filename, WATERBOX_WRAP, WATERBOX_WRAP )
+
+        positions = np.array( [ getattr( waterbox, 'vert' + str( 1 + i ) ) for i in range( 4 ) ], dtype=np.float64 ) + np.asarray( area_offset )
+
+        if waterbox.rotation_direction == 0:
+            rot_offset = [ 0, 16384, -32768, -16384 ]
+        elif waterbox.rotation_direction == 1:
+            rot_offset = [ 0, -16384, -32768, 16384 ]
+        angles = np.array( rot_offset ) * math.pi / 32768
+        radius = 32 * waterbox.scale - 1.0
+
+        current_texels = np.empty( ( 4, 2 ) )
+        current_texels[ :, 0 ] = radius * np.sin( angles ) / s_scale
+        current_texels[ :, 1 ] = 1 - radius * np.cos( angles ) / t_scale
+        current_colours = np.array( [ waterbox.colour ] * 4 )
+
+        self.new_cull_unit()
+        if self.shaders:
+            self.shaded_textures.add( texture_filename )
+            chunk = self.get_chunk( LAYER_DICT[ 'LAYER_TRANSPARENT_INTER' ], None, True, None, shaded=True )
+            chunk.add_part( positions, current_texels, current_colours, [ 0, 1, 2, 0, 2, 3 ], self.texture_ids[ texture_filename ], ( get_wrap_mode( WATERBOX_WRAP ), get_wrap_mode( WATERBOX_WRAP ), 1.0, 1.0 ), cull_unit=self.cull_unit )
+        else:
+            chunk = self.get_chunk( LAYER_DICT[ 'LAYER_TRANSPARENT_INTER' ], texture_filename, False, None )
+            chunk.add_part( positions, current_texels, current_colours, [ 0, 1, 2, 0, 2, 3 ], cull_unit=self.cull_unit )
+
+
+    def add_movtex_tri( self, each_movtex_obj, current_area_offset ):
+        transformation_matrix = util_math.translate_mat( current_area_offset[ 0 ], current_area_offset[ 1 ], current_area_offset[ 2 ] )
+        self.new_cull_unit()
+        self.add_drawlist( each_movtex_obj.drawlist, each_movtex_obj.layer, transformation_matrix )
+
+
+
+##################
+### BAKED FILE ###
+##################
+
+## A baked file is BAKE_MAGIC, the length of the header as a little endian uint64, the pickled header, and then the raw chunk arrays, each aligned to BAKE_ALIGNMENT bytes.  The header has everything but the arrays, plus the offset, dtype, and shape of each array, so the arrays can be read straight out of a memory map.
+
+def align( offset ):
+    return ( offset + BAKE_ALIGNMENT - 1 ) // BAKE_ALIGNMENT * BAKE_ALIGNMENT
+
+
+def save_baked_level( baked_level, path ):
+    arrays = []
+    chunk_headers = []
+    offset = 0
+    for each_chunk in baked_level.chunks:
+        array_headers = {}
+        for each_name in CHUNK_ARRAYS:
+            array = getattr( each_chunk, each_name )
+            if array is None:
+                continue
+            array = np.ascontiguousarray( array )
+            offset = align( offset )
+            array_headers[ each_name ] = ( offset, array.dtype.str, array.shape )
+            arrays.append( ( offset, array ) )
+            offset += array.nbytes
+        chunk_headers.append( { 'layer' : each_chunk.layer, 'texture' : each_chunk.texture, 'atlas' : each_chunk.atlas, 'shaded' : each_chunk.shaded, 'render_settings' : each_chunk.render_settings, 'arrays' : array_headers } )
+
+    header = pickle.dumps( { 'version' : BAKE_VERSION, 'fingerprint' : baked_level.fingerprint, 'textures' : baked_level.textures, 'cull_boxes' : baked_level.cull_boxes, 'cull_areas' : baked_level.cull_areas, 'cull_ranges' : baked_level.cull_ranges, 'cull_origins' : baked_level.cull_origins,
+        'room_floors' : baked_level.room_floors, 'room_floor_rooms' : baked_level.room_floor_rooms, 'room_units' : baked_level.room_units,
+        'spatial_index' : { each_name : getattr( baked_level.spatial_index, each_name ) for each_name in SPATIAL_INDEX_ARRAYS }, 'chunks' : chunk_headers }, pickle.HIGHEST_PROTOCOL )
+    data_start = align( len( BAKE_MAGIC ) + 8 + len( header ) )
+
+    path = Path( path )
+    temp_path = path.with_suffix( '.tmp' )
+    with open( temp_path, 'wb' ) as f:
+        f.write( BAKE_MAGIC + struct.pack( '<Q', len( header ) ) + header )
+        for array_offset, array in arrays:
+            f.seek( data_start + array_offset )
+            f.write( array.tobytes() )
+    os.replace( temp_path, path )
+
+
+def load_baked_level( path, fingerprint ):
+    """Maps a baked level into memory.  Returns None if there's no baked file, or if it was baked by a different version or from a different game data store.  The arrays of the returned chunks are read only views of the file."""
+    try:
+        with open( path, 'rb' ) as f:
+            if f.read( len( BAKE_MAGIC ) ) != BAKE_MAGIC:
+                return None
+            header_length, = struct.unpack( '<Q', f.read( 8 ) )
+            header = pickle.loads( f.read( header_length ) )
+    except:
+        return None
+
+    if header[ 'version' ] != BAKE_VERSION or header[ 'fingerprint' ] != fingerprint:
+        return None
+
+    data_start = align( len( BAKE_MAGIC ) + 8 + header_length )
+    data = np.memmap( path, dtype=np.uint8, mode='r' )
+    chunks = []
+    for each_header in header[ 'chunks' ]:
+        chunk = BakedChunk( each_header[ 'layer' ], each_header[ 'texture' ], each_header[ 'atlas' ], each_header[ 'render_settings' ], each_header[ 'shaded' ] )
+        for each_name, ( offset, dtype, shape ) in each_header[ 'arrays' ].items():
+            dtype = np.dtype( dtype )
+            start = data_start + offset
+            setattr( chunk, each_name, data[ start : start + dtype.itemsize * int( np.prod( shape ) ) ].view( dtype ).reshape( shape ) )
+        chunks.append( chunk )
+
+    spatial_index = SpatialIndex( header[ 'cull_boxes' ], **header[ 'spatial_index' ] )
+    return BakedLevel( header[ 'textures' ], chunks, fingerprint, header[ 'cull_boxes' ], header[ 'cull_areas' ], spatial_index, header[ 'cull_ranges' ], header[ 'cull_origins' ], header[ 'room_floors' ], header[ 'room_floor_rooms' ], header[ 'room_units' ] )
+
+
+
+############
+### MAIN ###
+############
+
+
+def make_baker( game_data, level ):
+    """Makes a LevelBaker that can bake level ( or INTRO ) from a GameData, loading only the sections level needs."""
+    return LevelBaker( *game_data.get_game_dicts( level ) )
+
+
+def main( mario_source_dir, baked_dir ):
+    """Setup stage.  Bakes the intro and every level in the game data store into baked_dir so the game can map them instead of building them when a level is loaded."""
+    os.makedirs( baked_dir, exist_ok=True )
+    game_data = GameData( Path( baked_dir ).parent / 'pickles' / GAME_DATA_FILENAME )
+    fingerprint = game_data.fingerprint
+
+    levels = [ INTRO ] + list( game_data.start_positions )
+    for each_level in levels:
+        try:
+            baked_level = make_baker( game_data, each_level ).bake_level( each_level )
+        except Exception as e:
+            print( "Couldn't bake", each_level + ":", e )
+            continue
+        baked_level.fingerprint = fingerprint
+        save_baked_level( baked_level, Path( baked_dir ) / get_baked_filename( each_level ) )
+
+    print( "Baked", len( levels ) - 1, "levels and the intro." )
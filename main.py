@@ -14,12 +14,20 @@ if __name__ == '__main__':
     parser.add_argument( '-res', '--resolution', nargs=2, type=int, metavar=( 'x', 'y' ), default=[1280, 720], help='resolution of the game window (default: 1280x720)' )
     parser.add_argument( '-msaa', type=int, metavar='samples', help='number of MSAA samples per pixel (default: 1)', default=1 )
     parser.add_argument( '-yinv', '--invert_y', action='store_true', help='invert the y-axis on the mouse' )
+    parser.add_argument( '-shaders', action='store_true', help='draw textures from a single atlas with a shader that does N64 wrap/clamp/mirror (requires GLSL 1.20)' )
+    parser.add_argument( '-nocull', action='store_true', help='draw the whole level every frame, rather than only the parts in view' )
+    parser.add_argument( '-lodbias', type=float, metavar='bias', default=1.0, help='multiplies camera distances before choosing level of detail, so larger values draw less far away (default: 1.0)' )
+    parser.add_argument( '-occlusion', action='store_true', help='also skip the parts of the level hidden behind the rest of it, using GL occlusion queries (can be toggled in the options menu)' )
     args = parser.parse_args()
 
     fullscreen = args.fullscreen
     resolution = args.resolution
     msaa = args.msaa
     yinv = args.invert_y
+    use_shaders = args.shaders
+    cull = not args.nocull
+    lod_bias = args.lodbias
+    occlusion = args.occlusion
 
     mario_graphics_dir = Path( os.path.realpath( __file__ ) ).parent
 
@@ -29,7 +37,7 @@ if __name__ == '__main__':
     pyglet.font.add_file( font_path )
 
 
-    game_window = GameWindow( mario_graphics_dir, fullscreen=fullscreen, resolution=resolution, y_inv=yinv, vsync=False, msaa=msaa, resizable=True, show_fps=False, font=font_name )
+    game_window = GameWindow( mario_graphics_dir, fullscreen=fullscreen, resolution=resolution, y_inv=yinv, vsync=False, msaa=msaa, resizable=True, show_fps=False, font=font_name, use_shaders=use_shaders, cull=cull, lod_bias=lod_bias, occlusion=occlusion )
 
     ## Main game loop
     pyglet.app.run()
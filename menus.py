@@ -390,8 +390,11 @@ class OptionsMenu( Menu ):
         ## Back button
         self.back_button = Button( self.window_width, self.window_height, center_x=1/8, center_y=6/7, width=1/9, height=1/6, text='Back', font=self.font, font_size=self.font_size, batch=self.batch, foreground_group=self.foreground_group, background_group=self.background_group )
 
+        ## Occlusion culling button, across from the back button.
+        self.occlusion_button = Button( self.window_width, self.window_height, center_x=7/8, center_y=6/7, width=1/6, height=1/6, text='Toggle\nOcclusion', font=self.font, font_size=self.font_size, batch=self.batch, foreground_group=self.foreground_group, background_group=self.background_group, multiline=True )
+
         ## Button list ( also includes Sliders )
-        self.buttons = [ self.wireframe_button, self.textures_button, self.skybox_button, self.fps_button, self.fov_slider, self.mouse_sensitivity_slider, self.back_button ]
+        self.buttons = [ self.wireframe_button, self.textures_button, self.skybox_button, self.fps_button, self.fov_slider, self.mouse_sensitivity_slider, self.back_button, self.occlusion_button ]
 
 
     ## Redefine check_click from Menu class in order to deal with sliders.
@@ -427,6 +430,10 @@ class OptionsMenu( Menu ):
                 if self.clicked_button == self.fps_button:
                     self.dispatch_event( 'toggle_fps' )
 
+                ## Toggle occlusion culling button.
+                if self.clicked_button == self.occlusion_button:
+                    self.dispatch_event( 'toggle_occlusion' )
+
                 ## Back to the previous menu button.
                 if self.clicked_button == self.back_button:
                     self.dispatch_event( 'go_back' )
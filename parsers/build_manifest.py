@@ -0,0 +1,153 @@
+from pathlib import Path
+import ast
+import hashlib
+import json
+import os
+
+from .source_index import glob_to_regex, get_index
+
+
+def hash_bytes_of_file( path ):
+    h = hashlib.sha1()
+    with open( path, 'rb' ) as f:
+        for chunk in iter( lambda: f.read( 1 << 20 ), b'' ):
+            h.update( chunk )
+    return h.hexdigest()
+
+
+def get_local_imports( module_path, repo_dir ):
+    """Returns the paths of the modules inside repo_dir that module_path imports, either relatively ( from .model_parser import ... ) or from the top level of the repo ( from util_math import ... )."""
+    with open( module_path, 'r' ) as f:
+        tree = ast.parse( f.read() )
+
+    names = []
+    for node in ast.walk( tree ):
+        if isinstance( node, ast.ImportFrom ):
+            if node.level > 0:
+                names.append( ( module_path.parent, node.module ) )
+            else:
+                names.append( ( repo_dir, node.module ) )
+        elif isinstance( node, ast.Import ):
+            for each_alias in node.names:
+                names.append( ( repo_dir, each_alias.name ) )
+
+    paths = []
+    for base_dir, name in names:
+        if name is None:
+            continue
+        candidate = base_dir.joinpath( *name.split( '.' ) ).with_suffix( '.py' )
+        if candidate.is_file():
+            paths.append( candidate )
+
+    return paths
+
+
+
+class BuildManifest():
+    """Remembers what every setup stage consumed and produced the last time it ran, so that setup can skip stages whose sources, code, and input pickles haven't changed.
+
+    Files are fingerprinted by sha1.  The hash of a file is only recomputed when its size or mtime changes, so an unchanged tree costs one stat per file.  The list of source files comes from the SourceIndex, so no extra walk of the tree is needed."""
+
+    version = 1
+
+    def __init__( self, path ):
+        self.path = Path( path )
+        self.files = {}
+        self.stages = {}
+
+        try:
+            with open( self.path, 'r' ) as f:
+                data = json.load( f )
+            if data[ 'version' ] == self.version:
+                self.files = data[ 'files' ]
+                self.stages = data[ 'stages' ]
+        except:
+            pass
+
+
+    def save( self ):
+        temp_path = self.path.with_suffix( '.tmp' )
+        with open( temp_path, 'w' ) as f:
+            json.dump( { 'version' : self.version, 'files' : self.files, 'stages' : self.stages }, f, indent=1, sort_keys=True )
+        os.replace( temp_path, self.path )
+
+
+    def hash_file( self, path, size_and_mtime=None ):
+        key = str( path )
+        if size_and_mtime is None:
+            stat = os.stat( path )
+            size_and_mtime = ( stat.st_size, stat.st_mtime_ns )
+        cached = self.files.get( key )
+        if cached is not None and cached[ 0 ] == size_and_mtime[ 0 ] and cached[ 1 ] == size_and_mtime[ 1 ]:
+            return cached[ 2 ]
+
+        digest = hash_bytes_of_file( path )
+        self.files[ key ] = [ size_and_mtime[ 0 ], size_and_mtime[ 1 ], digest ]
+        return digest
+
+
+    def hash_path( self, path ):
+        """Hashes a file, or every file under a directory.  Returns None if nothing is there."""
+        path = Path( path )
+        if path.is_file():
+            return self.hash_file( path )
+        elif path.is_dir():
+            h = hashlib.sha1()
+            for each_path in sorted( i for i in path.rglob( '*' ) if i.is_file() ):
+                h.update( each_path.relative_to( path ).as_posix().encode() + b'\0' + self.hash_file( each_path ).encode() + b'\n' )
+            return h.hexdigest()
+        return None
+
+
+    def hash_sources( self, mario_source_dir, patterns ):
+        """Hashes the names and contents of every source file matching any of the glob patterns.  Adding, removing, or editing a matching file changes the hash."""
+        regexes = [ glob_to_regex( each_pattern ) for each_pattern in patterns ]
+        index = get_index( mario_source_dir )
+        h = hashlib.sha1()
+        for each_rel_path in index.paths:
+            if any( each_regex.match( each_rel_path ) for each_regex in regexes ):
+                h.update( each_rel_path.encode() + b'\0' + self.hash_file( mario_source_dir / each_rel_path, index.files[ each_rel_path ] ).encode() + b'\n' )
+        return h.hexdigest()
+
+
+    def hash_code( self, module_name, repo_dir ):
+        """Hashes the stage's module along with every module in the repo it imports, directly or indirectly."""
+        to_visit = [ repo_dir.joinpath( *module_name.split( '.' ) ).with_suffix( '.py' ) ]
+        seen = set()
+        while to_visit:
+            each_path = to_visit.pop()
+            if each_path in seen:
+                continue
+            seen.add( each_path )
+            to_visit += get_local_imports( each_path, repo_dir )
+
+        h = hashlib.sha1()
+        for each_path in sorted( seen ):
+            h.update( each_path.relative_to( repo_dir ).as_posix().encode() + b'\0' + self.hash_file( each_path ).encode() + b'\n' )
+        return h.hexdigest()
+
+
+    def make_record( self, stage, mario_source_dir, mario_graphics_dir ):
+        """Fingerprints everything a stage consumes.  The stage is up to date if this matches the record saved when it last ran."""
+        return { 'source_dir' : str( Path( mario_source_dir ).resolve() ),
+            'sources' : self.hash_sources( mario_source_dir, stage.sources ),
+            'code' : self.hash_code( stage.module_name, mario_graphics_dir ),
+            'inputs' : { each_input : self.hash_path( mario_graphics_dir / each_input ) for each_input in stage.inputs } }
+
+
+    def is_up_to_date( self, stage, record, mario_graphics_dir ):
+        previous = self.stages.get( stage.name )
+        if previous is None or previous[ 'record' ] != record:
+            return False
+
+        ## The outputs have to still be what this stage wrote last time.
+        for each_output in stage.outputs:
+            if self.hash_path( mario_graphics_dir / each_output ) != previous[ 'outputs' ].get( each_output ):
+                return False
+
+        return True
+
+
+    def update( self, stage, record, mario_graphics_dir ):
+        outputs = { each_output : self.hash_path( mario_graphics_dir / each_output ) for each_output in stage.outputs }
+        self.stages[ stage.name ] = { 'record' : record, 'outputs' : outputs }
@@ -3,6 +3,8 @@ import pickle
 import numpy as np
 
 from .level_script_parser import process_line
+from .source_index import get_index
+from .macro_lexer import tokenize_macros
 from util_math import identity_mat, scale_mat, translate_mat, rotate_around_x, rotate_around_y, rotate_around_z
 
 
@@ -149,32 +151,28 @@ class Geo():
         node_stack = [ parent_node or GeoNode() ]
         current_node = node_stack[ -1 ].copy()
         current_joint = 0
+        ## Depth in node_stack -> joint the first render range at that depth started from.
+        range_joints = {}
         switch_seen = 0
         switch_max = 0
         code = geo_source_dict[ name ]
         #print( code )
-        geo_lines = [ i.strip() for i in code.split( '\n' ) ]
-        for each_line in geo_lines:
+        for opcode, args in tokenize_macros( code ):
 
-            if 'GEO_DISPLAY_LIST' in each_line:
+            if opcode == 'GEO_DISPLAY_LIST':
                 ## Use node_stack[ -1 ] or current_node??  In almost every case, they should be the same.
                 if switch_max == 0 or ( switch_max > 0 and switch_seen == 0 ):
-                    layer, dl_name = process_line( each_line )
+                    layer, dl_name = args
 
                     if dl_name != 'NULL':
-                        if node_stack[ -1 ].render_range == True:
-                            if node_stack[ -1 ].render_range_near == True:
-                                dl_list.append( GeoDisplayList( layer, dl_name, node_stack[ -1 ].transformation.copy(), node_stack[ -1 ].zbuffer, node_stack[ -1 ].billboard ) )
-
+                        if node_stack[ -1 ].billboard == True:
+                            ## Billboarded display lists are not scaled, so multiply the transformation matrix by a scale matrix of 1/scale to unscale.
+                            if node_stack[ -1 ].scale != 0:
+                                temp_transformation = scale_mat( 1 / node_stack[ -1 ].scale ) @ node_stack[ -1 ].transformation.copy()
+                            else: temp_transformation = node_stack[ -1 ].transformation.copy()
+                            dl_list.append( GeoDisplayList( layer, dl_name, temp_transformation, node_stack[ -1 ].zbuffer, node_stack[ -1 ].billboard, node_stack[ -1 ].render_range ) )
                         else:
-                            if node_stack[ -1 ].billboard == True:
-                                ## Billboarded display lists are not scaled, so multiply the transformation matrix by a scale matrix of 1/scale to unscale.
-                                if node_stack[ -1 ].scale != 0:
-                                    temp_transformation = scale_mat( 1 / node_stack[ -1 ].scale ) @ node_stack[ -1 ].transformation.copy()
-                                else: temp_transformation = node_stack[ -1 ].transformation.copy()
-                                dl_list.append( GeoDisplayList( layer, dl_name, temp_transformation, node_stack[ -1 ].zbuffer, node_stack[ -1 ].billboard ) )
-                            else:
-                                dl_list.append( GeoDisplayList( layer, dl_name, node_stack[ -1 ].transformation, node_stack[ -1 ].zbuffer, node_stack[ -1 ].billboard ) )
+                            dl_list.append( GeoDisplayList( layer, dl_name, node_stack[ -1 ].transformation, node_stack[ -1 ].zbuffer, node_stack[ -1 ].billboard, node_stack[ -1 ].render_range ) )
 
                 if switch_max > 0:
                     switch_seen += 1
@@ -184,27 +182,16 @@ class Geo():
                     switch_seen = 0
 
 
-            elif 'GEO_ANIMATED_PART' in each_line:
-                layer, tx, ty, tz, dl_name = process_line( each_line )
+            elif opcode == 'GEO_ANIMATED_PART':
+                layer, tx, ty, tz, dl_name = args
 
                 if switch_max == 0 or ( switch_max > 0 and switch_seen == 0 ):
-                    if current_node.render_range == True:
-                        if current_node.render_range_near == True:
-                            animated_transition_mat = animation.calculate_transition_mat( tx, ty, tz, current_joint )
-                            current_node = node_stack[ -1 ].copy()
-                            current_node.transformation = animated_transition_mat @ current_node.transformation
-                            current_joint += 1
-                            
-                            if dl_name != 'NULL':
-                                dl_list.append( GeoDisplayList( layer, dl_name, current_node.transformation, current_node.zbuffer, current_node.billboard ) )
-
-                    else:
-                        animated_transition_mat = animation.calculate_transition_mat( tx, ty, tz, current_joint )
-                        current_node = node_stack[ -1 ].copy()
-                        current_node.transformation = animated_transition_mat @ current_node.transformation
-                        current_joint += 1
-                        if dl_name != 'NULL':
-                            dl_list.append( GeoDisplayList( layer, dl_name, current_node.transformation, current_node.zbuffer, current_node.billboard ) )
+                    animated_transition_mat = animation.calculate_transition_mat( tx, ty, tz, current_joint )
+                    current_node = node_stack[ -1 ].copy()
+                    current_node.transformation = animated_transition_mat @ current_node.transformation
+                    current_joint += 1
+                    if dl_name != 'NULL':
+                        dl_list.append( GeoDisplayList( layer, dl_name, current_node.transformation, current_node.zbuffer, current_node.billboard, current_node.render_range ) )
 
                 if switch_max > 0:
                     switch_seen += 1
@@ -214,14 +201,17 @@ class Geo():
                     switch_seen = 0
 
 
-            elif 'GEO_OPEN_NODE' in each_line:
+            elif opcode == 'GEO_OPEN_NODE':
                 node_stack.append( current_node )
                 current_node = node_stack[ -1 ].copy()
 
-            elif 'GEO_CLOSE_NODE' in each_line:
+            elif opcode == 'GEO_CLOSE_NODE':
                 if self.name != 'bowser_geo':
                     if node_stack:
                         current_node = node_stack.pop()
+                    ## Render ranges in nodes that are now closed can't have any more siblings.
+                    for each_depth in [ each_depth for each_depth in range_joints if each_depth > len( node_stack ) ]:
+                        del range_joints[ each_depth ]
 
                 else:
                     ## Intentionally parse bowser_geo wrong because it somehow fixes his head despite not doing the GEO_ASM function.  Ugly hack...
@@ -230,30 +220,31 @@ class Geo():
                         if node_stack:
                             current_node = node_stack[ -1 ].copy()
 
-            elif 'GEO_ZBUFFER' in each_line:
-                zbuffer = process_line( each_line )
+            elif opcode == 'GEO_ZBUFFER':
+                zbuffer = args[ 0 ]
                 current_node.zbuffer = bool( zbuffer )
 
-            elif 'GEO_RENDER_RANGE' in each_line:
-                near, far = process_line( each_line )
-                current_node.render_range = True
-                if near < 0:
-                    current_node.render_range_near = True
+            elif opcode == 'GEO_RENDER_RANGE':
+                ## Every branch of a level of detail is kept, along with the range of camera distances it's drawn at.  Sibling branches animate the same joints, so each one starts from the joint the first one did.
+                near, far = args
+                current_node.render_range = ( near, far )
+                if len( node_stack ) in range_joints:
+                    current_joint = range_joints[ len( node_stack ) ]
                 else:
-                    current_node.render_range_near = False
+                    range_joints[ len( node_stack ) ] = current_joint
 
-            elif 'GEO_SWITCH_CASE' in each_line:
+            elif opcode == 'GEO_SWITCH_CASE':
                 ## GEO_SWITCH_CASE(count, function)
-                count, function = process_line( each_line )
+                count, function = args
                 if function != 'geo_switch_area':
                     switch_max = count
                     switch_seen = 0
 
-            elif 'GEO_BRANCH' in each_line:
-                if 'GEO_BRANCH_AND_LINK' in each_line:
-                    branch_name = process_line( each_line )
+            elif opcode == 'GEO_BRANCH' or opcode == 'GEO_BRANCH_AND_LINK':
+                if opcode == 'GEO_BRANCH_AND_LINK':
+                    branch_name = args[ 0 ]
                 else:
-                    _, branch_name = process_line( each_line )
+                    _, branch_name = args
 
                 if branch_name != 'NULL':
                     if switch_max == 0:
@@ -268,9 +259,9 @@ class Geo():
                     switch_seen = 0
                     switch_max = 0
 
-            elif 'GEO_TRANSLATE_ROTATE_WITH_DL' in each_line:
+            elif opcode == 'GEO_TRANSLATE_ROTATE_WITH_DL':
                 ## GEO_TRANSLATE_ROTATE_WITH_DL(layer, tx, ty, tz, rx, ry, rz, displayList)
-                layer, tx, ty, tz, rx, ry, rz, dl_name = process_line( each_line )
+                layer, tx, ty, tz, rx, ry, rz, dl_name = args
                 if switch_max == 0 or ( switch_max > 0 and switch_seen == 0 ):
                     translation_matrix = translate_mat( tx, ty, tz )
                     rot_x = rotate_around_x( rx )
@@ -279,12 +270,7 @@ class Geo():
                     rotation_matrix = rot_z @ rot_x @ rot_y
                     current_node.transformation = current_node.transformation @ rotation_matrix @ translation_matrix
                     if dl_name != 'NULL':
-                        if current_node.render_range == True:
-                            if current_node.render_range_near == True:
-                                dl_list.append( GeoDisplayList( layer, dl_name, current_node.transformation, current_node.zbuffer, current_node.billboard ) )
-
-                        else:
-                            dl_list.append( GeoDisplayList( layer, dl_name, current_node.transformation, current_node.zbuffer, current_node.billboard ) )
+                        dl_list.append( GeoDisplayList( layer, dl_name, current_node.transformation, current_node.zbuffer, current_node.billboard, current_node.render_range ) )
 
                 if switch_max > 0:
                     switch_seen += 1
@@ -293,14 +279,14 @@ class Geo():
                     switch_max = 0
                     switch_seen = 0
 
-            elif 'GEO_NODE_START' in each_line:
+            elif opcode == 'GEO_NODE_START':
                 if switch_max > 0:
                     pass
                     #print( self.name )
 
-            elif 'GEO_TRANSLATE_ROTATE' in each_line:
+            elif opcode == 'GEO_TRANSLATE_ROTATE':
                 ## GEO_TRANSLATE_ROTATE(layer, tx, ty, tz, rx, ry, rz)
-                layer, tx, ty, rz, rx, ry, rz = process_line( each_line )
+                layer, tx, ty, tz, rx, ry, rz = args
                 translation_matrix = translate_mat( tx, ty, tz )
                 rot_x = rotate_around_x( rx )
                 rot_y = rotate_around_y( ry )
@@ -308,27 +294,27 @@ class Geo():
                 rotation_matrix = rot_z @ rot_x @ rot_y
                 current_node.transformation = current_node.transformation @ rotation_matrix @ translation_matrix
 
-            elif 'GEO_TRANSLATE_NODE' in each_line:
+            elif opcode == 'GEO_TRANSLATE_NODE':
                 ## GEO_TRANSLATE_NODE(layer, ux, uy, uz)
-                layer, tx, ty, tz = process_line( each_line )
+                layer, tx, ty, tz = args
                 translation_matrix = translate_mat( tx, ty, tz )
                 #current_node.transformation = current_node.transformation @ translation_matrix
                 current_node.transformation = translation_matrix @ current_node.transformation
 
-            elif 'GEO_ROTATION_NODE' in each_line:
+            elif opcode == 'GEO_ROTATION_NODE':
                 ## GEO_ROTATION_NODE(layer, ux, uy, uz)
-                layer, rx, ry, rz = process_line( each_line )
+                layer, rx, ry, rz = args
                 rot_x = rotate_around_x( rx )
                 rot_y = rotate_around_y( ry )
                 rot_z = rotate_around_z( rz )
                 rotation_matrix = rot_z @ rot_x @ rot_y
                 current_node.transformation = current_node.transformation @ rotation_matrix
 
-            elif 'GEO_BILLBOARD' in each_line:
+            elif opcode == 'GEO_BILLBOARD' or opcode == 'GEO_BILLBOARD_WITH_PARAMS' or opcode == 'GEO_BILLBOARD_WITH_PARAMS_AND_DL':
                 current_node.billboard = True
 
-            elif 'GEO_SCALE' in each_line:
-                layer, scale = process_line( each_line )
+            elif opcode == 'GEO_SCALE':
+                layer, scale = args
                 scale = scale / 65536
                 current_node.scale = scale
                 scale_transformation = scale_mat( scale )
@@ -336,13 +322,13 @@ class Geo():
                 #current_node.transformation = current_node.transformation @ scale_transformation
                 current_node.transformation = scale_transformation @ current_node.transformation
 
-            elif 'GEO_ASM' in each_line:
+            elif opcode == 'GEO_ASM':
                 pass
 
-            elif 'GEO_SHADOW' in each_line:
+            elif opcode == 'GEO_SHADOW':
                 pass
 
-            elif 'GEO_HELD_OBJECT' in each_line:
+            elif opcode == 'GEO_HELD_OBJECT':
                 ## This is only used in Mario's animations.
                 pass
 
@@ -357,29 +343,31 @@ class Geo():
 
 
 class GeoNode():
-    def __init__( self, transformation=None, zbuffer=True, billboard=False, render_range=False, render_range_near=None, scale=1.0, switch_state=None ):
+    def __init__( self, transformation=None, zbuffer=True, billboard=False, render_range=None, scale=1.0, switch_state=None ):
         if transformation is not None:
             self.transformation = transformation.copy()
         else:
             self.transformation = identity_mat()
         self.zbuffer = zbuffer
         self.billboard = billboard
+        ## ( near, far ) camera distances from a GEO_RENDER_RANGE, or None.
         self.render_range = render_range
-        self.render_range_near = render_range_near
         self.scale = scale
         self.switch_state = switch_state
 
     def copy( self ):
-        copy_obj = GeoNode( transformation=self.transformation, zbuffer=self.zbuffer, billboard=self.billboard, render_range=self.render_range, render_range_near=self.render_range_near, scale=self.scale, switch_state=self.switch_state )
+        copy_obj = GeoNode( transformation=self.transformation, zbuffer=self.zbuffer, billboard=self.billboard, render_range=self.render_range, scale=self.scale, switch_state=self.switch_state )
         return copy_obj
 
 
 class GeoDisplayList():
-    def __init__( self, layer, dl_name, transformation, zbuffer=True, billboard=False ):
+    def __init__( self, layer, dl_name, transformation, zbuffer=True, billboard=False, render_range=None ):
         ## Transformation matrix contains scale, rotation, and translation information.
         self.transformation = transformation.copy()
         self.zbuffer = zbuffer
         self.billboard = billboard
+        ## ( near, far ) camera distances the display list is drawn between, or None to always draw it.
+        self.render_range = render_range
         self.layer = layer
         self.dl_name = dl_name
 
@@ -491,7 +479,8 @@ def main( mario_source_dir, mario_graphics_dir ):
 
     ## Don't deal with Mario animations since they're stored in a different way.
     mario_actor_path = mario_source_dir / 'actors' / 'mario'
-    geo_filepaths = [ i for i in mario_source_dir.glob( '**/geo.inc.c' ) if i.parent != mario_actor_path ]
+    index = get_index( mario_source_dir, mario_graphics_dir )
+    geo_filepaths = [ i for i in index.glob( '**/geo.inc.c' ) if i.parent != mario_actor_path ]
     
     layer_dict = { 'LAYER_FORCE' : 0, 'LAYER_OPAQUE' : 1, 'LAYER_OPAQUE_DECAL' : 2, 'LAYER_OPAQUE_INTER' : 3, 'LAYER_ALPHA' : 4, 'LAYER_TRANSPARENT' : 5, 'LAYER_TRANSPARENT_DECAL' : 6, 'LAYER_TRANSPARENT_INTER' : 7 }
     
@@ -558,32 +547,25 @@ def main( mario_source_dir, mario_graphics_dir ):
     geo_dict = {}
     geo_source_dict = {}
     
+    geo_layouts = {}
     for each_geo_filepath in geo_filepaths:
-        with open( each_geo_filepath, 'r' ) as f:
-            geo_txt = remove_if_def( f.read() )
-    
         ## Create a dict of geo source code for each struct keyed by struct name.
-        geo_structs = geo_txt.split( ';' )
-        for each_struct in geo_structs:
-            if '=' in each_struct:
-                geo_source_dict[ get_name( each_struct ) ] = each_struct
+        geo_layouts[ each_geo_filepath ] = [ ( name, remove_if_def( each_struct ) ) for kind, name, each_struct in index.get_declarations( each_geo_filepath, 'GeoLayout' ) ]
+        for name, each_struct in geo_layouts[ each_geo_filepath ]:
+            geo_source_dict[ name ] = each_struct
     
     
-    ## Read through the geo files again now that we have a source dict to resolve branching.
+    ## Go through the geo files again now that we have a source dict to resolve branching.
     for each_geo_filepath in geo_filepaths:
-        with open( each_geo_filepath, 'r' ) as f:
-            geo_txt = remove_if_def( f.read() )
-    
         animation_list = []
-        if 'GEO_ANIMATED_PART' in geo_txt:
+        if any( 'GEO_ANIMATED_PART' in each_struct for name, each_struct in geo_layouts[ each_geo_filepath ] ):
             ## Find all local animation files.
             skip_stems = [ 'model.inc', 'collision.inc', 'flames_pos.inc', 'geo.inc', 'data.inc' ]
-            local_animation_paths = [ i for i in each_geo_filepath.parent.glob( '**/*.c' ) if i.stem not in skip_stems ]
+            local_animation_paths = [ i for i in index.glob( '**/*.c', root=each_geo_filepath.parent ) if i.stem not in skip_stems ]
     
             local_anim_source = ''
             for each_path in local_animation_paths:
-                with open( each_path, 'r' ) as f:
-                    local_anim_source += f.read()
+                local_anim_source += index.read( each_path )
     
             ## Next, we process the animation source.  The goal is to get a list of Animations.
             anim_structs = [ i for i in local_anim_source.split( ';' ) if '=' in i ]
@@ -605,11 +587,8 @@ def main( mario_source_dir, mario_graphics_dir ):
         else:
             used_animation = None
     
-        geo_structs = geo_txt.split( ';' )
-        for each_struct in geo_structs:
-            if ' GeoLayout ' in each_struct:
-                struct_name = get_name( each_struct )
-                geo_dict[ struct_name ] = Geo( struct_name, geo_source_dict, animation=used_animation )
+        for struct_name, each_struct in geo_layouts[ each_geo_filepath ]:
+            geo_dict[ struct_name ] = Geo( struct_name, geo_source_dict, animation=used_animation )
     
     
     
@@ -620,17 +599,16 @@ def main( mario_source_dir, mario_graphics_dir ):
     
     ## We now have to parse /levels/scripts.c for macro name to geo lookups.
     obj_name_to_geo_dict = {}
-    script_filepaths = [ i for i in mario_source_dir.glob( '**/script*.c' ) ]
+    script_filepaths = index.glob( '**/script*.c' )
     for each_script in script_filepaths:
-        with open( each_script, 'r' ) as f:
-            for line in f:
-                if 'LOAD_MODEL_FROM_GEO' in line:
-                    obj_name, geo_name = process_line( line )
-                    obj_name_to_geo_dict[ obj_name ] = geo_name
-                elif 'LOAD_MODEL_FROM_DL' in line:
-                    ## Make a new geo object and then put the display list in the geo_dls.
-                    name, dl_name, layer = process_line( line )
-                    ## TODO: finish this
+        for line in index.read( each_script ).split( '\n' ):
+            if 'LOAD_MODEL_FROM_GEO' in line:
+                obj_name, geo_name = process_line( line )
+                obj_name_to_geo_dict[ obj_name ] = geo_name
+            elif 'LOAD_MODEL_FROM_DL' in line:
+                ## Make a new geo object and then put the display list in the geo_dls.
+                name, dl_name, layer = process_line( line )
+                ## TODO: finish this
     
     for each_macro in macro_dict:
         try:
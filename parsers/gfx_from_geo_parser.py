@@ -1,7 +1,12 @@
 from pathlib import Path
 import pickle
 
-from .level_script_parser import process_line
+from .source_index import get_index
+from .macro_lexer import tokenize_macros
+
+
+## Geo commands whose last argument is a display list.
+GEO_OPCODES_WITH_DL = { 'GEO_TRANSLATE_ROTATE_WITH_DL', 'GEO_TRANSLATE_WITH_DL', 'GEO_ROTATE_WITH_DL', 'GEO_ROTATE_Y_WITH_DL', 'GEO_TRANSLATE_NODE_WITH_DL', 'GEO_ROTATION_NODE_WITH_DL', 'GEO_ANIMATED_PART', 'GEO_BILLBOARD_WITH_PARAMS_AND_DL', 'GEO_DISPLAY_LIST', 'GEO_SCALE_WITH_DL' }
 
 
 ## This parser will generate a dictionary that has Gfx names as keys for all Gfx that are called directly from geo files.  The values will simply be True, because we just want an O(1) way to see if a particular Gfx is called from geo.
@@ -9,26 +14,15 @@ from .level_script_parser import process_line
 def main( mario_source_dir, mario_graphics_dir ):
 
     gfxs_called_from_geo = {}
-    geo_filepaths = mario_source_dir.glob( '**/geo.inc.c' )
+    index = get_index( mario_source_dir, mario_graphics_dir )
+    geo_filepaths = index.glob( '**/geo.inc.c' )
 
 
     for each_geo_filepath in geo_filepaths:
-        with open( each_geo_filepath, 'r' ) as f:
-            geo_txt = f.read()
-
-        geo_lines = [ each_line.strip() for each_line in geo_txt.split( '\n' ) ]
-        for each_line in geo_lines:
-            if 'GEO_TRANSLATE_ROTATE_WITH_DL' in each_line \
-                or 'GEO_TRANSLATE_WITH_DL' in each_line \
-                or 'GEO_ROTATE_WITH_DL' in each_line \
-                or 'GEO_ROTATE_Y_WITH_DL' in each_line \
-                or 'GEO_TRANSLATE_NODE_WITH_DL' in each_line \
-                or 'GEO_ROTATION_NODE_WITH_DL' in each_line \
-                or 'GEO_ANIMATED_PART' in each_line \
-                or 'GEO_BILLBOARD_WITH_PARAMS_AND_DL' in each_line \
-                or 'GEO_DISPLAY_LIST' in each_line \
-                or 'GEO_SCALE_WITH_DL' in each_line:
-                    *_, display_list = process_line( each_line )
+        for kind, name, geo_source in index.get_declarations( each_geo_filepath, 'GeoLayout' ):
+            for opcode, args in tokenize_macros( geo_source ):
+                if opcode in GEO_OPCODES_WITH_DL:
+                    *_, display_list = args
                     if display_list != 'NULL':
                         gfxs_called_from_geo[ display_list ] = True
                     
@@ -3,10 +3,13 @@ import math
 import pickle
 
 from .level_script_parser import LevelScript, LevelGeo, LevelGeoDisplayList, Area, Obj, WaterBox
-from .model_parser import Vertex, Vtx, Gfx, GfxDrawList, Light, RenderSettings
+from .model_parser import Vtx, Gfx, GfxDrawList, Light, RenderSettings, as_positions, as_texel_coordinates
 from .geo_parser import Geo, GeoDisplayList, Animation
 from .movtex_tri_parser import Movtex_Tri
 from .paintings_parser import Painting
+from .macro_lexer import tokenize_macro
+import asset_store
+import game_data
 import util_math
 
 
@@ -168,30 +171,12 @@ def remove_castle_basement_tile( level_scripts, gfx_display_dict ):
                 gfx_display_list = gfx_display_dict[ each_geo_dl.dl_name ]
                 for i in range( len( gfx_display_list ) - 1, -1, -1 ):
                     if gfx_display_list[ i ].name == 'inside_castle_seg7_vertex_0702C570':
-                        new_positions = []
-                        new_texel_coordinates = []
-                        new_colours = []
-                        new_triangles = []
-                        old_pos_to_new_pos = {}
-                        for j in range( len( gfx_display_list[ i ].positions ) // 3 ):
-                            if gfx_display_list[ i ].positions[ 3 * j + 1 ] != -1074:
-                                old_pos_to_new_pos[ j ] = len( new_positions ) // 3
-                                new_positions += gfx_display_list[ i ].positions[ 3 * j : 3 * ( j + 1 ) ]
-                                new_texel_coordinates += gfx_display_list[ i ].texel_coordinates[ 2 * j : 2 * ( j + 1 ) ]
-                                new_colours += gfx_display_list[ i ].colors[ 4 * j : 4 * ( j + 1 ) ]
-
-                        for j in range( len( gfx_display_list[ i ].triangles ) ):
-                            if gfx_display_list[ i ].triangles[ j ] in old_pos_to_new_pos.keys():
-                                new_triangles.append( old_pos_to_new_pos[ gfx_display_list[ i ].triangles[ j ] ] ) 
-                        gfx_display_list[ i ].positions = new_positions
-                        gfx_display_list[ i ].texel_coordinates = new_texel_coordinates
-                        gfx_display_list[ i ].colors = new_colours
-                        gfx_display_list[ i ].triangles = new_triangles
+                        gfx_display_list[ i ].remove_vertices( gfx_display_list[ i ].positions[ :, 1 ] != -1074 )
 
 
 def add_castle_lobby_light( level_scripts ):
     ## Add dl_castle_lobby_wing_cap_light to castle_geo_000F30.
-    wing_cap_light_geo_dl = LevelGeoDisplayList( 'GEO_DISPLAY_LIST(LAYER_TRANSPARENT, dl_castle_lobby_wing_cap_light)' )
+    wing_cap_light_geo_dl = LevelGeoDisplayList( tokenize_macro( 'GEO_DISPLAY_LIST(LAYER_TRANSPARENT, dl_castle_lobby_wing_cap_light)' ) )
     level_scripts[ 'castle_inside' ].geo_dict[ level_scripts[ 'castle_inside' ].areas[ 0 ].geo[ 0 ] ].geo_dls.append( wing_cap_light_geo_dl )
 
 
@@ -216,7 +201,7 @@ def fix_intro_dls( gfx_display_dict ):
         if gfx_display_list.name == 'intro_seg7_vertex_0700B420':
             gfx_display_list.texture_enable = True
             gfx_display_list.render_settings.current_texture = 'intro_seg7_texture_0700B4A0'
-            gfx_display_list.render_settings.set_current_texture_settings( 'gsDPSetTile(G_IM_FMT_RGBA, G_IM_SIZ_16b, 16, 0, G_TX_RENDERTILE, 0, G_TX_CLAMP, 7, G_TX_NOLOAD, G_TX_CLAMP, 4, G_TX_NOLOD)' )
+            gfx_display_list.render_settings.set_current_texture_settings( tokenize_macro( 'gsDPSetTile(G_IM_FMT_RGBA, G_IM_SIZ_16b, 16, 0, G_TX_RENDERTILE, 0, G_TX_CLAMP, 7, G_TX_NOLOAD, G_TX_CLAMP, 4, G_TX_NOLOD)' )[ 1 ] )
             ninlogo_center_x = 0
             ninlogo_center_y = -500
             ninlogo_center_z = -1
@@ -227,11 +212,10 @@ def fix_intro_dls( gfx_display_dict ):
             y_remap = { 42:( ninlogo_center_y - ninlogo_height / 2 ), 58:( ninlogo_center_y + ninlogo_height / 2 ) }
 
             try:
-                for i in range( len( gfx_display_list.positions ) ):
-                    if i % 3 == 0:
-                        gfx_display_list.positions[ i ] = x_remap[ gfx_display_list.positions[ i ] ]
-                    if i % 3 == 1:
-                        gfx_display_list.positions[ i ] = y_remap[ gfx_display_list.positions[ i ] ]
+                new_positions = gfx_display_list.positions.copy()
+                new_positions[ :, 0 ] = [ x_remap[ i ] for i in gfx_display_list.positions[ :, 0 ].tolist() ]
+                new_positions[ :, 1 ] = [ y_remap[ i ] for i in gfx_display_list.positions[ :, 1 ].tolist() ]
+                gfx_display_list.positions = new_positions
 
             except:
                 pass
@@ -241,29 +225,11 @@ def fix_intro_dls( gfx_display_dict ):
         elif gfx_display_list.name == 'intro_seg7_vertex_0700B460':
             gfx_display_list.texture_enable = True
             gfx_display_list.render_settings.current_texture = 'intro_seg7_texture_0700C4A0'
-            gfx_display_list.render_settings.set_current_texture_settings( 'gsDPSetTile(G_IM_FMT_RGBA, G_IM_SIZ_16b, 16, 0, G_TX_RENDERTILE, 0, G_TX_CLAMP, 4, G_TX_NOLOAD, G_TX_CLAMP, 4, G_TX_NOLOD)' )
+            gfx_display_list.render_settings.set_current_texture_settings( tokenize_macro( 'gsDPSetTile(G_IM_FMT_RGBA, G_IM_SIZ_16b, 16, 0, G_TX_RENDERTILE, 0, G_TX_CLAMP, 4, G_TX_NOLOAD, G_TX_CLAMP, 4, G_TX_NOLOD)' )[ 1 ] )
 
         ## Remove black square background for behind the main logo.
         elif gfx_display_list.name == 'intro_seg7_vertex_07006AC0':
-            new_positions = []
-            new_texel_coordinates = []
-            new_colours = []
-            new_triangles = []
-            old_pos_to_new_pos = {}
-            for j in range( len( gfx_display_list.positions ) // 3 ):
-                if gfx_display_list.positions[ 3 * j + 2 ] != -818:
-                    old_pos_to_new_pos[ j ] = len( new_positions ) // 3
-                    new_positions += gfx_display_list.positions[ 3 * j : 3 * ( j + 1 ) ]
-                    new_texel_coordinates += gfx_display_list.texel_coordinates[ 2 * j : 2 * ( j + 1 ) ]
-                    new_colours += gfx_display_list.colors[ 4 * j : 4 * ( j + 1 ) ]
-
-            for j in range( len( gfx_display_list.triangles ) ):
-                if gfx_display_list.triangles[ j ] in old_pos_to_new_pos.keys():
-                    new_triangles.append( old_pos_to_new_pos[ gfx_display_list.triangles[ j ] ] ) 
-            gfx_display_list.positions = new_positions
-            gfx_display_list.texel_coordinates = new_texel_coordinates
-            gfx_display_list.colors = new_colours
-            gfx_display_list.triangles = new_triangles
+            gfx_display_list.remove_vertices( gfx_display_list.positions[ :, 2 ] != -818 )
 
 
 
@@ -354,7 +320,7 @@ def place_treadmills_ttc( level_scripts, movtex_dict ):
         positions_mat = util_math.positions_to_mat( current_large_treadmill.drawlist.positions )
         rotate_yaw_mat = util_math.rotate_around_y( current_yaw )
         move_mat = util_math.translate_mat( *current_offset )
-        current_large_treadmill.drawlist.positions = util_math.mat_to_positions( positions_mat @ rotate_yaw_mat @ move_mat )
+        current_large_treadmill.drawlist.positions = as_positions( util_math.mat_to_positions( positions_mat @ rotate_yaw_mat @ move_mat ) )
         level_scripts[ 'ttc' ].areas[ 0 ].movtex += [ current_large_treadmill ]
 
     for i in range( 2, 7 ):
@@ -364,7 +330,7 @@ def place_treadmills_ttc( level_scripts, movtex_dict ):
         positions_mat = util_math.positions_to_mat( current_small_treadmill.drawlist.positions )
         rotate_yaw_mat = util_math.rotate_around_y( current_yaw )
         move_mat = util_math.translate_mat( *current_offset )
-        current_small_treadmill.drawlist.positions = util_math.mat_to_positions( positions_mat @ rotate_yaw_mat @ move_mat )
+        current_small_treadmill.drawlist.positions = as_positions( util_math.mat_to_positions( positions_mat @ rotate_yaw_mat @ move_mat ) )
         level_scripts[ 'ttc' ].areas[ 0 ].movtex += [ current_small_treadmill ]
 
 
@@ -376,8 +342,7 @@ def place_sand_pits_pyramid( level_scripts, movtex_dict ):
     for i in range( 3 ):
         current_sand_pit = movtex_dict[ 'MOVTEX_SSL_SAND_PIT_PYRAMID' ].copy()
         current_offset = positions[ i ]
-        for j in range( len( current_sand_pit.drawlist.positions ) ):
-            current_sand_pit.drawlist.positions[ j ] += current_offset[ j % 3 ]
+        current_sand_pit.drawlist.positions = as_positions( current_sand_pit.drawlist.positions + current_offset )
         sand_pits.append( current_sand_pit )
     level_scripts[ 'ssl' ].areas[ area_number ].movtex += sand_pits
 
@@ -389,8 +354,7 @@ def place_sand_pits_outside( level_scripts, movtex_dict ):
     for i in range( 5 ):
         current_sand_pit = movtex_dict[ 'MOVTEX_SSL_SAND_PIT_OUTSIDE' ].copy()
         current_offset = positions[ i ]
-        for j in range( len( current_sand_pit.drawlist.positions ) ):
-            current_sand_pit.drawlist.positions[ j ] += current_offset[ j % 3 ]
+        current_sand_pit.drawlist.positions = as_positions( current_sand_pit.drawlist.positions + current_offset )
         sand_pits.append( current_sand_pit )
 
     level_scripts[ 'ssl' ].areas[ area_number ].movtex += sand_pits
@@ -499,7 +463,7 @@ def fix_exclamation_boxes( obj_name_to_geo_dict, geo_dict, gfx_display_dict ):
     wing_cap_box_geo.geo_dls = [ wing_cap_geo_dl ]
     obj_name_to_geo_dict[ 'macro_box_wing_cap' ] = 'wing_cap_box_geo'
     geo_dict[ 'wing_cap_box_geo' ] = wing_cap_box_geo
-    gfx_display_dict[ 'exclamation_box_seg8_dl_08019318' ][ 1 ].texel_coordinates = texel_coords.copy()
+    gfx_display_dict[ 'exclamation_box_seg8_dl_08019318' ][ 1 ].texel_coordinates = as_texel_coordinates( texel_coords )
 
     metal_cap_box_geo = Geo( 'metal_cap_box_geo', {}, process_code=False )
     metal_cap_geo_dl = GeoDisplayList( 'LAYER_OPAQUE', 'exclamation_box_seg8_dl_08019378', util_math.identity_mat(), zbuffer=True, billboard=False )
@@ -512,7 +476,7 @@ def fix_exclamation_boxes( obj_name_to_geo_dict, geo_dict, gfx_display_dict ):
     vanish_cap_box_geo.geo_dls = [ vanish_cap_geo_dl ]
     obj_name_to_geo_dict[ 'macro_box_vanish_cap' ] = 'vanish_cap_box_geo'
     geo_dict[ 'vanish_cap_box_geo' ] = vanish_cap_box_geo
-    gfx_display_dict[ 'exclamation_box_seg8_dl_080193D8' ][ 1 ].texel_coordinates = texel_coords.copy()
+    gfx_display_dict[ 'exclamation_box_seg8_dl_080193D8' ][ 1 ].texel_coordinates = as_texel_coordinates( texel_coords )
 
     exclamation_box_geo = Geo( 'exclamation_box_geo', {}, process_code=False )
     exclamation_box_geo_dl = GeoDisplayList( 'LAYER_OPAQUE', 'exclamation_box_seg8_dl_08019438', util_math.identity_mat(), zbuffer=True, billboard=False )
@@ -612,30 +576,10 @@ def main( mario_source_dir, mario_graphics_dir ):
 
     skybox_dict, texture_dict, name_dict, model_dict, macro_dict, macro_to_geo_dict, special_dict, level_scripts, vtx_dict, gfx_dict, light_dict, gfx_display_dict, paintings_dict, movtex_dict, obj_name_to_geo_dict, geo_dict = fix_everything( skybox_dict, texture_dict, name_dict, model_dict, macro_dict, macro_to_geo_dict, special_dict, level_scripts, vtx_dict, gfx_dict, light_dict, gfx_display_dict, paintings_dict, movtex_dict, obj_name_to_geo_dict, geo_dict )
 
-    
-    with open( mario_graphics_dir / 'm64_dicts.pickle', 'wb' ) as f:
-        pickle.dump( [ skybox_dict, texture_dict, name_dict ], f, pickle.HIGHEST_PROTOCOL )
-
-    with open( mario_graphics_dir / 'model_dicts.pickle' , 'wb' ) as f:
-        pickle.dump( [ model_dict, macro_dict, macro_to_geo_dict, special_dict ], f, pickle.HIGHEST_PROTOCOL )
-
-    with open( mario_graphics_dir / 'level_scripts.pickle', 'wb' ) as f:
-        pickle.dump( level_scripts, f, pickle.HIGHEST_PROTOCOL )
-
-    with open( mario_graphics_dir / 'draw_dicts.pickle', 'wb' ) as f:
-        pickle.dump( [ vtx_dict, gfx_dict, light_dict, gfx_display_dict ], f, pickle.HIGHEST_PROTOCOL )
-
-    with open( mario_graphics_dir / 'paintings.pickle', 'wb' ) as f:
-        pickle.dump( paintings_dict, f, pickle.HIGHEST_PROTOCOL )
-
-    with open( mario_graphics_dir / 'movtex_dict.pickle', 'wb' ) as f:
-        pickle.dump( movtex_dict, f, pickle.HIGHEST_PROTOCOL )
-
-    with open( mario_graphics_dir / 'obj_geo_dicts.pickle', 'wb' ) as f:
-        pickle.dump( [ obj_name_to_geo_dict, geo_dict ], f, pickle.HIGHEST_PROTOCOL )
 
-    with open( mario_graphics_dir / 'game_dicts.pickle', 'wb' ) as f:
-        pickle.dump( [ level_scripts, geo_dict, gfx_display_dict, texture_dict, obj_name_to_geo_dict, special_dict ], f, pickle.HIGHEST_PROTOCOL )
+    ## Only the game data store is written.  The intermediate pickles are left as the parsers wrote them so that this stage can be re-run on its own without applying the fixes twice.
+    sections = game_data.split_game_data( level_scripts, geo_dict, gfx_display_dict, texture_dict, obj_name_to_geo_dict, special_dict )
+    asset_store.save_asset_store( sections, mario_graphics_dir / game_data.GAME_DATA_FILENAME )
 
 
     print( "Level fixes applied." )
@@ -2,7 +2,11 @@ import glob
 from pathlib import Path
 import pickle
 
+import numpy as np
+
 from util_math import scale_mat
+from .source_index import get_index
+from .macro_lexer import parse_arg, tokenize_macros
 
 
 def process_line( line ):
@@ -19,33 +23,7 @@ def process_line( line ):
         comment_end = uncommented_line.find( '*/', comment_start ) + len( '*/' )
         uncommented_line = uncommented_line[ : comment_start ] + uncommented_line[ comment_end : ]
 
-    args = uncommented_line.split( ',' )
-    ret_arr = []
-    for each_arg in args:
-        temp_arg = each_arg.strip()
-
-        if '0x' in temp_arg:
-            ## Try to process as a hex number
-            try:
-                hex_arg = int( temp_arg, 16 )
-                ret_arr.append( hex_arg )
-            except:
-                ret_arr.append( temp_arg )
-
-        else:
-            ## Try to parse as an int, otherwise try to parse as a float with a trailing 'f'.  Otherwise, just add the string to the arg list.
-            try:
-                int_arg = int( temp_arg )
-                ret_arr.append( int_arg )
-
-            except:
-                try:
-                    if temp_arg[ -1 ] == 'f':
-                        ret_arr.append( float( temp_arg[ : -1 ] ) )
-                    else:
-                        ret_arr.append( temp_arg )
-                except:
-                    ret_arr.append( temp_arg )
+    ret_arr = [ parse_arg( each_arg ) for each_arg in uncommented_line.split( ',' ) ]
 
     if len( ret_arr ) > 1:
         return ret_arr
@@ -55,8 +33,9 @@ def process_line( line ):
 
 
 class LevelScript():
-    def __init__( self, filepath ):
+    def __init__( self, filepath, source_index ):
         self.filepath = filepath
+        self.source_index = source_index
         self.mario_pos = [ 1, 0, 0.0, 0.0, 0.0 ]  ## Area, yaw, x, y , z
         self.terrain_type = None
         self.background_music = None
@@ -72,12 +51,13 @@ class LevelScript():
         self.parse_movtex()
         self.parse_collision()
         self.parse_geo()
+        ## The index is only needed while parsing and shouldn't end up in the pickle.
+        del self.source_index
         
 
     def read_file( self ):
         self.level = self.filepath.parts[ self.filepath.parts.index( 'levels' ) + 1 ]
-        with open( self.filepath, 'r' ) as f:
-            self.txt = f.read()
+        self.txt = self.source_index.read( self.filepath )
 
 
     def get_areas( self ):
@@ -115,6 +95,10 @@ class LevelScript():
                 if "SET_BACKGROUND_MUSIC" in each_line:
                     current_area.background_music = process_line( temp_line )
 
+                ## Get the name of the array of the room of each collision triangle, for areas that are split into rooms.
+                if temp_line[ : 6 ] == 'ROOMS(':
+                    current_area.rooms_name = process_line( temp_line )
+
                 ## Find any area specific objects.  These at least occur in castle_inside.
                 if 'OBJECT' in each_line and 'MODEL_NONE' not in each_line and 'MACRO_OBJECTS' not in each_line:
                     current_obj = Obj( each_line )
@@ -155,26 +139,13 @@ class LevelScript():
             for each_local_func in each_area.local_funcs:
                 local_funcs_to_find[ each_local_func ] = each_area.index
 
-        current_ind = 0
-        while True:
-            ## Loop to find every local function.
-
-            ## First find the start of a local function and extract its index.
-            current_ind = self.txt.find( 'static const LevelScript script_func_local_', current_ind )
-            ## If there are no more local functions in the rest of the file, exit the while loop.
-            if current_ind == -1:
-                break
-            current_ind += len( 'static const LevelScript ' )
-            ## If there are no more local functions in the rest of the file, exit the while loop.
-            if current_ind == -1:
-                break
-            bracket_ind = self.txt.find( '[', current_ind )
-            local_func_name = self.txt[ current_ind : bracket_ind ]
+        for kind, local_func_name, local_func_source in self.source_index.get_declarations( self.filepath, 'LevelScript' ):
+            ## Only look at local functions.
+            if local_func_name[ : len( 'script_func_local_' ) ] != 'script_func_local_':
+                continue
             assert local_func_name in local_funcs_to_find.keys(), "The local function is not in any area local function lists."
 
-            current_ind = self.txt.find( '{', current_ind )
-            end_local_func_ind = self.txt.find( '};', current_ind )
-            local_func_lines = [ i.strip() for i in self.txt[ current_ind : end_local_func_ind ].split( '\n' ) ]
+            local_func_lines = [ i.strip() for i in local_func_source[ local_func_source.find( '{' ) : ].split( '\n' ) ]
             for each_local_line in local_func_lines:
                 ## Don't bother processing objects without models.
                 if 'OBJECT' in each_local_line and 'MODEL_NONE' not in each_local_line:
@@ -195,93 +166,62 @@ class LevelScript():
                         raise ValueError( "Unknown object type." )
 
 
-    def parse_geo( self ):
-        for each_area in self.areas:
-            for each_geo_path in each_area.filepath.glob( '**/geo.inc.c' ):
-                with open( each_geo_path, 'r' ) as f:
-                    geo_txt = f.read()
-
-                ## Find all GeoLayouts in the file.
-                current_ind = 0
-                while True:
-                    current_ind = geo_txt.find( 'GeoLayout ', current_ind )
-                    if current_ind == -1:
-                        break
-                    current_ind += len( 'GeoLayout ' )
-                    name_end_ind = geo_txt.find( '[', current_ind )
-                    current_geo_name = geo_txt[ current_ind : name_end_ind ]
-
-                    current_ind = geo_txt.find( '{', current_ind ) + len( '{' )
-                    end_ind = geo_txt.find( '};', current_ind )
-                    current_geo_code = geo_txt[ current_ind : end_ind ]
-                    self.geo_dict[ current_geo_name ] = LevelGeo( current_geo_name, current_geo_code )
+    def read_geo_layouts( self, geo_path ):
+        """Returns a list of ( name, code ) for each GeoLayout in a geo file, where code is everything between the braces of the struct."""
+        return [ ( name, source[ source.find( '{' ) + 1 : source.rfind( '}' ) ] ) for kind, name, source in self.source_index.get_declarations( geo_path, 'GeoLayout' ) ]
 
-                ## Read through the file again and resolve geo references.
-                current_ind = 0
-                while True:
-                    current_ind = geo_txt.find( 'GeoLayout ', current_ind )
-                    if current_ind == -1:
-                        break
-                    current_ind += len( 'GeoLayout ' )
-                    name_end_ind = geo_txt.find( '[', current_ind )
-                    current_geo_name = geo_txt[ current_ind : name_end_ind ]
 
-                    current_ind = geo_txt.find( '{', current_ind ) + len( '{' )
-                    end_ind = geo_txt.find( '};', current_ind )
-                    current_geo_code = geo_txt[ current_ind : end_ind ]
+    def parse_geo( self ):
+        for each_area in self.areas:
+            for each_geo_path in self.source_index.glob( '**/geo.inc.c', root=each_area.filepath ):
+                geo_layouts = self.read_geo_layouts( each_geo_path )
 
-                    ## Resolve geo references.
-                    if 'GEO_BRANCH' in current_geo_code:
-                        current_geo_lines = [ i.strip() for i in geo_txt.split( '\n' ) ]
-                        geo_names_to_resolve = []
+                ## Make a LevelGeo for every GeoLayout in the file.
+                for current_geo_name, current_geo_code in geo_layouts:
+                    self.geo_dict[ current_geo_name ] = LevelGeo( current_geo_name, current_geo_code )
 
-                        for each_line in current_geo_lines:
-                            if 'GEO_BRANCH' in each_line:
-                                _, geo_name = process_line( each_line )
-                                geo_names_to_resolve.append( geo_name )
+                ## Go through them again and resolve geo references.
+                for current_geo_name, current_geo_code in geo_layouts:
+                    geo_names_to_resolve = [ args[ 1 ] for opcode, args in tokenize_macros( current_geo_code ) if opcode == 'GEO_BRANCH' ]
 
+                    ## Now we have the names and we can iterate through them and update current_geo_name.
+                    for each_name in geo_names_to_resolve:
+                        self.geo_dict[ current_geo_name ].shadows += self.geo_dict[ each_name ].shadows
+                        self.geo_dict[ current_geo_name ].geo_dls += self.geo_dict[ each_name ].geo_dls
 
-                        ## Now we have the names and we can iterate through them and update current_geo_name.
-                        for each_name in geo_names_to_resolve:
-                            self.geo_dict[ current_geo_name ].shadows += self.geo_dict[ each_name ].shadows
-                            self.geo_dict[ current_geo_name ].geo_dls += self.geo_dict[ each_name ].geo_dls
+                    ## Keep what each case of a geo_switch_area draws, before level_fixes dedupes the display lists of the cases.
+                    current_geo = self.geo_dict[ current_geo_name ]
+                    current_geo.room_dl_names = [ [ each_geo_dl.dl_name for each_geo_dl in self.geo_dict[ each_name ].geo_dls ] for each_name in current_geo.switch_area_branches ]
 
 
 
         ## Need to process level_geo that is in the root of the level folder.
-        root_level_geo = [ each_filepath for each_filepath in self.filepath.parent.glob( '**/geo.inc.c' ) if 'areas' not in each_filepath.parent.parts ]
+        root_level_geo = [ each_filepath for each_filepath in self.source_index.glob( '**/geo.inc.c', root=self.filepath.parent ) if 'areas' not in each_filepath.parent.parts ]
         for each_geo_path in root_level_geo:
-            with open( each_geo_path, 'r' ) as f:
-                geo_txt = f.read()
-
-            ## Find all GeoLayouts in the file.
-            current_ind = 0
-            while True:
-                current_ind = geo_txt.find( 'GeoLayout ', current_ind )
-                if current_ind == -1:
-                    break
-                current_ind += len( 'GeoLayout ' )
-                name_end_ind = geo_txt.find( '[', current_ind )
-                current_geo_name = geo_txt[ current_ind : name_end_ind ]
-
-                current_ind = geo_txt.find( '{', current_ind ) + len( '{' )
-                end_ind = geo_txt.find( '};', current_ind )
-                current_geo_code = geo_txt[ current_ind : end_ind ]
+            for current_geo_name, current_geo_code in self.read_geo_layouts( each_geo_path ):
                 self.geo_dict[ current_geo_name ] = LevelGeo( current_geo_name, current_geo_code )
 
 
 
     def parse_collision( self ):
         for each_area in self.areas:
-            for each_collision_path in each_area.filepath.glob( '**/collision.inc.c' ):
-                with open( each_collision_path, 'r' ) as f:
-                    collision_txt = f.read()
+            vertices = []
+            triangles = []
+            for each_collision_path in self.source_index.glob( '**/collision.inc.c', root=each_area.filepath ):
+                collision_txt = self.source_index.read( each_collision_path )
 
                 collision_lines = [ i.strip() for i in collision_txt.split( '\n' ) ]
                 for each_line in collision_lines:
                     if 'OBJECT' in each_line:
                         each_area.special_objs.append( Obj( each_line ) )
 
+                    ## Triangles are only needed to find the room of a point, so they're only kept for areas with rooms.
+                    elif each_area.rooms_name is not None and each_line[ : 11 ] == 'COL_VERTEX(':
+                        vertices.append( process_line( each_line ) )
+
+                    elif each_area.rooms_name is not None and ( each_line[ : 8 ] == 'COL_TRI(' or each_line[ : 16 ] == 'COL_TRI_SPECIAL(' ):
+                        triangles.append( process_line( each_line )[ : 3 ] )
+
                     elif 'COL_WATER_BOX' in each_line and 'COL_WATER_BOX_INIT' not in each_line:
                         ## We need to match up waterboxes that are in areas[].movtex with the current line.
                         ind, x1, z1, x2, z2, y = process_line( each_line )
@@ -290,12 +230,27 @@ class LevelScript():
                                 if each_water_box.index == ind:
                                     each_water_box.set_height( y )
 
+            if each_area.rooms_name is not None and triangles:
+                each_area.set_floors( np.array( vertices, dtype=np.float32 )[ np.array( triangles ) ], self.read_rooms( each_area ) )
+
+
+    def read_rooms( self, area ):
+        """Reads the room of each collision triangle of an area from the s8 array named by its ROOMS command."""
+        for each_room_path in self.source_index.glob( '**/room.inc.c', root=area.filepath ):
+            room_txt = self.source_index.read( each_room_path )
+            name_ind = room_txt.find( area.rooms_name + '[' )
+            if name_ind == -1:
+                continue
+            array_txt = room_txt[ room_txt.find( '{', name_ind ) + 1 : room_txt.find( '}', name_ind ) ]
+            array_txt = '\n'.join( each_line.split( '//' )[ 0 ] for each_line in array_txt.split( '\n' ) )
+            return [ int( each_value ) for each_value in array_txt.split( ',' ) if each_value.strip() ]
+        return []
+
     
     def parse_macro( self ):
         for each_area in self.areas:
-            for each_macro_path in each_area.filepath.glob( '**/macro.inc.c' ):
-                with open( each_macro_path, 'r' ) as f:
-                    macro_txt = f.read()
+            for each_macro_path in self.source_index.glob( '**/macro.inc.c', root=each_area.filepath ):
+                macro_txt = self.source_index.read( each_macro_path )
 
                 macro_lines = [ i.strip() for i in macro_txt.split( '\n' ) ]
                 for each_line in macro_lines:
@@ -305,40 +260,27 @@ class LevelScript():
 
     def parse_movtex( self ):
         for each_area in self.areas:
-            for each_movtex_path in each_area.filepath.glob( '**/movtext.inc.c' ):
-                with open( each_movtex_path, 'r' ) as f:
-                    movtex_txt = f.read()
-
+            for each_movtex_path in self.source_index.glob( '**/movtext.inc.c', root=each_area.filepath ):
                 ## Find each MovtexQuadCollection and parse out the quads from it.
-                current_ind = 0
-                while True:
-                    current_ind = movtex_txt.find( '{', movtex_txt.find( 'MovtexQuadCollection', current_ind ) )
-                    if current_ind != -1:
-                        ## Then there are waterboxes in the file
-                        current_ind += 1
-                        end_ind = movtex_txt.find( '};', current_ind )
-
-                        quad_names = []
-                        while True:
-                            current_ind = movtex_txt.find( '{', current_ind ) + 1
-                            entry_end_ind = movtex_txt.find( '}', current_ind )
-                            quad_ind = int( movtex_txt[ current_ind : entry_end_ind ].split( ',' )[ 0 ].strip() )
-                            quad_name = movtex_txt[ current_ind : entry_end_ind ].split( ',' )[ 1 ].strip()
-                            if quad_name == 'NULL':
-                                break
-                            else:
-                                quad_names.append( [ quad_ind, quad_name ] )
-
-
-                        ## Find opening and closing curly braces and look to see if a waterbox is contained inside:
-                        for each_quad in quad_names:
-                            quad_ind = movtex_txt.find( each_quad[ 1 ] )
-                            quad_end_ind = movtex_txt.find( '};', quad_ind )
-                            ## Parse each water_box from the single water data.
-                            each_area.movtex += self.parse_waterbox( movtex_txt[ quad_ind : quad_end_ind ], each_quad[ 0 ] )
-
-                    elif current_ind == -1:
-                        break
+                for kind, name, collection_source in self.source_index.get_declarations( each_movtex_path, 'MovtexQuadCollection' ):
+                    current_ind = collection_source.find( '{' ) + 1
+
+                    quad_names = []
+                    while True:
+                        current_ind = collection_source.find( '{', current_ind ) + 1
+                        entry_end_ind = collection_source.find( '}', current_ind )
+                        quad_ind = int( collection_source[ current_ind : entry_end_ind ].split( ',' )[ 0 ].strip() )
+                        quad_name = collection_source[ current_ind : entry_end_ind ].split( ',' )[ 1 ].strip()
+                        if quad_name == 'NULL':
+                            break
+                        else:
+                            quad_names.append( [ quad_ind, quad_name ] )
+
+
+                    ## Parse each water_box from the single water data.
+                    for each_quad in quad_names:
+                        quad_source = self.source_index.read_declaration( 'Movtex', each_quad[ 1 ], [ each_movtex_path ] )
+                        each_area.movtex += self.parse_waterbox( quad_source, each_quad[ 0 ] )
 
 
     def parse_waterbox( self, code_lines, ind ):
@@ -420,71 +362,89 @@ class LevelGeo():
         self.name = name
         self.shadows = []
         self.geo_dls = []
+        ## Geos branched to by each case of a GEO_SWITCH_CASE on geo_switch_area, which picks the case from the room the camera is in, and the names of the display lists each case draws once branches are resolved.
+        self.switch_area_branches = []
+        self.room_dl_names = []
         self.process_code( code )
 
 
     def process_code( self, code ):
         ## Because level geo files are much simpler than object geo files, we can avoid implementing a parser for all kinds of graph display nodes.  We can also cheat a little bit on GEO_SCALE and GEO_RENDER_RANGE because of how simple the few uses are in level geo.
+        ## Display lists inside a GEO_RENDER_RANGE node keep its ( near, far ) range, so they can be drawn only at those camera distances.
         current_scale = 1.0
-        geo_lines = [ i.strip() for i in code.split( '\n' ) ]
-        geo_render_range_ignore = False
+        geo_render_range = None
         geo_render_range_open_node = False
-        for each_line in geo_lines:
-            if 'GEO_DISPLAY_LIST' in each_line:
-                if not geo_render_range_open_node:
-                    current_geo_display_list = LevelGeoDisplayList( each_line, scale=current_scale )
-                    if current_geo_display_list.dl_name != 'NULL':
-                        self.geo_dls.append( LevelGeoDisplayList( each_line, scale=current_scale ) )
-
-            elif 'GEO_SCALE' in each_line:
-                layer, scale = process_line( each_line )
+        node_depth = 0
+        switch_area_depth = None
+        for opcode, args in tokenize_macros( code ):
+            if opcode == 'GEO_DISPLAY_LIST':
+                current_geo_display_list = LevelGeoDisplayList( ( opcode, args ), scale=current_scale, render_range=geo_render_range if geo_render_range_open_node else None )
+                if current_geo_display_list.dl_name != 'NULL':
+                    self.geo_dls.append( current_geo_display_list )
+
+            elif opcode == 'GEO_SCALE':
+                layer, scale = args
                 current_scale *= ( scale / 65536 )
 
-            elif 'GEO_ANIMATED_PART' in each_line:
-                current_geo_display_list = LevelGeoDisplayList( each_line, scale=current_scale )
+            elif opcode == 'GEO_ANIMATED_PART':
+                current_geo_display_list = LevelGeoDisplayList( ( opcode, args ), scale=current_scale )
                 if current_geo_display_list.dl_name != 'NULL':
-                    self.geo_dls.append( LevelGeoDisplayList( each_line, scale=current_scale ) )
+                    self.geo_dls.append( current_geo_display_list )
 
-            elif 'GEO_BILLBOARD' in each_line:
+            elif opcode in ( 'GEO_BILLBOARD', 'GEO_BILLBOARD_WITH_PARAMS', 'GEO_BILLBOARD_WITH_PARAMS_AND_DL' ):
                 ## Required for trees to work.
                 pass
 
-            elif 'GEO_RENDER_RANGE' in each_line:
-                near, far = process_line( each_line )
-                if near > 0:
-                    geo_render_range_ignore = True
+            elif opcode == 'GEO_RENDER_RANGE':
+                near, far = args
+                geo_render_range = ( near, far )
+
+            elif opcode == 'GEO_SWITCH_CASE':
+                count, function = args
+                if function == 'geo_switch_area':
+                    switch_area_depth = node_depth + 1
 
-            elif 'GEO_OPEN_NODE' in each_line:
-                if geo_render_range_ignore == True:
+            elif opcode == 'GEO_BRANCH':
+                if switch_area_depth == node_depth:
+                    self.switch_area_branches.append( args[ 1 ] )
+
+            elif opcode == 'GEO_OPEN_NODE':
+                node_depth += 1
+                if geo_render_range is not None:
                     geo_render_range_open_node = True
 
-            elif 'GEO_CLOSE_NODE' in each_line:
+            elif opcode == 'GEO_CLOSE_NODE':
+                if switch_area_depth == node_depth:
+                    switch_area_depth = None
+                node_depth -= 1
                 if geo_render_range_open_node == True:
-                    geo_render_range_ignore = False
+                    geo_render_range = None
                     geo_render_range_open_node = False
 
 
 
 
 class LevelGeoDisplayList():
-    def __init__( self, line, scale=1.0, zbuffer=True, billboard=False ):
+    def __init__( self, command, scale=1.0, zbuffer=True, billboard=False, render_range=None ):
+        """command is an ( opcode, args ) pair from macro_lexer.tokenize_macros.  render_range is the ( near, far ) camera distances the display list is drawn between, or None to always draw it."""
         self.scale = scale
         self.transformation = scale_mat( scale )
         self.zbuffer = zbuffer
         self.billboard = billboard
+        self.render_range = render_range
         self.layer = None
         self.dl_name = None
-        self.parse_cases( line )
+        self.parse_cases( *command )
 
-    def parse_cases( self, code_line ):
+    def parse_cases( self, opcode, args ):
         ## GEO_ANIMATED_PART(layer, x, y, z, displayList)
         ## Note, for level geometry, this is ONLY used for the castle_grounds flags.
         ## Not sure if this is supposed to accumulate between nodes or not.
-        if 'GEO_ANIMATED_PART' in code_line:
-            self.layer, x, y, z, self.dl_name = process_line( code_line )
+        if opcode == 'GEO_ANIMATED_PART':
+            self.layer, x, y, z, self.dl_name = args
 
-        elif 'GEO_DISPLAY_LIST' in code_line:
-            self.layer, self.dl_name = process_line( code_line )
+        elif opcode == 'GEO_DISPLAY_LIST':
+            self.layer, self.dl_name = args
 
 
 
@@ -505,6 +465,21 @@ class Area():
         self.movtex = []
         self.geo = []
         self.level_geo = {}
+        ## For areas split into rooms: the name of the room array, and the collision floors with the room each one is in.
+        self.rooms_name = None
+        self.floors = None
+        self.floor_rooms = None
+
+
+    def set_floors( self, triangles, rooms ):
+        """Keeps the triangles ( n, 3, 3 ) that are floors, along with their rooms.  As in the game, a floor is a triangle whose normal points up by more than 0.01."""
+        if len( rooms ) != len( triangles ):
+            print( "Area", self.index, "of", self.level, "has", len( triangles ), "collision triangles but", len( rooms ), "rooms.  Ignoring its rooms." )
+            return
+        normals = np.cross( triangles[ :, 1 ] - triangles[ :, 0 ], triangles[ :, 2 ] - triangles[ :, 1 ] )
+        is_floor = normals[ :, 1 ] > 0.01 * np.linalg.norm( normals, axis=1 )
+        self.floors = triangles[ is_floor ]
+        self.floor_rooms = np.array( rooms, dtype=np.int16 )[ is_floor ]
 
 
 
@@ -637,9 +612,8 @@ class WaterBox():
 
 def main( mario_source_dir, mario_graphics_dir ):
 
-    level_dir = mario_source_dir / 'levels'
-    
-    level_script_paths = [ i for i in level_dir.glob(  '**/script.c' ) ]
+    index = get_index( mario_source_dir, mario_graphics_dir )
+    level_script_paths = index.glob( 'levels/**/script.c' )
     
     ## Remove level scripts for the intro, ending, and menu
     for i in level_script_paths:
@@ -652,7 +626,7 @@ def main( mario_source_dir, mario_graphics_dir ):
     for each_path in level_script_paths:
         name_ind = each_path.parts.index( 'levels' ) + 1
         name = each_path.parts[ name_ind ]
-        level_scripts[ name ]= LevelScript( each_path )
+        level_scripts[ name ]= LevelScript( each_path, index )
 
     with open( mario_graphics_dir / 'level_scripts.pickle', 'wb' ) as f:
         pickle.dump( level_scripts, f, pickle.HIGHEST_PROTOCOL )
@@ -0,0 +1,89 @@
+import functools
+import re
+
+
+COMMENT_REGEX = re.compile( r'//[^\n]*|/\*.*?\*/', re.DOTALL )
+MACRO_START_REGEX = re.compile( r'([A-Za-z_]\w*)\s*\(' )
+DELIMITER_REGEX = re.compile( r'[(){}\[\],]' )
+## How many blocks of code tokenize_macros keeps the tokens of.  Pool workers run several stages, so the cache has to be bounded.
+TOKEN_CACHE_SIZE = 4096
+
+
+def parse_arg( text ):
+    """Converts a single macro argument into an int ( decimal or hex ) or a float ( with a trailing 'f' ) where possible.  Anything else, such as a symbol name or expression, is returned as a stripped string."""
+    text = text.strip()
+
+    if '0x' in text:
+        try:
+            return int( text, 16 )
+        except ValueError:
+            return text
+
+    try:
+        return int( text )
+    except ValueError:
+        pass
+
+    if text and text[ -1 ] == 'f':
+        try:
+            return float( text[ : -1 ] )
+        except ValueError:
+            pass
+
+    return text
+
+
+def split_args( code, start ):
+    """Splits the arguments of a macro invocation whose opening parenthesis ends at start.  Only commas outside of nested (), {}, and [] separate arguments.  Returns ( list of argument strings, index of the closing parenthesis )."""
+    args = []
+    depth = 0
+    arg_start = start
+    for match in DELIMITER_REGEX.finditer( code, start ):
+        char = match.group()
+        if char in '({[':
+            depth += 1
+        elif char in ')}]':
+            if depth == 0:
+                args.append( code[ arg_start : match.start() ] )
+                return args, match.start()
+            depth -= 1
+        elif depth == 0:
+            args.append( code[ arg_start : match.start() ] )
+            arg_start = match.end()
+
+    ## Unterminated invocation.  Take everything up to the end of the code.
+    args.append( code[ arg_start : ] )
+    return args, len( code )
+
+
+@functools.lru_cache( maxsize=TOKEN_CACHE_SIZE )
+def tokenize_macros( code ):
+    """Tokenizes every top level macro invocation in a block of C code, e.g. the body of a Gfx or GeoLayout struct, into a tuple of ( opcode, args ) pairs.  Comments are skipped, args are converted with parse_arg, and macros nested inside another macro's arguments are left as part of that argument.
+
+    gsSPVertex(bob_seg7_vertex_07000000, 15, 0), /* comment */ gsSP1Triangle( 0,  1,  2, 0x0),
+    becomes
+    ( ( 'gsSPVertex', ( 'bob_seg7_vertex_07000000', 15, 0 ) ), ( 'gsSP1Triangle', ( 0, 1, 2, 0 ) ) )
+
+    Results for the last TOKEN_CACHE_SIZE blocks are cached by source text, so a struct that is reached many times is only tokenized once.  The returned tuples must not be modified."""
+    code = COMMENT_REGEX.sub( ' ', code )
+    commands = []
+    position = 0
+    while True:
+        match = MACRO_START_REGEX.search( code, position )
+        if match is None:
+            break
+        args, end = split_args( code, match.end() )
+        if len( args ) == 1 and args[ 0 ].strip() == '':
+            args = []
+        commands.append( ( match.group( 1 ), tuple( parse_arg( each_arg ) for each_arg in args ) ) )
+        position = end + 1
+
+    return tuple( commands )
+
+
+def tokenize_macro( line ):
+    """Tokenizes a single macro invocation.  Returns ( opcode, args ), or None if there is no invocation in the line."""
+    commands = tokenize_macros( line )
+    if commands:
+        return commands[ 0 ]
+    return None
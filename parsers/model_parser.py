@@ -1,8 +1,12 @@
 from pathlib import Path
 import pickle
-import copy
+import re
+
+import numpy as np
 
 from .level_script_parser import process_line
+from .macro_lexer import COMMENT_REGEX, parse_arg, tokenize_macros
+from .source_index import get_index
 
 
 ########################
@@ -18,23 +22,32 @@ def remove_comment_from_line( code ):
         return code
 
 
-def get_name( code ):
-    """Takes in a block of code corresponding to a struct of either lights, Vtx, or Gfx, and gets the name of the struct."""
-    lines = code.split( '\n' )
-    for each_line in lines:
-        if '//' in each_line:
-            each_line = each_line[ : each_line.find( '//' ) ]
+## Matches the body of a single vertex, e.g. {{{ -1023, 0, 1024}, 0, { 0, 990}, {0x00, 0x7f, 0x00, 0xff}}}
+VERTEX_REGEX = re.compile( r'\{\{\{(.*?)\}\}\}', re.DOTALL )
+
+
+def coerce_array( values, dtype, width=None ):
+    """Converts a list or array of numbers to a numpy array of dtype, rounding floats and wrapping out of range values the same way the N64's C types do.  If width is given, the result has shape ( -1, width )."""
+    array = np.asarray( values )
+    if array.dtype.kind == 'f':
+        array = np.rint( array )
+    array = array.astype( np.int64 ).astype( dtype )
+    if width is not None:
+        array = array.reshape( ( -1, width ) )
+    return array
+
+## Vertex data is stored column by column using the same types as the N64's Vtx struct.
+def as_positions( positions ):
+    return coerce_array( positions, np.int16, 3 )
 
-        if 'Vtx ' in each_line or 'Gfx ' in each_line:
-            if '[]' in each_line:
-                temp_line = [ each_word.strip() for each_word in each_line.split( '[]' ) ]
-                temp_line = temp_line[ 0 ].split( ' ' )
-                return temp_line[ -1 ]
+def as_texel_coordinates( texel_coordinates ):
+    return coerce_array( texel_coordinates, np.int16, 2 )
 
-        elif 'Lights1' in each_line:
-            temp_line = [ each_word.strip() for each_word in each_line.split( '=' ) ]
-            temp_line = temp_line[ 0 ].split( ' ' )
-            return temp_line[ -1 ]
+def as_colours( colours ):
+    return coerce_array( colours, np.uint8, 4 )
+
+def as_triangles( triangles ):
+    return coerce_array( triangles, np.uint16 )
 
 
 
@@ -64,7 +77,8 @@ class RenderSettings():
         copy_object = RenderSettings()
         copy_object.geometry_mode = self.geometry_mode.copy()
         copy_object.combine_mode = self.combine_mode.copy()
-        copy_object.current_lights = copy.deepcopy( self.current_lights )
+        ## The light values themselves are never modified, only replaced, so they can be shared.
+        copy_object.current_lights = self.current_lights.copy()
         copy_object.current_texture = self.current_texture
         copy_object.texture_settings = self.texture_settings.copy()
         copy_object.texture_enable = self.texture_enable
@@ -72,23 +86,25 @@ class RenderSettings():
         copy_object.env_colour = self.env_colour
         return copy_object
 
-    def set_combine_mode( self, combine_line ):
+    ## The setters below take the argument tuple of the corresponding macro, as produced by macro_lexer.tokenize_macros.
+
+    def set_combine_mode( self, args ):
         """
         The combine mode settings are a list of length 2.  The values are strings indicating to the Nintendo 64 GPU how to combine colours.  There are two values because of the triple frame buffering.  Generally the two values are identical, but in rare cases, they are different.
         """
-        self.combine_mode = process_line( combine_line )
+        self.combine_mode = list( args )
 
-    def set_geometry_mode( self, geometry_line ):
+    def set_geometry_mode( self, args ):
         """
         The geometry mode settings are a string of any length.  Usually the settings are changed one at a time, but this is not always the case.  If more than one are changed, they'll be separated by a | sign.  Typical values for SetGeometryMode are G_FOG, G_LIGHTING, G_CULL_BACK, G_SHADING_SMOOTH.
         """
-        geometry_string = process_line( geometry_line )
+        geometry_string = args[ 0 ]
         geometry_args = [ each_arg.strip() for each_arg in geometry_string.split( '|' ) ]
         for each_arg in geometry_args:
             self.geometry_mode[ each_arg ] = True
 
-    def clear_geometry_mode( self, geometry_line ):
-        geometry_string = process_line( geometry_line )
+    def clear_geometry_mode( self, args ):
+        geometry_string = args[ 0 ]
         geometry_args = [ each_arg.strip() for each_arg in geometry_string.split( '|' ) ]
         for each_arg in geometry_args:
             self.geometry_mode[ each_arg ] = False
@@ -96,20 +112,20 @@ class RenderSettings():
         if 'G_LIGHTING' in geometry_args:
             self.current_lights = {}
 
-    def set_current_lights( self, light_line, light_dict ):
+    def set_current_lights( self, opcode, args, light_dict ):
         """
         There are up to 7 or 8 concurrent lights.  This sets a dictionary with keys equal to index and vals equal to light with the light as a list.  Because only one directional light is used at a time, if the length of the list is 3, it's an ambient light, if it's 6, it's a directional light.
         """
         ## There are a few issues of malformed data in the source code.  In particular, the model.inc.c files for koopa, amp, and bully have a couple of issues.
         try:
-            if 'SetLights1' in light_line:
-                name = process_line( light_line )
+            if opcode == 'gsSPSetLights1':
+                name = args[ 0 ]
                 light = light_dict[ name ]
                 self.current_lights[ 1 ] = light.dlights[ 0 ]
                 self.current_lights[ 2 ] = light.a
 
             else:
-                name, index = process_line( light_line )
+                name, index = args
                 name = name[ 1 : ] ## Removes the & at the front.
                 name, attrib = name.split( '.' )
                 light = light_dict[ name ]
@@ -122,37 +138,63 @@ class RenderSettings():
         except:
             pass
 
-    def set_current_texture( self, texture_line ):
-        unused1, unused2, unused3, texture_name = process_line( texture_line )
+    def set_current_texture( self, args ):
+        unused1, unused2, unused3, texture_name = args
         self.current_texture = texture_name
     
-    def load_texture_block( self, temp_line ):
-        texture_name, fmt, siz, width, height, pal, cms, cmt, masks, maskt, shifts, shiftt = process_line( temp_line )
+    def load_texture_block( self, args ):
+        texture_name, fmt, siz, width, height, pal, cms, cmt, masks, maskt, shifts, shiftt = args
         ## Hacky.  There are hex offsets used in some texture names.  This removes the offset and just gets the texture name.
         if ' + ' in texture_name:
             texture_name = texture_name.split()[ 0 ]
         self.current_texture = texture_name
         self.texture_settings = [ fmt, siz, width, 0, 0, pal, cmt, maskt, shiftt, cms, masks, shifts ]
 
-    def set_current_texture_settings( self, texture_settings_line ):
+    def set_current_texture_settings( self, args ):
         ## This is set in the SetTile line.
-        self.texture_settings = [ each_arg for each_arg in process_line( texture_settings_line ) ]
+        self.texture_settings = list( args )
 
-    def set_current_texture_render( self, texture_render_line ):
+    def set_current_texture_render( self, args ):
         ## This is set in gsSPTexture.
         ## Note: s_size and t_size are in .16 format.  So 0xFFFF = 1, basically.
-        s_size, t_size, mipmap_level, tile, texture_enable = process_line( texture_render_line )
+        s_size, t_size, mipmap_level, tile, texture_enable = args
         if texture_enable == 'G_ON':
             self.texture_enable = True
         elif texture_enable == 'G_OFF':
             self.texture_enable = False
         self.texture_render_settings = [ s_size, t_size, mipmap_level, tile ]
 
-    def set_env_colour( self, env_colour_line ):
+    def set_env_colour( self, args ):
         ## This is set by gsDPSetEnvColor and gives a 4-tuple of RGBA.
-        env_r, env_g, env_b, env_a = process_line( env_colour_line )
+        env_r, env_g, env_b, env_a = args
         self.env_colour = ( env_r, env_g, env_b, env_a )
 
+    def lights_key( self ):
+        """Returns the current lights as a hashable, sorted tuple of ( name, light ) pairs."""
+        return tuple( sorted( ( ( str( each_key ), tuple( each_light ) ) for each_key, each_light in self.current_lights.items() ) ) )
+
+    def key( self ):
+        """Returns a hashable snapshot of every setting, used to look up display lists that have already been compiled starting from these settings."""
+        return ( tuple( sorted( self.geometry_mode.items() ) ),
+                 tuple( self.combine_mode ),
+                 self.lights_key(),
+                 self.current_texture,
+                 tuple( self.texture_settings ),
+                 self.texture_enable,
+                 tuple( self.texture_render_settings ),
+                 self.env_colour )
+
+    def render_state_key( self ):
+        """Returns a hashable key of only the settings that RenderSettingsGroup draws with.  Draw lists whose keys match can share a group, and so a vertex list.  Lights only matter when lighting is on.
+
+        This is worked out when asked for rather than stored, since level_fixes changes the settings of draw lists after they're made."""
+        lighting = bool( self.geometry_mode[ 'G_LIGHTING' ] )
+        if lighting:
+            lights = self.lights_key()
+        else:
+            lights = ()
+        return ( lighting, bool( self.geometry_mode.get( 'G_TEXTURE_GEN' ) ), lights, tuple( self.combine_mode ), self.env_colour )
+
     def __eq__( self, other ):
         return ( self.geometry_mode == other.geometry_mode and
                  self.combine_mode == other.combine_mode and
@@ -203,68 +245,43 @@ class Light():
                  self.dlights == other.dlights )
 
 
-class Vertex():
-    """Gets a single vertex from a comma separated string.  Fields are x,y,z, unused bit, tc1 tc2, r,g,b,a.  The game stores vertex normals and vertex colours in the same spot.  So if a vertex is lit, we extract the normal information.  If the vertex is not lit, we extract colour information.  Colours are RGBA."""
-    def __init__( self, source_str=None ):
-        self.pos = [ 0, 0, 0 ]
-        self.tc = [ 0, 0 ]
-        self.rgba = [ 0, 0, 0, 0 ]
-        if source_str is not None:
-            self.process_source( source_str )
-
-    def process_source( self, code ):
-        ## Here, cn stands for either a colour or normal coordinate.
-        x, y, z, unused, tc1, tc2, cn1, cn2, cn3, cn4 = process_line( code )
-        self.pos = [ x, y, z ]
-        self.tc = [ tc1, tc2 ]
-        self.rgba = [ cn1, cn2, cn3, cn4 ]
-
-    def copy( self ):
-        copy_object = Vertex()
-        copy_object.pos = self.pos.copy()
-        copy_object.tc = self.tc.copy()
-        copy_object.rgba = self.rgba.copy()
-        return copy_object
-
-
 class Vtx():
     def __init__( self, source_str=None, name=None, filename=None ):
-        """Takes a string at the beginning of the Vtx declaration source code that ends at the end of the Vtx structure."""
+        """Takes a string at the beginning of the Vtx declaration source code that ends at the end of the Vtx structure.  The vertices are stored as read only arrays of positions, texel coordinates, and colours ( or normals ), one row per vertex."""
         self.filename = filename
         self.name = name
         self.render_settings = None
-        self.vertices = []
+        self.positions = as_positions( [] )
+        self.texel_coordinates = as_texel_coordinates( [] )
+        self.colours = as_colours( [] )
         self.triangles = []
         if source_str is not None:
             self.get_vertices( source_str )
 
     def get_vertices( self, code ):
-
-        temp = code.replace( '{{{', '(' )
-        temp = temp.replace( '}}}', ')' )
-        temp = temp.replace( '{', '' )
-        temp = temp.replace( '}', '' )
-        
-        i = 0
-        while i < len( temp ):
-            if temp.find( '(', i ) == -1:
-                break
-
-            start = temp.find( '(', i )
-            end = temp.find( ')', start ) + 1
-            self.vertices.append( Vertex( temp[ start : end ] ) )
-            i = end
-
-
-    def add_triangle( self, code_line ):
+        ## Here, cn stands for either a colour or normal coordinate.  Each row is x, y, z, unused, tc1, tc2, cn1, cn2, cn3, cn4.
+        rows = []
+        for each_vertex in VERTEX_REGEX.findall( COMMENT_REGEX.sub( ' ', code ) ):
+            each_vertex = each_vertex.replace( '{', '' ).replace( '}', '' )
+            rows.append( [ parse_arg( each_arg ) for each_arg in each_vertex.split( ',' ) ] )
+
+        values = np.array( rows, dtype=np.int64 ).reshape( ( -1, 10 ) )
+        self.positions = as_positions( values[ :, 0 : 3 ] )
+        self.texel_coordinates = as_texel_coordinates( values[ :, 4 : 6 ] )
+        self.colours = as_colours( values[ :, 6 : 10 ] )
+        ## The arrays are shared by every copy of this Vtx and every GfxDrawList made from it, so they must never be modified in place.
+        for each_array in ( self.positions, self.texel_coordinates, self.colours ):
+            each_array.flags.writeable = False
+
+
+    def add_triangle( self, opcode, triangle_args ):
         """
-        Check to see whether the line of code is gsSP2Triangles or gsSP1Triangle.  Use process_line to parse out the triangle data and append to self.triangles.
+        Appends the vertex indices of a gsSP2Triangles or gsSP1Triangle command to self.triangles.
         """
-        triangle_args = process_line( code_line )
-        if '2Triangles' in code_line:
+        if opcode == 'gsSP2Triangles':
             self.triangles += triangle_args[ 0 : 3 ]
             self.triangles += triangle_args[ 4 : 7 ]
-        elif '1Triangle' in code_line:
+        elif opcode == 'gsSP1Triangle':
             self.triangles += triangle_args[ 0 : 3 ]
 
 
@@ -273,7 +290,10 @@ class Vtx():
         copy_object.filename = self.filename
         copy_object.name = self.name
         copy_object.render_settings = self.render_settings
-        copy_object.vertices = [ vertex.copy() for vertex in self.vertices ]
+        ## Vertices are never modified after parsing, so every copy shares the same arrays.  Only the triangles differ between copies.
+        copy_object.positions = self.positions
+        copy_object.texel_coordinates = self.texel_coordinates
+        copy_object.colours = self.colours
         copy_object.triangles = self.triangles.copy()
         return copy_object
 
@@ -294,85 +314,84 @@ Note that there are essentially three kinds of Gfx structs that seem to be used.
 Each Gfx needs to be parsed differently.  The ultimate goal is to get a list of Vertex/Triangle calls with the texture, texture settings, lights, draw layer, combine mode, and geometry mode.  The draw layer will come from the geo files and are not relevant in this particular parsing.
 """
 
+## Commands that only change render settings, mapped to the RenderSettings method that applies them.
+RENDER_SETTINGS_DISPATCH = {
+    'gsDPSetCombineMode' : RenderSettings.set_combine_mode,
+    'gsSPSetGeometryMode' : RenderSettings.set_geometry_mode,
+    'gsSPClearGeometryMode' : RenderSettings.clear_geometry_mode,
+    'gsDPSetTile' : RenderSettings.set_current_texture_settings,
+    'gsSPTexture' : RenderSettings.set_current_texture_render,
+    'gsDPLoadTextureBlock' : RenderSettings.load_texture_block,
+    'gsDPSetTextureImage' : RenderSettings.set_current_texture,
+    'gsDPSetEnvColor' : RenderSettings.set_env_colour,
+}
+
+LIGHT_OPCODES = { 'gsSPSetLights1', 'gsSPLight' }
+TRIANGLE_OPCODES = { 'gsSP1Triangle', 'gsSP2Triangles' }
+
+
 class Gfx():
-    def __init__( self, name, gfx_source_dict, vtx_dict, light_dict ):
+    """dl_cache can be shared between Gfx objects.  It maps ( dl_name, dl_source, incoming render settings key ) of every display list called with gsSPDisplayList to the vertex lists it produced and the render settings it left behind, so a display list called from many places is only walked once for each render state it's called with."""
+    def __init__( self, name, gfx_source_dict, vtx_dict, light_dict, dl_cache=None ):
         self.render_settings = RenderSettings()
         self.name = name
         #self.gfx_source_dict = gfx_source_dict
         self.vertex_lists = []
+        self.dl_cache = {} if dl_cache is None else dl_cache
+        ## The index of the earliest vertex list that triangles have been added to.  Used to tell whether a display list relies on vertices loaded by its caller.
+        self.oldest_vertex_list = 0
         self.process_gfx( self.name, gfx_source_dict, vtx_dict, light_dict )
+        del self.dl_cache
+        del self.oldest_vertex_list
+
+    def call_display_list( self, name, gfx_source_dict, vtx_dict, light_dict ):
+        """Processes a gsSPDisplayList call, reusing the result of an earlier call to the same display list with the same render settings if there was one."""
+        key = ( name, gfx_source_dict[ name ], self.render_settings.key() )
+        cached = self.dl_cache.get( key )
+        if cached is not None:
+            cached_vertex_lists, cached_render_settings = cached
+            for each_vtx in cached_vertex_lists:
+                self.vertex_lists.append( each_vtx.copy() )
+                self.vertex_lists[ -1 ].render_settings = each_vtx.render_settings.copy()
+            self.render_settings = cached_render_settings.copy()
+            return
+
+        start = len( self.vertex_lists )
+        outer_oldest_vertex_list = self.oldest_vertex_list
+        self.oldest_vertex_list = start
+
+        self.process_gfx( name, gfx_source_dict, vtx_dict, light_dict )
+
+        oldest_vertex_list = self.oldest_vertex_list
+        self.oldest_vertex_list = min( outer_oldest_vertex_list, oldest_vertex_list )
+        ## A display list that draws triangles with the caller's vertices depends on more than the render settings, so it can't be reused.
+        if oldest_vertex_list < start:
+            return
+
+        cached_vertex_lists = []
+        for each_vtx in self.vertex_lists[ start : ]:
+            cached_vertex_lists.append( each_vtx.copy() )
+            cached_vertex_lists[ -1 ].render_settings = each_vtx.render_settings.copy()
+        self.dl_cache[ key ] = ( cached_vertex_lists, self.render_settings.copy() )
 
     def process_gfx( self, name, gfx_source_dict, vtx_dict, light_dict ):
         #print( "Starting in", name )
 
-        lines = gfx_source_dict[ name ]
-        curr_line = 0
-        while curr_line != len( lines ):
-
-            temp_line = remove_comment_from_line( lines[ curr_line ] )
-
-            if 'BranchList' in temp_line:
-                #print( "Branching... Current name =", name, "current line =", curr_line )
-                name = process_line( temp_line )
-                lines = gfx_source_dict[ name ]
-                curr_line = 0
-
-
-            if 'EndDisplayList' in temp_line:
-                #print( "Ending", name )
-                return
-
-            elif 'DisplayList' in temp_line:
-                new_name = process_line( temp_line )
-                #print( "Entering", new_name )
-                self.process_gfx( new_name, gfx_source_dict, vtx_dict, light_dict )
+        commands = tokenize_macros( gfx_source_dict[ name ] )
+        curr_command = 0
+        while curr_command < len( commands ):
 
-            elif 'SetCombineMode' in temp_line:
-                self.render_settings.set_combine_mode( temp_line )
-                #print( "Set combine mode:", self.render_settings.combine_mode )
+            opcode, args = commands[ curr_command ]
 
-            elif 'SetGeometryMode' in temp_line:
-                self.render_settings.set_geometry_mode( temp_line )
-                #print( "Set geometry:", self.render_settings.geometry_mode )
+            if opcode in RENDER_SETTINGS_DISPATCH:
+                RENDER_SETTINGS_DISPATCH[ opcode ]( self.render_settings, args )
 
-            elif 'ClearGeometryMode' in temp_line:
-                self.render_settings.clear_geometry_mode( temp_line )
-                #print( "Cleared geometry:", self.render_settings.geometry_mode )
-
-            elif 'SetTile' in temp_line and 'SetTileSize' not in temp_line:
-                self.render_settings.set_current_texture_settings( temp_line )
-                #print( "SetTile settings =", self.render_settings.texture_settings )
-
-            ## Possibly use a more general name than gsSPTexture?  Unfortunately, there would be too many collisions with other Texture names.
-            elif 'gsSPTexture' in temp_line and 'Rectangle' not in temp_line:
-                self.render_settings.set_current_texture_render( temp_line )
-                #print( "Texture render set:", self.render_settings.texture_render_settings )
-                #print( "Texture enable/disable:", self.render_settings.texture_enable )
-
-            elif 'gsDPLoadTextureBlock' in temp_line:
-                self.render_settings.load_texture_block( temp_line )
-
-            elif 'SetTextureImage' in temp_line:
-                self.render_settings.set_current_texture( temp_line )
-                #print( "Newly set texture =", self.render_settings.current_texture )
-
-            elif 'Light' in temp_line and 'NumLights' not in temp_line:
-                self.render_settings.set_current_lights( temp_line, light_dict )
-                #print( "Current lights:", self.render_settings.current_lights )
-
-            elif 'Vertex' in temp_line:
-                current_vertex_name, num_vertices, vertex_start_ind = process_line( temp_line )
-                self.vertex_lists.append( vtx_dict[ current_vertex_name ].copy() )
-                ## Assign the current state of render_settings to the render_settings of the vertex.  We need to copy because we will continue changing self.render_settings.
-                self.vertex_lists[ -1 ].render_settings = self.render_settings.copy()
-                #print( "Set current vertex =", current_vertex_name )
-
-            elif 'Triangle' in temp_line:
-                ## Read ahead to see how far triangle calls go, process all of those lines at once, and then advance curr_line the appropriate amount.
+            elif opcode in TRIANGLE_OPCODES:
+                self.oldest_vertex_list = min( self.oldest_vertex_list, len( self.vertex_lists ) - 1 )
                 if self.render_settings != self.vertex_lists[ -1 ].render_settings:
                     if len( self.vertex_lists[ -1 ].triangles ) == 0:
                         self.vertex_lists[ -1 ].render_settings = self.render_settings.copy()
-                        self.vertex_lists[ -1 ].add_triangle( temp_line )
+                        self.vertex_lists[ -1 ].add_triangle( opcode, args )
 
                     else:
                         ## Get the name of the vertex list in self.vertex_lists[ -1 ]
@@ -381,33 +400,66 @@ class Gfx():
                         self.vertex_lists.append( vtx_dict[ temp_vtx_name ].copy() )
                         ## Copy current render settings.
                         self.vertex_lists[ -1 ].render_settings = self.render_settings.copy()
-                        self.vertex_lists[ -1 ].add_triangle( temp_line )
+                        self.vertex_lists[ -1 ].add_triangle( opcode, args )
 
                 else:
-                    ## Read ahead to see how far triangle calls go, process all of those lines at once, and then advance curr_line the appropriate amount.
-                    self.vertex_lists[ -1 ].add_triangle( temp_line )
-                    while 'Triangle' in lines[ curr_line + 1 ]:
-                        curr_line += 1
-                        temp_line = remove_comment_from_line( lines[ curr_line ] )
-                        self.vertex_lists[ -1 ].add_triangle( temp_line )
+                    ## Read ahead to see how far triangle calls go, process all of those commands at once, and then advance curr_command the appropriate amount.
+                    self.vertex_lists[ -1 ].add_triangle( opcode, args )
+                    while curr_command + 1 < len( commands ) and commands[ curr_command + 1 ][ 0 ] in TRIANGLE_OPCODES:
+                        curr_command += 1
+                        self.vertex_lists[ -1 ].add_triangle( *commands[ curr_command ] )
                     #print( "Triangles added:", self.vertex_lists[ -1 ].triangles )
 
-            elif 'SetEnvColor' in temp_line:
-                self.render_settings.set_env_colour( temp_line )
+            elif opcode == 'gsSPVertex':
+                current_vertex_name, num_vertices, vertex_start_ind = args
+                self.vertex_lists.append( vtx_dict[ current_vertex_name ].copy() )
+                ## Assign the current state of render_settings to the render_settings of the vertex.  We need to copy because we will continue changing self.render_settings.
+                self.vertex_lists[ -1 ].render_settings = self.render_settings.copy()
+                #print( "Set current vertex =", current_vertex_name )
+
+            elif opcode in LIGHT_OPCODES:
+                self.render_settings.set_current_lights( opcode, args, light_dict )
+                #print( "Current lights:", self.render_settings.current_lights )
 
+            elif opcode == 'gsSPDisplayList':
+                #print( "Entering", args[ 0 ] )
+                self.call_display_list( args[ 0 ], gfx_source_dict, vtx_dict, light_dict )
+
+            elif opcode == 'gsSPBranchList':
+                ## A branch never returns, so just continue from the start of the other list.
+                #print( "Branching... Current name =", name, "current command =", curr_command )
+                name = args[ 0 ]
+                commands = tokenize_macros( gfx_source_dict[ name ] )
+                curr_command = 0
+                continue
+
+            elif opcode == 'gsSPEndDisplayList':
+                #print( "Ending", name )
+                return
 
-            curr_line += 1
+            curr_command += 1
 
 
 class GfxDrawList():
+    """A vertex list ready to be sent to OpenGL.  positions, texel_coordinates, and colors are numpy arrays with one row per vertex ( int16 x, y, z, int16 s, t, and uint8 r, g, b, a or normal x, y, z, a ), and triangles is a uint16 array of vertex indices.  Whatever is passed in is converted to those types.  The arrays may be shared with other GfxDrawLists, so replace them rather than modifying them in place."""
     def __init__( self, name, render_settings, triangles, positions, texel_coordinates, colours ):
         self.name = name
         self.render_settings = render_settings
-        self.triangles = triangles
-        self.positions = positions
-        self.texel_coordinates = texel_coordinates
-        self.colors = colours
-                    
+        self.triangles = as_triangles( triangles )
+        self.positions = as_positions( positions )
+        self.texel_coordinates = as_texel_coordinates( texel_coordinates )
+        self.colors = as_colours( colours )
+
+    def remove_vertices( self, keep ):
+        """Keeps only the vertices where the boolean array keep is True, renumbering the triangles to match.  Triangles using a removed vertex are removed."""
+        new_indices = np.cumsum( keep ) - 1
+        triangles = self.triangles.reshape( ( -1, 3 ) )
+        triangles = triangles[ keep[ triangles ].all( axis=1 ) ]
+        self.triangles = as_triangles( new_indices[ triangles ].ravel() )
+        self.positions = self.positions[ keep ]
+        self.texel_coordinates = self.texel_coordinates[ keep ]
+        self.colors = self.colors[ keep ]
+
     def copy( self ):
         copy_triangles = self.triangles.copy()
         copy_positions = self.positions.copy()
@@ -427,14 +479,15 @@ class GfxDrawList():
 
 
 def make_vtx_and_gfx_and_light_dict( mario_source_dir, mario_graphics_dir ):
-    filelist = [ each_path for each_path in mario_source_dir.glob( '**/model.inc.c' ) ]
-    filelist += [ each_path for each_path in mario_source_dir.glob( '**/1.inc.c' ) ]
-    filelist += [ each_path for each_path in mario_source_dir.glob( '**/2.inc.c' ) ]
-    filelist += [ each_path for each_path in mario_source_dir.glob( '**/3.inc.c' ) ]
-    filelist += [ each_path for each_path in mario_source_dir.glob( '**/painting.inc.c' ) ]
-    filelist += [ each_path for each_path in mario_source_dir.glob( '**/movtext.inc.c' ) ]
-    filelist += [ each_path for each_path in mario_source_dir.glob( '**/anim_*.inc.c' ) ]
-    filelist += [ each_path for each_path in ( mario_source_dir / 'levels' ).glob( '**/leveldata.c' ) ]
+    index = get_index( mario_source_dir, mario_graphics_dir )
+    filelist = index.glob( '**/model.inc.c' )
+    filelist += index.glob( '**/1.inc.c' )
+    filelist += index.glob( '**/2.inc.c' )
+    filelist += index.glob( '**/3.inc.c' )
+    filelist += index.glob( '**/painting.inc.c' )
+    filelist += index.glob( '**/movtext.inc.c' )
+    filelist += index.glob( '**/anim_*.inc.c' )
+    filelist += index.glob( 'levels/**/leveldata.c' )
 
     with open( mario_graphics_dir / 'gfxs_called_from_geo.pickle', 'rb' ) as f:
         gfxs_called_from_geo = pickle.load( f )
@@ -447,84 +500,58 @@ def make_vtx_and_gfx_and_light_dict( mario_source_dir, mario_graphics_dir ):
     gfx_source_dict = {}
     gfx_display_dict = {}
     light_dict = {}
+    ## Shared by every Gfx, so display lists used by many models ( segment2, common actor parts ) are compiled once.
+    dl_cache = {}
 
-    light_files = [ each_path for each_path in mario_source_dir.glob( '**/light.inc.c' ) ]
+    light_files = index.glob( '**/light.inc.c' )
     ## Process light files first to build the light_dict.
     for filename in light_files:
-        with open( filename, 'r' ) as f:
-            source = f.read()
-
-        source = source.split( ';' )
-    
-        for each_struct in source:
-            ## Read through the data once and skip Gfx structs.
-            name = get_name( each_struct )
-            if name:
-                name_end_ind = each_struct.find( name ) + len( name )
-
-            if 'DefLights' in each_struct:
-                light_dict[ name ] = Light( each_struct[ name_end_ind : ], name )
+        for kind, name, each_struct in index.get_declarations( filename, 'Lights' ):
+            light_dict[ name ] = Light( each_struct[ each_struct.find( name ) + len( name ) : ], name )
     
     
     ## Process the files into vtx and gfx objects and populate the vtx and gfx dictionaries.
     for filename in filelist:
         current_file_gfxs = []
-        with open( filename, 'r' ) as f:
-            source = f.read()
-    
-        source = source.split( ';' )
+        declarations = index.get_declarations( filename )
     
-        for each_struct in source:
-            ## Read through the data once and skip Gfx structs.
-            name = get_name( each_struct )
-            if name:
-                name_end_ind = each_struct.find( name ) + len( name )
+        for kind, name, each_struct in declarations:
+            name_end_ind = each_struct.find( name ) + len( name )
 
-            if 'Vtx ' in each_struct:
+            if kind == 'Vtx':
                 vtx_dict[ name ] = Vtx( each_struct[ name_end_ind : ], name, filename )
                 #print( 'Processed vertex data:', name )
     
-            elif 'DefLights' in each_struct:
+            elif kind == 'Lights':
                 light_dict[ name ] = Light( each_struct[ name_end_ind : ], name )
                 #print( 'Processed lights data:', name )
 
-            elif 'Gfx ' in each_struct:
-                gfx_source_dict[ name ] = [ each_line for each_line in each_struct.split( '\n' ) ]
+            elif kind == 'Gfx':
+                gfx_source_dict[ name ] = each_struct
 
 
         ## Read through the data again, but only process Gfx structs if they contain "DisplayList"
-        for each_struct in source:
-            if 'Gfx ' in each_struct:
-                name = get_name( each_struct )
+        for kind, name, each_struct in declarations:
+            if kind == 'Gfx':
                 if gfxs_called_from_geo.get( name, False ):
-                    current_file_gfxs.append( Gfx( name, gfx_source_dict, vtx_dict, light_dict ) )
+                    current_file_gfxs.append( Gfx( name, gfx_source_dict, vtx_dict, light_dict, dl_cache ) )
 
                 elif name == 'dl_castle_lobby_wing_cap_light':
-                    current_file_gfxs.append( Gfx( name, gfx_source_dict, vtx_dict, light_dict ) )
+                    current_file_gfxs.append( Gfx( name, gfx_source_dict, vtx_dict, light_dict, dl_cache ) )
 
                 elif filename.stem == 'leveldata':
-                    current_file_gfxs.append( Gfx( name, gfx_source_dict, vtx_dict, light_dict ) )
+                    current_file_gfxs.append( Gfx( name, gfx_source_dict, vtx_dict, light_dict, dl_cache ) )
 
                 elif gfxs_called_from_paintings.get( name, False ):
-                    current_file_gfxs.append( Gfx( name, gfx_source_dict, vtx_dict, light_dict ) )
+                    current_file_gfxs.append( Gfx( name, gfx_source_dict, vtx_dict, light_dict, dl_cache ) )
 
 
-        ## Next, we simply do some preprocessing to put vertex lists into the right format for OpenGL now.  This is done now so that it doesn't have to be done when the game is running, which would increase level load times.
+        ## Next, we simply do some preprocessing to put vertex lists into the right format for OpenGL now.  This is done now so that it doesn't have to be done when the game is running, which would increase level load times.  The vertex arrays are shared with the Vtx, only the triangles are new.
         for each_gfx in current_file_gfxs:
 
             gfx_output_list = []
             for vtx in each_gfx.vertex_lists:
-                current_triangles = vtx.triangles
-                current_names = []
-                current_positions = []
-                current_texels = []
-                current_colours = []
-                for i in range( len( vtx.vertices ) ):
-                    current_positions += vtx.vertices[ i ].pos
-                    current_texels += vtx.vertices[ i ].tc
-                    current_colours += vtx.vertices[ i ].rgba
-
-                gfx_output_list.append( GfxDrawList( vtx.name, vtx.render_settings, current_triangles, current_positions, current_texels, current_colours ) )
+                gfx_output_list.append( GfxDrawList( vtx.name, vtx.render_settings, vtx.triangles, vtx.positions, vtx.texel_coordinates, vtx.colours ) )
 
             gfx_display_dict[ each_gfx.name ] = gfx_output_list
 
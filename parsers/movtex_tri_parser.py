@@ -2,7 +2,9 @@ from pathlib import Path
 import pickle
 
 from .level_script_parser import process_line
-from .model_parser import get_name, RenderSettings, Light, Vertex, Vtx, Gfx, GfxDrawList
+from .model_parser import RenderSettings, Light, Vtx, Gfx, GfxDrawList
+from .source_index import get_index
+from .macro_lexer import tokenize_macros
 
 
 def convert_to_twos_complement( num, bits ):
@@ -12,21 +14,6 @@ def convert_to_twos_complement( num, bits ):
         return num
 
 
-def get_movtex_name( code ):
-    """Takes in a block of code corresponding to a struct of either lights, Vtx, or Gfx, and gets the name of the struct."""
-    lines = code.split( '\n' )
-    for each_line in lines:
-        if '//' in each_line:
-            each_line = each_line[ : each_line.find( '//' ) ]
-
-        if 'Movtex ' in each_line or 'Gfx ' in each_line:
-            if '[]' in each_line:
-                temp_line = [ each_word.strip() for each_word in each_line.split( '[]' ) ]
-                temp_line = temp_line[ 0 ].split( ' ' )
-                return temp_line[ -1 ]
-
-
-
 class Movtex_Tri():
 
     movtex_texture_dict = { 'TEXTURE_WATER' : 'texture_waterbox_water', 'TEXTURE_MIST' : 'texture_waterbox_mist', 'TEXTURE_JRB_WATER' : 'texture_waterbox_jrb_water', 'TEXTURE_UNK_WATER' : 'texture_waterbox_unknown_water', 'TEXTURE_LAVA' : 'texture_waterbox_lava', 'TEX_QUICKSAND_SSL' : 'ssl_quicksand', 'TEX_PYRAMID_SAND_SSL' : 'ssl_pyramid_sand', 'TEX_YELLOW_TRI_TTC' : 'ttc_yellow_triangle' }
@@ -83,14 +70,11 @@ class Movtex_Tri():
 
 
     def parse_tris( self, struct ):
-        triangle_calls = struct.splitlines()
-        for each_line in triangle_calls:
-            if '2Triangles' in each_line:
-                triangle_args = process_line( each_line )
+        for opcode, triangle_args in tokenize_macros( struct ):
+            if opcode == 'gsSP2Triangles':
                 self.triangles += triangle_args[ 0 : 3 ]
                 self.triangles += triangle_args[ 4 : 7 ]
-            elif '1Triangle' in each_line:
-                triangle_args = process_line( each_line )
+            elif opcode == 'gsSP1Triangle':
                 self.triangles += triangle_args[ 0 : 3 ]
         
 
@@ -169,44 +153,32 @@ def is_null_movtex( movtex ):
     return movtex == [0, 0, 0, 'NULL', 'NULL', 'NULL', 'NULL', 0, 0, 0, 0, 0]
 
 
-def build_movtex_dict( mov_source ):
-    structs = mov_source.split( ';' )
-    
+def build_movtex_dict( index, filepath ):
     movtex_dict = {}
     
-    for each_struct in structs:
-        if 'MovtexObject gMovtexNonColored' in each_struct:
-            noncolored_movtexs = parse_movtex_struct( each_struct )
-            for each_noncolored_movtex in noncolored_movtexs:
-                if not is_null_movtex( each_noncolored_movtex ):
-                    movtex_dict[ each_noncolored_movtex[ 0 ] ] = Movtex_Tri( False, each_noncolored_movtex )
-                    
+    for struct_name, coloured in ( ( 'gMovtexNonColored', False ), ( 'gMovtexColored', True ) ):
+        source = index.read_declaration( 'MovtexObject', struct_name, [ filepath ] )
+        if source is None:
+            continue
+        source = ''.join( line for line in source.splitlines( True ) if line.strip()[ : 2 ] != '//' )
     
-        elif 'MovtexObject gMovtexColored' in each_struct:
-            colored_movtexs = parse_movtex_struct( each_struct )
-            for each_colored_movtex in colored_movtexs:
-                if not is_null_movtex( each_colored_movtex ):
-                    movtex_dict[ each_colored_movtex[ 0 ] ] = Movtex_Tri( True, each_colored_movtex )
+        for each_movtex in parse_movtex_struct( source ):
+            if not is_null_movtex( each_movtex ):
+                movtex_dict[ each_movtex[ 0 ] ] = Movtex_Tri( coloured, each_movtex )
 
     return movtex_dict
 
 
 def main( mario_source_dir, mario_graphics_dir ):
 
+    index = get_index( mario_source_dir, mario_graphics_dir )
     filepath = mario_source_dir / 'src' / 'game' / 'moving_texture.c'
     
-    mov_source = ''
-    with open( filepath, 'r' ) as f:
-        for line in f:
-            if line.strip()[ : 2 ] != '//':
-                mov_source += line
-    
-    
-    movtex_dict = build_movtex_dict( mov_source )
+    movtex_dict = build_movtex_dict( index, filepath )
     
     ## Now that we have the dictionary of movtexs, we need to open each movtex.inc.c file and find the corresponding vtx_name and tri_dl structs and parse those out.  We also need to keep track of render settings for begin_dl.  We can ignore end_dl.
     
-    movtex_paths = [ each_path for each_path in mario_source_dir.glob( '**/movtext.inc.c' ) ]
+    movtex_paths = index.glob( '**/movtext.inc.c' )
     ## Of course they split things up into other non-movtext files.
     movtex_paths += [ mario_source_dir / 'levels' / 'ssl' / 'areas' / '2' / '4' / 'model.inc.c' ]
     ## Of course they have one Gfx randomly in a totally different file.
@@ -215,32 +187,26 @@ def main( mario_source_dir, mario_graphics_dir ):
     render_settings_dict = {}
     gfx_source_dict = {}
     
-    for each_path in movtex_paths:
-        with open( each_path, 'r' ) as f:
-            movtext_source = f.read()
-    
-        structs = movtext_source.split( ';' )
-    
-        for each_struct in structs:
-            name = get_movtex_name( each_struct )
-            for each_movtex in movtex_dict.values():
-                if name == each_movtex.tri_dl:
-                    each_movtex.parse_tris( each_struct )
-                elif name == each_movtex.vtx_name:
-                    each_movtex.parse_vtx( each_struct )
-                if name == each_movtex.begin_dl:
-                    if gfx_source_dict.get( name ):
-                        pass
-                    else:
-                        gfx_source_dict[ name ] = [ each_line for each_line in each_struct.split( '\n' ) ]
+    for each_movtex in movtex_dict.values():
+        tri_source = index.read_declaration( 'Gfx', each_movtex.tri_dl, movtex_paths )
+        if tri_source is not None:
+            each_movtex.parse_tris( tri_source )
+        vtx_source = index.read_declaration( 'Movtex', each_movtex.vtx_name, movtex_paths )
+        if vtx_source is not None:
+            each_movtex.parse_vtx( vtx_source )
+        if each_movtex.begin_dl not in gfx_source_dict:
+            begin_source = index.read_declaration( 'Gfx', each_movtex.begin_dl, movtex_paths )
+            if begin_source is not None:
+                gfx_source_dict[ each_movtex.begin_dl ] = begin_source
     
     
     with open( mario_graphics_dir / 'draw_dicts.pickle', 'rb' ) as f:
         vtx_dict, gfx_dict, light_dict, gfx_display_dict = pickle.load( f )
     
     ## We finally have everything in place to get render settings.
+    dl_cache = {}
     for each_dl_name in gfx_source_dict:
-        current_gfx = Gfx( each_dl_name, gfx_source_dict, vtx_dict, light_dict )
+        current_gfx = Gfx( each_dl_name, gfx_source_dict, vtx_dict, light_dict, dl_cache )
         render_settings_dict[ each_dl_name ] = current_gfx.render_settings
     
     ## Add render settings to each movtex and generate a drawlist.
@@ -2,6 +2,7 @@ from pathlib import Path
 import pickle
 
 from .level_script_parser import process_line
+from .source_index import get_index
 
 
 class Painting():
@@ -41,22 +42,14 @@ class Painting():
 
 def main( mario_source_dir, mario_graphics_dir ):
 
-    pathlist = [ each_path for each_path in mario_source_dir.glob( '**/painting.inc.c' ) ]
+    index = get_index( mario_source_dir, mario_graphics_dir )
+    pathlist = index.glob( '**/painting.inc.c' )
     
     paintings_dict = {}
     
     for each_path in pathlist:
-        with open( each_path, 'r' ) as f:
-            source = f.read()
-    
-        structs = source.split( ';' )
-    
-        for each_struct in structs:
-            if 'struct Painting' in each_struct:
-                name_start = each_struct.find( 'struct Painting' ) + len( 'struct Painting' ) + 1
-                name_end = each_struct.find( '=' )
-                name = each_struct[ name_start : name_end ].strip()
-                paintings_dict[ name ] = Painting( name, each_struct[ name_end + 1 : ] )
+        for kind, name, each_struct in index.get_declarations( each_path, 'Painting' ):
+            paintings_dict[ name ] = Painting( name, each_struct[ each_struct.find( '=' ) + 1 : ] )
     
     
     gfxs_called_from_paintings = {}
@@ -0,0 +1,200 @@
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from pathlib import Path
+import importlib
+import time
+
+from .stage_metrics import measure, get_path_size
+
+
+class Stage():
+    """A single setup step.  module_name.main( mario_source_dir, mario_graphics_dir / out_dir ) is called to run it.  inputs and outputs are paths relative to mario_graphics_dir, and are used to work out which stages have to wait on which.  sources are glob patterns relative to mario_source_dir covering every source file the stage reads, and are used to tell whether the stage needs to run again."""
+
+    def __init__( self, name, message, module_name, out_dir, sources, inputs, outputs ):
+        self.name = name
+        self.message = message
+        self.module_name = module_name
+        self.out_dir = out_dir
+        self.sources = sources
+        self.inputs = inputs
+        self.outputs = outputs
+
+
+## The order here is a valid serial order, and is the order used when running with a single job.
+STAGES = [
+    Stage( 'texture_parser', "Parsing textures and building the texture dictionary.", 'parsers.texture_parser', 'pickles',
+        [ '**/*.c', '**/*.png', 'levels/**/*.yaml' ],
+        [],
+        [ 'pickles/m64_dicts.pickle' ] ),
+    Stage( 'model_id_parser', "Parsing models and creating model dictionaries.", 'parsers.model_id_parser', 'pickles',
+        [ 'include/model_ids.h', 'include/macro_presets.h', 'include/macro_preset_names.h', 'include/special_preset_names.h', 'include/special_presets.h' ],
+        [],
+        [ 'pickles/model_dicts.pickle' ] ),
+    Stage( 'level_script_parser', "Parsing level scripts.", 'parsers.level_script_parser', 'pickles',
+        [ 'levels/**/script.c', 'levels/**/geo.inc.c', 'levels/**/collision.inc.c', 'levels/**/macro.inc.c', 'levels/**/movtext.inc.c', 'levels/**/room.inc.c' ],
+        [],
+        [ 'pickles/level_scripts.pickle' ] ),
+    Stage( 'gfx_from_geo_parser', "Parsing gfx data called from level geo.", 'parsers.gfx_from_geo_parser', 'pickles',
+        [ '**/geo.inc.c' ],
+        [],
+        [ 'pickles/gfxs_called_from_geo.pickle' ] ),
+    Stage( 'paintings_parser', "Parsing gfx data called from paintings.", 'parsers.paintings_parser', 'pickles',
+        [ '**/painting.inc.c' ],
+        [],
+        [ 'pickles/paintings.pickle', 'pickles/gfxs_called_from_paintings.pickle' ] ),
+    Stage( 'model_parser', "Parsing vertex, triangle, and draw data.", 'parsers.model_parser', 'pickles',
+        [ '**/model.inc.c', '**/1.inc.c', '**/2.inc.c', '**/3.inc.c', '**/painting.inc.c', '**/movtext.inc.c', '**/anim_*.inc.c', 'levels/**/leveldata.c', '**/light.inc.c' ],
+        [ 'pickles/gfxs_called_from_geo.pickle', 'pickles/gfxs_called_from_paintings.pickle' ],
+        [ 'pickles/draw_dicts.pickle' ] ),
+    Stage( 'skybox_extender', "Converting skyboxes from 248x248 pixels to 256x256.", 'parsers.skybox_extender', '',
+        [ 'textures/skyboxes/*.png' ],
+        [],
+        [ 'skyboxes' ] ),
+    Stage( 'movtex_tri_parser', "Parsing moving texture data.", 'parsers.movtex_tri_parser', 'pickles',
+        [ 'src/game/moving_texture.c', '**/movtext.inc.c', 'levels/ssl/areas/2/4/model.inc.c', 'bin/segment2.c' ],
+        [ 'pickles/draw_dicts.pickle' ],
+        [ 'pickles/movtex_dict.pickle' ] ),
+    Stage( 'geo_parser', "Parsing geo data.", 'parsers.geo_parser', 'pickles',
+        [ '**/geo.inc.c', '**/script*.c', 'actors/**/*.c', 'levels/**/*.c' ],
+        [ 'pickles/model_dicts.pickle' ],
+        [ 'pickles/obj_geo_dicts.pickle' ] ),
+    Stage( 'level_fixes', "Performing level fixes.", 'parsers.level_fixes', 'pickles',
+        [],
+        [ 'pickles/m64_dicts.pickle', 'pickles/model_dicts.pickle', 'pickles/level_scripts.pickle', 'pickles/draw_dicts.pickle', 'pickles/paintings.pickle', 'pickles/movtex_dict.pickle', 'pickles/obj_geo_dicts.pickle' ],
+        [ 'pickles/game_data.store' ] ),
+    Stage( 'level_bake', "Baking level vertex buffers.", 'level_bake', 'baked',
+        [ '**/*.png' ],
+        [ 'pickles/game_data.store' ],
+        [ 'baked' ] ),
+]
+
+
+def get_dependencies( stages ):
+    """Returns a dict of stage name -> set of names of the stages that produce its inputs."""
+    producers = {}
+    for each_stage in stages:
+        for each_output in each_stage.outputs:
+            producers[ each_output ] = each_stage.name
+
+    dependencies = {}
+    for each_stage in stages:
+        dependencies[ each_stage.name ] = { producers[ each_input ] for each_input in each_stage.inputs if each_input in producers }
+
+    return dependencies
+
+
+def run_stage( module_name, mario_source_dir, out_dir, measured=False, profile_path=None ):
+    """Runs a single stage and returns ( wall time, StageMetrics ).  The metrics are None unless measured is True or a profile_path to dump cProfile stats to is given.  This is the function handed to the worker processes, so it only takes picklable arguments."""
+    module = importlib.import_module( module_name )
+    if measured or profile_path is not None:
+        stage_metrics = measure( module.main, mario_source_dir, out_dir, profile_path=profile_path )
+        return stage_metrics.wall_time, stage_metrics
+    start_time = time.perf_counter()
+    module.main( mario_source_dir, out_dir )
+    return time.perf_counter() - start_time, None
+
+
+def check_stage( stage, manifest, force, mario_source_dir, mario_graphics_dir ):
+    """Fingerprints a stage whose inputs are ready.  Returns ( up_to_date, record )."""
+    if manifest is None:
+        return False, None
+    record = manifest.make_record( stage, mario_source_dir, mario_graphics_dir )
+    return not force and manifest.is_up_to_date( stage, record, mario_graphics_dir ), record
+
+
+def get_run_stage_args( stage, mario_source_dir, mario_graphics_dir, metrics, profile_dir ):
+    profile_path = Path( profile_dir ) / ( stage.name + '.prof' ) if profile_dir is not None else None
+    return stage.module_name, mario_source_dir, mario_graphics_dir / stage.out_dir, metrics is not None, profile_path
+
+
+def record_metrics( stage, stage_metrics, metrics, mario_graphics_dir ):
+    if stage_metrics is not None and metrics is not None:
+        stage_metrics.output_bytes = sum( get_path_size( mario_graphics_dir / each_output ) for each_output in stage.outputs )
+        metrics[ stage.name ] = stage_metrics
+
+
+def record_stage( stage, manifest, record, mario_graphics_dir ):
+    if manifest is not None:
+        manifest.update( stage, record, mario_graphics_dir )
+        manifest.save()
+
+
+def run_pipeline( mario_source_dir, mario_graphics_dir, stages=STAGES, jobs=None, manifest=None, force=False, metrics=None, profile_dir=None ):
+    """Runs every stage, starting each one as soon as all of the stages it depends on have finished.  jobs is the size of the process pool (None means one per core), and jobs=1 runs everything in this process in list order.
+
+    If a BuildManifest is given, a stage is skipped when its sources, code, and input pickles all match what they were the last time it ran and its outputs are untouched.  Since inputs are compared by content, a stage that re-runs but writes identical output doesn't cause the stages after it to re-run.  force=True runs everything regardless, but still updates the manifest.
+
+    If a dict is given as metrics, the StageMetrics ( wall and CPU time, peak memory, files and bytes read, and output size ) of each stage that runs are put in it.  With a profile_dir, each stage that runs is also profiled with cProfile and its stats dumped to profile_dir / <stage name>.prof.
+
+    Returns a dict of stage name -> wall time, with None for stages that were skipped."""
+    if profile_dir is not None and metrics is None:
+        metrics = {}
+    dependencies = get_dependencies( stages )
+    timings = {}
+
+    if jobs == 1:
+        for each_stage in stages:
+            up_to_date, record = check_stage( each_stage, manifest, force, mario_source_dir, mario_graphics_dir )
+            if up_to_date:
+                print( "Skipping", each_stage.name, "(up to date).\n" )
+                timings[ each_stage.name ] = None
+                continue
+            print( each_stage.message )
+            timings[ each_stage.name ], stage_metrics = run_stage( *get_run_stage_args( each_stage, mario_source_dir, mario_graphics_dir, metrics, profile_dir ) )
+            record_metrics( each_stage, stage_metrics, metrics, mario_graphics_dir )
+            record_stage( each_stage, manifest, record, mario_graphics_dir )
+            print( "\n", end='' )
+        return timings
+
+    pending = list( stages )
+    running = {}
+    records = {}
+    finished = set()
+
+    with ProcessPoolExecutor( max_workers=jobs ) as pool:
+        while pending or running:
+            ready = [ each_stage for each_stage in pending if dependencies[ each_stage.name ] <= finished ]
+            for each_stage in ready:
+                pending.remove( each_stage )
+                up_to_date, records[ each_stage.name ] = check_stage( each_stage, manifest, force, mario_source_dir, mario_graphics_dir )
+                if up_to_date:
+                    print( "Skipping", each_stage.name, "(up to date).\n" )
+                    timings[ each_stage.name ] = None
+                    finished.add( each_stage.name )
+                    continue
+                print( each_stage.message )
+                future = pool.submit( run_stage, *get_run_stage_args( each_stage, mario_source_dir, mario_graphics_dir, metrics, profile_dir ) )
+                running[ future ] = each_stage
+
+            ## Skipping a stage can make more stages ready without anything having to finish.
+            if not running:
+                assert any( dependencies[ each_stage.name ] <= finished for each_stage in pending ) or not pending, "Stages are waiting on inputs that no stage produces: " + ', '.join( each_stage.name for each_stage in pending )
+                continue
+
+            done, _ = wait( running, return_when=FIRST_COMPLETED )
+            for future in done:
+                each_stage = running.pop( future )
+                try:
+                    timings[ each_stage.name ], stage_metrics = future.result()
+                except:
+                    print( "Stage", each_stage.name, "failed." )
+                    for each_future in running:
+                        each_future.cancel()
+                    raise
+                record_metrics( each_stage, stage_metrics, metrics, mario_graphics_dir )
+                record_stage( each_stage, manifest, records[ each_stage.name ], mario_graphics_dir )
+                finished.add( each_stage.name )
+                print( "Finished", each_stage.name, "in {:.2f}s.\n".format( timings[ each_stage.name ] ) )
+
+    return timings
+
+
+def print_timings( timings, total_time ):
+    name_width = max( len( each_name ) for each_name in timings )
+    print( "Stage timings:" )
+    for each_name, each_time in timings.items():
+        if each_time is None:
+            print( '  ' + each_name.ljust( name_width ), "  up to date" )
+        else:
+            print( '  ' + each_name.ljust( name_width ), "{:8.2f}s".format( each_time ) )
+    print( '  ' + 'sum of stages'.ljust( name_width ), "{:8.2f}s".format( sum( i for i in timings.values() if i is not None ) ) )
+    print( '  ' + 'wall time'.ljust( name_width ), "{:8.2f}s".format( total_time ) )
@@ -3,11 +3,14 @@ import numpy as np
 import os
 from pathlib import Path
 
+from .source_index import get_index
+
 def main( mario_source_dir, mario_graphics_dir ):
 
     mario_skybox_dir = mario_source_dir / 'textures' / 'skyboxes'
 
-    for im_filepath in mario_skybox_dir.glob( '*.png' ):
+    index = get_index( mario_source_dir, mario_graphics_dir / 'pickles' )
+    for im_filepath in index.glob( '*.png', root=mario_skybox_dir ):
     
         im_filename = str( im_filepath.resolve() )
         im = Image.open( im_filename )
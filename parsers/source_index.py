@@ -0,0 +1,261 @@
+from collections import OrderedDict
+from pathlib import Path
+import mmap
+import os
+import pickle
+import re
+
+
+## Matches the start of a top level definition of one of the types the parsers care about, e.g.
+## ALIGNED8 static const Texture bob_seg7_texture_07000000[] = {
+## static const Lights1 bob_seg7_lights_07002800 = gdSPDefLights1(
+## struct Painting bob_painting = {
+DECLARATION_REGEX = re.compile( rb'^[ \t]*(?:ALIGNED8[ \t]+)?(?:(?:static|const|UNUSED)[ \t]+)*(?:struct[ \t]+)?(Texture|Vtx|Gfx|Lights\d|GeoLayout|LevelScript|MovtexObject|MovtexQuadCollection|Movtex|Painting)[ \t]+(?:const[ \t]+)?(\w+)[ \t]*(?:\[[^\]\n]*\])?[ \t]*=', re.MULTILINE )
+
+## Matches a comment or a semicolon, so the semicolon that ends a declaration can be found without stopping at one inside a comment.
+DECLARATION_END_REGEX = re.compile( rb'/\*.*?\*/|//[^\n]*|;', re.DOTALL )
+
+INDEX_FILENAME = 'source_index.pickle'
+
+## Most file contents the index keeps in memory at once.  Big enough to hold every geo, script, and movtext file, which are the ones more than one stage reads.
+READ_CACHE_BYTES = 128 * 2**20
+
+
+def glob_to_regex( pattern ):
+    """Converts a pathlib style glob pattern ( '**/' matches zero or more directories ) into a compiled regex that matches posix style relative paths."""
+    regex = ''
+    i = 0
+    while i < len( pattern ):
+        if pattern[ i : i + 3 ] == '**/':
+            regex += '(?:.*/)?'
+            i += 3
+        elif pattern[ i ] == '*':
+            regex += '[^/]*'
+            i += 1
+        elif pattern[ i ] == '?':
+            regex += '[^/]'
+            i += 1
+        else:
+            regex += re.escape( pattern[ i ] )
+            i += 1
+    return re.compile( regex + r'\Z' )
+
+
+def scan_declarations( path ):
+    """Memory maps a file and returns a list of ( kind, name, start, end ) for every declaration in it, in file order.  start and end are byte offsets, with end at the first semicolon after the start that isn't in a comment, so the span is the declaration without the semicolon that closes it."""
+    declarations = []
+    with open( path, 'rb' ) as f:
+        try:
+            data = mmap.mmap( f.fileno(), 0, access=mmap.ACCESS_READ )
+        except ValueError:
+            ## Empty files can't be mapped.
+            return declarations
+
+        with data:
+            for match in DECLARATION_REGEX.finditer( data ):
+                kind = match.group( 1 ).decode()
+                if kind[ : 6 ] == 'Lights':
+                    kind = 'Lights'
+                end = len( data )
+                for end_match in DECLARATION_END_REGEX.finditer( data, match.end() ):
+                    if end_match.group() == b';':
+                        end = end_match.start()
+                        break
+                declarations.append( ( kind, match.group( 2 ).decode(), match.start(), end ) )
+
+    return declarations
+
+
+
+class SourceIndex():
+    """A listing of every file in the sm64 source tree, made with a single walk, along with the location of every Texture, Vtx, Gfx, Lights, GeoLayout, LevelScript, Movtex, and Painting declaration in the .c files.
+
+    Paths are stored relative to the source directory as posix strings.  Parsers use glob() in place of Path.glob(), and get the text of each struct with get_declarations() or read_declaration() rather than splitting whole files themselves.  Files are read through a cache of up to READ_CACHE_BYTES that lives as long as the process, so a file shared by several stages run in the same process, such as a geo.inc.c, is read from disk once.  The index is saved to pickles/source_index.pickle and on the next setup only files whose size or mtime changed are scanned again."""
+
+    version = 3
+
+    def __init__( self, mario_source_dir ):
+        self.root = Path( mario_source_dir )
+        self.files = {}         ## rel_path -> ( size, mtime_ns )
+        self.paths = []         ## sorted rel_paths
+        self.declarations = {}  ## rel_path -> [ ( kind, name, start, end ), ... ]
+        self.by_name = None     ## ( kind, name ) -> [ ( rel_path, start, end ), ... ], built on first use
+        self.data_cache = OrderedDict()
+        self.cached_bytes = 0
+
+
+    def __getstate__( self ):
+        state = self.__dict__.copy()
+        state[ 'by_name' ] = None
+        state[ 'data_cache' ] = OrderedDict()
+        state[ 'cached_bytes' ] = 0
+        return state
+
+
+    def update( self ):
+        """Walks the source tree and scans any .c file that is new or has changed since the index was last updated.  Returns the number of files scanned."""
+        files = {}
+        for root, dirs, filenames in os.walk( self.root ):
+            dirs[ : ] = [ i for i in dirs if i != '.git' ]
+            rel_root = Path( root ).relative_to( self.root ).as_posix()
+            for each_filename in filenames:
+                rel_path = each_filename if rel_root == '.' else rel_root + '/' + each_filename
+                try:
+                    stat = os.stat( os.path.join( root, each_filename ) )
+                except OSError:
+                    continue
+                files[ rel_path ] = ( stat.st_size, stat.st_mtime_ns )
+
+        scanned = 0
+        declarations = {}
+        for rel_path, each_stat in files.items():
+            if rel_path[ -2 : ] != '.c':
+                continue
+            if self.files.get( rel_path ) == each_stat and rel_path in self.declarations:
+                declarations[ rel_path ] = self.declarations[ rel_path ]
+            else:
+                declarations[ rel_path ] = scan_declarations( self.root / rel_path )
+                scanned += 1
+
+        self.files = files
+        self.paths = sorted( files )
+        self.declarations = declarations
+        self.by_name = None
+        self.clear_cache()
+        return scanned
+
+
+    def relative( self, path ):
+        try:
+            return Path( path ).relative_to( self.root ).as_posix()
+        except ValueError:
+            return Path( path ).resolve().relative_to( self.root.resolve() ).as_posix()
+
+
+    def glob( self, pattern, root=None ):
+        """Same as Path( root ).glob( pattern ) ( root defaults to the source directory ), but answered from the index.  Results are sorted."""
+        if root is not None:
+            prefix = self.relative( root )
+            if prefix != '.':
+                pattern = prefix + '/' + pattern
+        regex = glob_to_regex( pattern )
+        return [ self.root / each_path for each_path in self.paths if regex.match( each_path ) ]
+
+
+    def read_bytes( self, path ):
+        """Returns the contents of a file, reading it from disk only if it isn't in the cache.  The least recently used files are dropped once the cache holds more than READ_CACHE_BYTES."""
+        key = str( path )
+        data = self.data_cache.get( key )
+        if data is not None:
+            self.data_cache.move_to_end( key )
+            return data
+
+        with open( path, 'rb' ) as f:
+            data = f.read()
+        self.data_cache[ key ] = data
+        self.cached_bytes += len( data )
+        while self.cached_bytes > READ_CACHE_BYTES and len( self.data_cache ) > 1:
+            _, dropped = self.data_cache.popitem( last=False )
+            self.cached_bytes -= len( dropped )
+        return data
+
+
+    def read( self, path ):
+        """Returns the text of a whole file, for parsers that go through a file line by line rather than struct by struct."""
+        return self.read_bytes( path ).decode()
+
+
+    def clear_cache( self ):
+        self.data_cache = OrderedDict()
+        self.cached_bytes = 0
+
+
+    def files_declaring( self, kind ):
+        """Returns the paths of every file that declares at least one of kind."""
+        return [ self.root / rel_path for rel_path, each_declarations in sorted( self.declarations.items() ) if any( i[ 0 ] == kind for i in each_declarations ) ]
+
+
+    def get_declarations( self, path, kind=None ):
+        """Returns a list of ( kind, name, source ) for every declaration in a file, or only those of kind if it's given, in file order.  source is the text of the declaration without its closing semicolon."""
+        each_declarations = self.declarations.get( self.relative( path ), [] )
+        if kind is not None:
+            each_declarations = [ i for i in each_declarations if i[ 0 ] == kind ]
+        if not each_declarations:
+            return []
+
+        data = self.read_bytes( path )
+        return [ ( each_kind, name, data[ start : end ].decode() ) for each_kind, name, start, end in each_declarations ]
+
+
+    def find( self, kind, name, paths=None ):
+        """Returns ( path, start, end ) for the declaration of kind called name, or None if there isn't one.  If a list of paths is given only those files are searched, in that order, otherwise the first file in path order that declares it is used."""
+        if self.by_name is None:
+            self.by_name = {}
+            for rel_path in sorted( self.declarations ):
+                for each_kind, each_name, start, end in self.declarations[ rel_path ]:
+                    self.by_name.setdefault( ( each_kind, each_name ), [] ).append( ( rel_path, start, end ) )
+
+        locations = self.by_name.get( ( kind, name ), [] )
+        if paths is not None:
+            locations = { i[ 0 ] : i for i in reversed( locations ) }
+            locations = [ locations[ rel_path ] for rel_path in ( self.relative( each_path ) for each_path in paths ) if rel_path in locations ]
+
+        if not locations:
+            return None
+        rel_path, start, end = locations[ 0 ]
+        return self.root / rel_path, start, end
+
+
+    def read_declaration( self, kind, name, paths=None ):
+        """Returns the text of the declaration of kind called name without its closing semicolon, or None if there isn't one.  paths is the same as for find().  Only the file that holds the declaration is read."""
+        location = self.find( kind, name, paths )
+        if location is None:
+            return None
+        path, start, end = location
+        return self.read_bytes( path )[ start : end ].decode()
+
+
+_index = None
+
+def load_index( mario_source_dir, index_dir ):
+    """Loads the index saved in index_dir by setup.  Returns an empty index if there isn't one for mario_source_dir."""
+    mario_source_dir = Path( mario_source_dir )
+    try:
+        with open( Path( index_dir ) / INDEX_FILENAME, 'rb' ) as f:
+            index = pickle.load( f )
+        if index.version == SourceIndex.version and index.root.resolve() == mario_source_dir.resolve():
+            index.root = mario_source_dir
+            return index
+    except:
+        pass
+    return SourceIndex( mario_source_dir )
+
+
+def get_index( mario_source_dir, index_dir=None ):
+    """Returns the SourceIndex for mario_source_dir, loading it from index_dir if it was saved there by setup, and building it otherwise.  The index is kept for the life of the process so every parser in it shares the same walk and file cache."""
+    global _index
+    mario_source_dir = Path( mario_source_dir )
+    if _index is not None and _index.root == mario_source_dir:
+        return _index
+
+    index = SourceIndex( mario_source_dir ) if index_dir is None else load_index( mario_source_dir, index_dir )
+    if not index.files:
+        index.update()
+
+    _index = index
+    return _index
+
+
+def build_index( mario_source_dir, index_dir ):
+    """Brings the saved index up to date with the source tree and writes it back.  Setup calls this once before running any parser.  Returns the index and the number of files that had to be scanned."""
+    global _index
+    index = load_index( mario_source_dir, index_dir )
+    scanned = index.update()
+
+    temp_path = Path( index_dir ) / ( INDEX_FILENAME + '.tmp' )
+    with open( temp_path, 'wb' ) as f:
+        pickle.dump( index, f, pickle.HIGHEST_PROTOCOL )
+    os.replace( temp_path, Path( index_dir ) / INDEX_FILENAME )
+
+    _index = index
+    return index, scanned
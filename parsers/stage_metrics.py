@@ -0,0 +1,130 @@
+from pathlib import Path
+import builtins
+import cProfile
+import io
+import os
+import time
+
+
+def get_peak_rss_mb():
+    """Peak resident set size of this process in MB, or None if the platform doesn't say."""
+    try:
+        with open( '/proc/self/status' ) as f:
+            for each_line in f:
+                if each_line.startswith( 'VmHWM:' ):
+                    return int( each_line.split()[ 1 ] ) / 1024
+    except:
+        pass
+    try:
+        import resource
+        return resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss / 1024
+    except:
+        return None
+
+
+def reset_peak_rss():
+    """Resets the peak resident set size, so the next get_peak_rss_mb is the peak since now rather than since the process started.  Returns False if it can't be reset ( anywhere but Linux ), in which case peaks only ever go up."""
+    try:
+        with open( '/proc/self/clear_refs', 'w' ) as f:
+            f.write( '5' )
+        return True
+    except:
+        return False
+
+
+def get_path_size( path ):
+    """Size in bytes of a file, or of every file under a directory.  0 if path doesn't exist."""
+    path = Path( path )
+    if path.is_file():
+        return path.stat().st_size
+    return sum( each_path.stat().st_size for each_path in path.rglob( '*' ) if each_path.is_file() )
+
+
+
+class StageMetrics():
+    """What running one setup stage cost.  Times are in seconds.  files_read counts every open() for reading, and bytes_read is the total size of those files, so a file opened twice counts twice.  output_bytes is the size of the stage's outputs and profile_path is where its cProfile stats were dumped, if they were."""
+    def __init__( self, wall_time, cpu_time, peak_rss_mb, files_read, bytes_read, profile_path=None ):
+        self.wall_time = wall_time
+        self.cpu_time = cpu_time
+        self.peak_rss_mb = peak_rss_mb
+        self.files_read = files_read
+        self.bytes_read = bytes_read
+        self.output_bytes = None
+        self.profile_path = profile_path
+
+
+
+class FileReadCounter():
+    """Counts the files opened for reading, through open(), io.open(), or Path.open(), while in a with block.  Only meant to be used by one thread at a time, which is how stages run."""
+    def __init__( self ):
+        self.files_read = 0
+        self.bytes_read = 0
+        self.original_open = None
+
+
+    def counting_open( self, file, mode='r', *args, **kwargs ):
+        f = self.original_open( file, mode, *args, **kwargs )
+        if 'r' in mode and '+' not in mode:
+            self.files_read += 1
+            try:
+                self.bytes_read += os.fstat( f.fileno() ).st_size
+            except:
+                pass
+        return f
+
+
+    def __enter__( self ):
+        self.original_open = builtins.open
+        builtins.open = self.counting_open
+        io.open = self.counting_open
+        return self
+
+
+    def __exit__( self, *exc_info ):
+        builtins.open = self.original_open
+        io.open = self.original_open
+        return False
+
+
+
+def measure( function, *args, profile_path=None ):
+    """Calls function( *args ) and returns its StageMetrics.  With a profile_path, function is run under cProfile and the stats are dumped there, for use with pstats or snakeviz."""
+    peak_rss_reset = reset_peak_rss()
+    profiler = cProfile.Profile() if profile_path is not None else None
+
+    with FileReadCounter() as counter:
+        start_time = time.perf_counter()
+        start_cpu_time = time.process_time()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            function( *args )
+        finally:
+            if profiler is not None:
+                profiler.disable()
+        cpu_time = time.process_time() - start_cpu_time
+        wall_time = time.perf_counter() - start_time
+
+    if profiler is not None:
+        os.makedirs( Path( profile_path ).parent, exist_ok=True )
+        profiler.dump_stats( str( profile_path ) )
+
+    ## Without a reset the peak may be left over from an earlier stage run by the same process.
+    peak_rss_mb = get_peak_rss_mb() if peak_rss_reset else None
+    return StageMetrics( wall_time, cpu_time, peak_rss_mb, counter.files_read, counter.bytes_read, profile_path )
+
+
+def print_metrics( metrics ):
+    """Prints a table of stage name -> StageMetrics, one row per stage that ran, slowest first."""
+    if not metrics:
+        return
+    name_width = max( len( each_name ) for each_name in metrics )
+    print( "Stage metrics:" )
+    print( '  ' + 'stage'.ljust( name_width ), "{:>9} {:>9} {:>10} {:>8} {:>10} {:>10}".format( 'wall', 'cpu', 'peak rss', 'files', 'read', 'output' ) )
+    for each_name, each_metrics in sorted( metrics.items(), key=lambda item: -item[ 1 ].wall_time ):
+        peak_rss = "{:8.1f}MB".format( each_metrics.peak_rss_mb ) if each_metrics.peak_rss_mb is not None else "{:>10}".format( '-' )
+        output = "{:8.2f}MB".format( each_metrics.output_bytes / 2**20 ) if each_metrics.output_bytes is not None else "{:>10}".format( '-' )
+        print( '  ' + each_name.ljust( name_width ), "{:8.2f}s {:8.2f}s {} {:8d} {:8.2f}MB {}".format( each_metrics.wall_time, each_metrics.cpu_time, peak_rss, each_metrics.files_read, each_metrics.bytes_read / 2**20, output ) )
+    profile_paths = [ each_metrics.profile_path for each_metrics in metrics.values() if each_metrics.profile_path is not None ]
+    if profile_paths:
+        print( "  cProfile stats written to", Path( profile_paths[ 0 ] ).parent )
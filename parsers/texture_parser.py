@@ -1,7 +1,12 @@
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+import os
 import pickle
+import re
 
-def make_skybox_and_name_dictionaries( mario_source_dir ):
+from .source_index import get_index
+
+def make_skybox_and_name_dictionaries( mario_source_dir, index ):
 
     levels_dir = mario_source_dir / 'levels'
     
@@ -21,7 +26,7 @@ def make_skybox_and_name_dictionaries( mario_source_dir ):
     name_dict = {}
     
     ## Process level.yaml first to get level names and skybox names.
-    for f in levels_dir.glob( "**/*.yaml" ):
+    for f in index.glob( "**/*.yaml", root=levels_dir ):
         yaml_files.append( f )
     
     
@@ -30,8 +35,7 @@ def make_skybox_and_name_dictionaries( mario_source_dir ):
     level_textures = []
     skybox_bins = []
     for each_file in yaml_files:
-        with open( each_file, 'r' ) as f:
-            yaml = f.read()
+        yaml = index.read( each_file )
     
         short_name_ind = yaml.find( 'short-name:' ) + 1
         end_name = yaml.find( '\n', short_name_ind + len( 'short-name:' ) )
@@ -62,76 +66,58 @@ def make_skybox_and_name_dictionaries( mario_source_dir ):
     return name_dict, skybox_dict
 
 
-def make_texture_dictionary( mario_source_dir ):
+## Matches a texture declaration along with the file it includes, e.g.
+## ALIGNED8 static const Texture bob_seg7_texture_07000000[] = {
+## #include "levels/bob/0.rgba16.inc.c"
+## which covers 'ALIGNED8 const Texture', 'ALIGNED8 static const Texture', 'ALIGNED8 static Texture', and 'const Texture'.
+TEXTURE_REGEX = re.compile( rb'(?:const|ALIGNED8 static) Texture (\w+)\[[^\]]*\]\s*=\s*\{\s*#include\s*"([^"]+)"' )
+
+## Number of threads used to read and scan source files.  Reading dominates on network filesystems and releases the GIL.
+SCAN_THREADS = 4
+
+
+def find_texture_declarations( path ):
+    """Returns a list of ( texture_name, included_filename ) for every texture declared in a source file."""
+    try:
+        with open( path, 'rb' ) as f:
+            source = f.read()
+    except OSError:
+        return []
+
+    return [ ( match.group( 1 ).decode(), match.group( 2 ).decode() ) for match in TEXTURE_REGEX.finditer( source ) ]
+
+
+def make_texture_dictionary( mario_source_dir, index, threads=SCAN_THREADS ):
 
     ## Next process texture includes
     texture_dict = {}
-    
-    bin_files = []
-    for f in mario_source_dir.glob( "**/*.c" ):
-        bin_files.append( f )
-    
+
+    ## Only files the index saw a Texture declaration in need to be read.
+    bin_files = index.files_declaring( 'Texture' )
+
+    if threads > 1:
+        with ThreadPoolExecutor( max_workers=threads ) as pool:
+            declarations = list( pool.map( find_texture_declarations, bin_files ) )
+    else:
+        declarations = [ find_texture_declarations( each_file ) for each_file in bin_files ]
+
     tot_textures = 0
     textures_found = 0
-    found_textures = []
-    
-    for each_file in bin_files:
-        with open( each_file, 'r' ) as f:
-            try:
-                source = f.read()
-            except:
-                continue
-    
-        match_str1 = 'ALIGNED8 const Texture '
-        match_str2 = 'ALIGNED8 static const Texture '
-        match_str3 = 'ALIGNED8 static Texture '
-        match_str4 = 'const Texture '
-        m1_len = len( match_str1 )
-        m2_len = len( match_str2 )
-        m3_len = len( match_str3 )
-        m4_len = len( match_str4 )
-    
-        i = 0
-        while i < len( source ):
-            
-            check1 = source[ i : i + m1_len ] == match_str1
-            check2 = source[ i : i + m2_len ] == match_str2
-            check3 = source[ i : i + m3_len ] == match_str3
-            check4 = source[ i : i + m4_len ] == match_str4
-    
-            if check1 or check2 or check3 or check4:
-                end_name = source.find( '[', i )
-                if check1:
-                    texture_name = source[ i + m1_len : end_name ]
-    
-                if check2:
-                    texture_name = source[ i + m2_len : end_name ]
-    
-                if check3:
-                    texture_name = source[ i + m3_len : end_name ]
+    found_textures = set()
+    resolved_source_dir = mario_source_dir.resolve()
 
-                if check4 and not check1:
-                    texture_name = source[ i + m4_len : end_name ]
-    
-                start_texture_file = source.find( '"', end_name ) + 1
-                end_texture_file = source.find( '"', start_texture_file + 1 )
-                texture_filename = source[ start_texture_file : end_texture_file ]
-                texture_filename_png = texture_filename[ : -5 ] + 'png'
-                ## Test texture_filename_png to make sure we have it:
-                try:
-                    with open( mario_source_dir / texture_filename_png, 'rb' ) as g:
-                        g.read()
-                        textures_found += 1
-                        found_textures.append( str( ( mario_source_dir / texture_filename_png ).resolve() ) )
-                        texture_dict[ texture_name ] = str( ( mario_source_dir / texture_filename_png ).resolve() )
-                except:
-                    pass
-                    #print( 'Missing', texture_name, texture_filename_png )
-    
-                tot_textures += 1
-    
-    
-            i += 1
+    for each_file_declarations in declarations:
+        for texture_name, texture_filename in each_file_declarations:
+            texture_filename_png = texture_filename[ : -5 ] + 'png'
+            ## Test texture_filename_png to make sure we have it.  The index already has a listing of the tree, so this usually doesn't touch the disk.
+            if texture_filename_png in index.files or os.path.isfile( mario_source_dir / texture_filename_png ):
+                textures_found += 1
+                found_textures.add( str( resolved_source_dir / texture_filename_png ) )
+                texture_dict[ texture_name ] = str( resolved_source_dir / texture_filename_png )
+            #else:
+                #print( 'Missing', texture_name, texture_filename_png )
+
+            tot_textures += 1
     
     
     folders = [ str( ( mario_source_dir / 'textures' ).resolve() ) ]
@@ -159,8 +145,9 @@ def make_texture_dictionary( mario_source_dir ):
 
 def main( mario_source_dir, mario_graphics_dir ):
 
-    texture_dict = make_texture_dictionary ( mario_source_dir )
-    name_dict, skybox_dict = make_skybox_and_name_dictionaries( mario_source_dir )
+    index = get_index( mario_source_dir, mario_graphics_dir )
+    texture_dict = make_texture_dictionary ( mario_source_dir, index )
+    name_dict, skybox_dict = make_skybox_and_name_dictionaries( mario_source_dir, index )
 
     with open( mario_graphics_dir / 'm64_dicts.pickle', 'wb' ) as f:
         pickle.dump( [ skybox_dict, texture_dict, name_dict ], f, pickle.HIGHEST_PROTOCOL )
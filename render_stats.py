@@ -0,0 +1,167 @@
+from collections import deque
+import csv
+import json
+import os
+import time
+
+import pyglet
+
+from gl_state import gl_state
+from culling import LevelBatch
+
+
+## Sections of a frame whose CPU time is recorded, in the order they happen.
+SECTIONS = [ 'camera', 'skybox', 'cull', 'level', 'occlude', 'menu' ]
+## Columns of an exported frame, after the sections.
+COUNTERS = [ 'draw_calls', 'group_switches', 'vertices', 'texture_binds', 'gl_calls', 'gl_calls_elided', 'units_culled', 'units_out_of_range', 'units_in_other_rooms', 'units_occluded' ]
+
+
+def count_batch( batch ):
+    """Walks a batch the same way pyglet does when drawing it.  Returns ( draw calls, group switches, vertices ).  Each domain is a single glDrawElements or glMultiDrawElements, each group visited costs a set_state and an unset_state, and vertices counts the indices submitted."""
+    draw_calls = 0
+    group_switches = 0
+    vertices = 0
+    to_visit = [ each_group for each_group in batch.top_groups if each_group.visible ]
+    while to_visit:
+        group = to_visit.pop()
+        domain_map = batch.group_map.get( group, {} )
+        children = [ each_child for each_child in batch.group_children.get( group, [] ) if each_child.visible ]
+        if domain_map or children:
+            group_switches += 1
+        for ( formats, mode, indexed ), domain in domain_map.items():
+            if indexed:
+                sizes = domain.index_allocator.get_allocated_regions()[ 1 ]
+            else:
+                sizes = domain.allocator.get_allocated_regions()[ 1 ]
+            if sizes:
+                draw_calls += 1
+                vertices += sum( sizes )
+        to_visit += children
+    return draw_calls, group_switches, vertices
+
+
+
+class RenderStats():
+    """Per frame CPU time of each section of GameWindow.on_draw and on_update, along with what the level batch submitted: draw calls, group switches, vertices, texture binds, and GL state calls made and skipped by gl_state.
+
+    The last history_length frames are kept, so they can be exported as CSV or JSON, and the overlay shows averages over the last second, refreshed every update_period seconds.  Batch counts are only worked out again when the batch changes or invalidate_batch is called."""
+    def __init__( self, window, export_dir, font=None, history_length=1000, update_period=0.25 ):
+        self.window = window
+        self.export_dir = export_dir
+        self.history = deque( maxlen=history_length )
+        self.update_period = update_period
+        self.show_overlay = False
+
+        self.frame = None
+        self.section_starts = {}
+        self.last_frame_start = None
+        self.batch = None
+        self.batch_counts = ( 0, 0, 0 )
+        self.last_overlay_update = 0.0
+        self.overlay_label = pyglet.text.Label( '', font_name=font, font_size=12, x=10, y=window.height - 10, anchor_y='top', multiline=True, width=600, color=( 255, 255, 255, 255 ) )
+
+
+    def begin_frame( self, batch ):
+        """Starts recording a frame.  The previous frame is finished first."""
+        now = time.perf_counter()
+        if self.frame is not None:
+            self.end_frame( now )
+
+        if batch is not self.batch:
+            self.batch = batch
+            self.invalidate_batch()
+
+        self.frame = { each_section : 0.0 for each_section in SECTIONS }
+        self.frame[ 'frame' ] = 0.0 if self.last_frame_start is None else now - self.last_frame_start
+        self.frame[ 'time' ] = time.time()
+        self.last_frame_start = now
+
+
+    def end_frame( self, now ):
+        ## gl_state counts are per level batch draw, which is finished by the time the next frame starts.
+        draw_calls, group_switches, vertices = self.batch_counts
+        units_culled = 0
+        units_out_of_range = 0
+        units_in_other_rooms = 0
+        units_occluded = 0
+        ## A culled level batch only submits the indices of the units in view, and skips domains with none in view.
+        if isinstance( self.batch, LevelBatch ) and self.batch.visible is not None:
+            draw_calls = self.batch.draw_calls
+            vertices = self.batch.indices_drawn
+            units_culled = self.batch.units_culled
+            units_out_of_range = self.batch.units_out_of_range
+            units_in_other_rooms = self.batch.units_in_other_rooms
+            units_occluded = self.batch.units_occluded
+        self.frame.update( { 'draw_calls' : draw_calls, 'group_switches' : group_switches, 'vertices' : vertices, 'texture_binds' : gl_state.texture_binds, 'gl_calls' : gl_state.issued, 'gl_calls_elided' : gl_state.elided, 'units_culled' : units_culled, 'units_out_of_range' : units_out_of_range, 'units_in_other_rooms' : units_in_other_rooms, 'units_occluded' : units_occluded } )
+        self.history.append( self.frame )
+        self.frame = None
+
+
+    def invalidate_batch( self ):
+        """Counts the batch again.  Call this when what the batch draws changes without the batch itself changing."""
+        self.batch_counts = count_batch( self.batch ) if self.batch is not None else ( 0, 0, 0 )
+
+
+    def start( self, section ):
+        self.section_starts[ section ] = time.perf_counter()
+
+
+    def stop( self, section ):
+        """Adds the time since start( section ) to the frame being recorded.  Sections timed outside of on_draw, like camera updates in on_update, count towards the last frame drawn."""
+        elapsed = time.perf_counter() - self.section_starts.pop( section )
+        if self.frame is not None:
+            self.frame[ section ] += elapsed
+
+
+    def toggle_overlay( self ):
+        self.show_overlay = not self.show_overlay
+
+
+    def get_averages( self, seconds ):
+        now = time.time()
+        frames = [ each_frame for each_frame in self.history if now - each_frame[ 'time' ] <= seconds ] or list( self.history )[ -1 : ]
+        if not frames:
+            return None
+        return { each_key : sum( each_frame[ each_key ] for each_frame in frames ) / len( frames ) for each_key in [ 'frame' ] + SECTIONS + COUNTERS }
+
+
+    def update_overlay( self ):
+        averages = self.get_averages( 1.0 )
+        if averages is None:
+            return
+        lines = [ "frame {:7.2f} ms  ({:5.1f} fps)".format( averages[ 'frame' ] * 1000, 1 / averages[ 'frame' ] if averages[ 'frame' ] else 0.0 ) ]
+        lines += [ "{:<7}{:7.2f} ms".format( each_section, averages[ each_section ] * 1000 ) for each_section in SECTIONS ]
+        lines += [ "draw calls {:.0f}   group switches {:.0f}   vertices {:.0f}".format( averages[ 'draw_calls' ], averages[ 'group_switches' ], averages[ 'vertices' ] ),
+            "texture binds {:.0f}   gl calls {:.0f}   elided {:.0f}".format( averages[ 'texture_binds' ], averages[ 'gl_calls' ], averages[ 'gl_calls_elided' ] ),
+            "units culled {:.0f}   out of range {:.0f}   other rooms {:.0f}   occluded {:.0f}".format( averages[ 'units_culled' ], averages[ 'units_out_of_range' ], averages[ 'units_in_other_rooms' ], averages[ 'units_occluded' ] ) ]
+        self.overlay_label.text = '\n'.join( lines )
+
+
+    def draw_overlay( self ):
+        if not self.show_overlay:
+            return
+        now = time.perf_counter()
+        if now - self.last_overlay_update >= self.update_period:
+            self.last_overlay_update = now
+            self.update_overlay()
+        self.overlay_label.y = self.window.height - 10
+        self.overlay_label.draw()
+
+
+    def export( self ):
+        """Writes the recorded frames to export_dir as both CSV and JSON.  Returns the path of the CSV file."""
+        os.makedirs( self.export_dir, exist_ok=True )
+        base_name = time.strftime( "%Y_%m_%d_%H%M%S", time.localtime() )
+        columns = [ 'time', 'frame' ] + SECTIONS + COUNTERS
+        frames = list( self.history )
+
+        csv_path = self.export_dir / ( base_name + '.csv' )
+        with open( csv_path, 'w', newline='' ) as f:
+            writer = csv.DictWriter( f, fieldnames=columns )
+            writer.writeheader()
+            writer.writerows( frames )
+
+        with open( self.export_dir / ( base_name + '.json' ), 'w' ) as f:
+            json.dump( { 'columns' : columns, 'frames' : frames }, f, indent=1 )
+
+        return csv_path
@@ -0,0 +1,33 @@
+import numpy as np
+
+
+## As in the game's find_floor, a floor counts as under a point when it's no more than this far above it.
+FLOOR_TOLERANCE = 78
+
+
+def find_floor( floors, point ):
+    """Index of the highest of the ( n, 3, 3 ) floor triangles under point, or -1 if there isn't one.  Floors are tested the way the game tests them: the point has to be inside the triangle seen from above, with the triangle's vertices in the game's winding order."""
+    if not len( floors ):
+        return -1
+    x, y, z = point
+    x1, z1 = floors[ :, 0, 0 ], floors[ :, 0, 2 ]
+    x2, z2 = floors[ :, 1, 0 ], floors[ :, 1, 2 ]
+    x3, z3 = floors[ :, 2, 0 ], floors[ :, 2, 2 ]
+    inside = ( ( z1 - z ) * ( x2 - x1 ) - ( x1 - x ) * ( z2 - z1 ) >= 0 ) & ( ( z2 - z ) * ( x3 - x2 ) - ( x2 - x ) * ( z3 - z2 ) >= 0 ) & ( ( z3 - z ) * ( x1 - x3 ) - ( x3 - x ) * ( z1 - z3 ) >= 0 )
+    candidates = np.flatnonzero( inside )
+    if not len( candidates ):
+        return -1
+
+    triangles = floors[ candidates ].astype( np.float64 )
+    normals = np.cross( triangles[ :, 1 ] - triangles[ :, 0 ], triangles[ :, 2 ] - triangles[ :, 1 ] )
+    heights = triangles[ :, 0, 1 ] - ( normals[ :, 0 ] * ( x - triangles[ :, 0, 0 ] ) + normals[ :, 2 ] * ( z - triangles[ :, 0, 2 ] ) ) / normals[ :, 1 ]
+    below = heights <= y + FLOOR_TOLERANCE
+    if not below.any():
+        return -1
+    return int( candidates[ below ][ np.argmax( heights[ below ] ) ] )
+
+
+def get_adjacent_rooms( room_dl_names ):
+    """For each case of a geo_switch_area ( room number - 1 ), the set of room numbers that can be seen from it: the room itself, and every room whose case draws any of the same display lists.  Each case draws its own room along with the rooms next to it, so a room that's drawn from another always shares display lists with it."""
+    case_names = [ set( each_names ) for each_names in room_dl_names ]
+    return [ { other_ind + 1 for other_ind, other_names in enumerate( case_names ) if other_ind == ind or each_names & other_names } for ind, each_names in enumerate( case_names ) ]
@@ -1,7 +1,9 @@
 from pathlib import Path
+import argparse
 from distutils.version import LooseVersion
 import os
 import sys
+import time
 
 try:
     import pyglet
@@ -23,75 +25,54 @@ except:
     print( "Please install numpy for python.  This project uses numpy as the backend for its 3D matrix math.  You can install it using:\npip install numpy\n" )
     sys.exit()
 
-from parsers import texture_parser
-from parsers import model_id_parser
-from parsers import level_script_parser
-from parsers import gfx_from_geo_parser
-from parsers import paintings_parser
-from parsers import model_parser
-from parsers import skybox_extender
-from parsers import geo_parser
-from parsers import level_fixes
-from parsers import movtex_tri_parser
+from parsers import pipeline
+from parsers.build_manifest import BuildManifest
+from parsers import source_index
+from parsers import stage_metrics
 
 
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument( '-j', '--jobs', type=int, default=None, help="Number of setup stages to run at once.  Defaults to the number of cores.  Use 1 to run every stage one after another in this process." )
+    parser.add_argument( '-f', '--force', action='store_true', help="Re-run every setup stage, even those whose sources haven't changed since the last setup." )
+    parser.add_argument( '-m', '--metrics', action='store_true', help="Record the wall time, CPU time, peak memory, files and bytes read, and output size of each setup stage, and print them in a table at the end." )
+    parser.add_argument( '-p', '--profile', action='store_true', help="Profile each setup stage with cProfile and dump the stats to profiles/<stage>.prof.  Implies --metrics." )
+    args = parser.parse_args()
 
+    mario_source_dir = Path( '' )
+    while not os.path.isfile( mario_source_dir / 'extract_assets.py' ):
+        mario_source_dir = Path( input( 'Please enter the path of the sm64 source code directory.  This is the directory in which extract_assets.py is located.\nFor Windows, the path should be formatted like the following example:\nC:/Users/Me/mario\n(Note the direction of the slashes.)\n\nFor Linux, the path should be formatted like the following example:\n/home/Me/mario\n\n>' ) )
 
-mario_source_dir = Path( '' )
-while not os.path.isfile( mario_source_dir / 'extract_assets.py' ):
-    mario_source_dir = Path( input( 'Please enter the path of the sm64 source code directory.  This is the directory in which extract_assets.py is located.\nFor Windows, the path should be formatted like the following example:\nC:/Users/Me/mario\n(Note the direction of the slashes.)\n\nFor Linux, the path should be formatted like the following example:\n/home/Me/mario\n\n>' ) )
+    if not os.path.isfile( mario_source_dir / 'textures' / 'skyboxes' / 'water.png' ):
+        print( "Located the sm64 source directory, however textures are missing.  Please run the extract_assets.py script in that directory on your US version baserom." )
+        sys.exit()
 
-if not os.path.isfile( mario_source_dir / 'textures' / 'skyboxes' / 'water.png' ):
-    print( "Located the sm64 source directory, however textures are missing.  Please run the extract_assets.py script in that directory on your US version baserom." )
-    sys.exit()
-
-mario_graphics_dir = Path( os.path.realpath( __file__ ) ).parent
-parser_dir = mario_graphics_dir / 'parsers'
-pickle_dir = mario_graphics_dir / 'pickles'
-
-
-print( "Beginning setup.\n" )
-
-os.makedirs( mario_graphics_dir / 'pickles', exist_ok=True )
-
-print( "Parsing textures and building the texture dictionary.  This may take a minute..." )
-texture_parser.main( mario_source_dir, pickle_dir )
-print( "\n", end='' )
-
-print( "Parsing models and creating model dictionaries." )
-model_id_parser.main( mario_source_dir, pickle_dir )
-print( "\n", end='' )
-
-print( "Parsing level scripts." )
-level_script_parser.main( mario_source_dir, pickle_dir )
-print( "\n", end='' )
+    mario_graphics_dir = Path( os.path.realpath( __file__ ) ).parent
 
-print( "Parsing gfx data called from level geo." )
-gfx_from_geo_parser.main( mario_source_dir, pickle_dir )
-print( "\n", end='' )
 
-print( "Parsing gfx data called from paintings." )
-paintings_parser.main( mario_source_dir, pickle_dir )
-print( "\n", end='' )
+    print( "Beginning setup.\n" )
 
-print( "Parsing vertex, triangle, and draw data." )
-model_parser.main( mario_source_dir, pickle_dir )
-print( "\n", end='' )
+    os.makedirs( mario_graphics_dir / 'pickles', exist_ok=True )
 
-print( "Converting skyboxes from 248x248 pixels to 256x256." )
-skybox_extender.main( mario_source_dir, mario_graphics_dir )
-print( "\n", end='' )
+    ## Walk the source tree once up front.  Every stage answers its globs and declaration lookups from this index instead of walking the tree itself.
+    print( "Indexing the sm64 source tree." )
+    start_time = time.perf_counter()
+    index, scanned = source_index.build_index( mario_source_dir, mario_graphics_dir / 'pickles' )
+    print( "Indexed", len( index.files ), "files ({} scanned for declarations) in {:.2f}s.\n".format( scanned, time.perf_counter() - start_time ) )
 
-print( "Parsing moving texture data." )
-movtex_tri_parser.main( mario_source_dir, pickle_dir )
-print( "\n", end='' )
+    ## The manifest records what each stage read and wrote, so that only stages affected by source changes are re-run.
+    manifest = BuildManifest( mario_graphics_dir / 'pickles' / 'build_manifest.json' )
 
-print( "Parsing geo data." )
-geo_parser.main( mario_source_dir, pickle_dir )
-print( "\n", end='' )
+    ## Stages that don't depend on each other's pickles run at the same time, so their output may be interleaved.
+    metrics = {} if args.metrics or args.profile else None
+    profile_dir = mario_graphics_dir / 'profiles' if args.profile else None
+    start_time = time.perf_counter()
+    timings = pipeline.run_pipeline( mario_source_dir, mario_graphics_dir, jobs=args.jobs, manifest=manifest, force=args.force, metrics=metrics, profile_dir=profile_dir )
+    pipeline.print_timings( timings, time.perf_counter() - start_time )
+    print( "\n", end='' )
 
-print( "Performing level fixes." )
-level_fixes.main( mario_source_dir, pickle_dir )
-print( "\n", end='' )
+    if metrics:
+        stage_metrics.print_metrics( metrics )
+        print( "\n", end='' )
 
-print( "Setup complete!  Run main.py and have fun!" )
+    print( "Setup complete!  Run main.py and have fun!" )
@@ -0,0 +1,160 @@
+import ctypes
+
+import pyglet
+from pyglet.gl import *
+
+
+## Generic vertex attribute indices of the atlas shader.  6 and 7 aren't aliased with any of the fixed function attributes on any driver.
+TILE_RECT_INDEX = 6
+TILE_SETTINGS_INDEX = 7
+TILE_RECT_FORMAT = str( TILE_RECT_INDEX ) + 'g4f'
+TILE_SETTINGS_FORMAT = str( TILE_SETTINGS_INDEX ) + 'g4f'
+
+
+## GLSL 1.20, so it runs anywhere the fixed function pipeline does, and reads the same light and material state that RenderSettingsGroup sets.
+ATLAS_VERTEX_SOURCE = '''#version 120
+
+attribute vec4 tile_rect;
+attribute vec4 tile_settings;
+
+uniform bool lighting;
+
+varying vec4 v_tile_rect;
+varying vec4 v_tile_settings;
+
+void main()
+{
+    gl_Position = ftransform();
+    gl_TexCoord[ 0 ] = gl_MultiTexCoord0;
+    v_tile_rect = tile_rect;
+    v_tile_settings = tile_settings;
+
+    if ( lighting )
+    {
+        // Same as fixed function GL_LIGHT0 with a directional light and no specular.
+        vec3 normal = normalize( gl_NormalMatrix * gl_Normal );
+        vec3 light_direction = normalize( gl_LightSource[ 0 ].position.xyz );
+        float diffuse = max( dot( normal, light_direction ), 0.0 );
+        vec4 colour = gl_FrontLightModelProduct.sceneColor + gl_FrontLightProduct[ 0 ].ambient + diffuse * gl_FrontLightProduct[ 0 ].diffuse;
+        gl_FrontColor = clamp( vec4( colour.rgb, gl_FrontMaterial.diffuse.a ), 0.0, 1.0 );
+    }
+    else
+    {
+        gl_FrontColor = gl_Color;
+    }
+}
+'''
+
+ATLAS_FRAGMENT_SOURCE = '''#version 120
+
+uniform sampler2D atlas;
+uniform bool texture_enable;
+uniform vec2 half_texel;
+
+varying vec4 v_tile_rect;
+varying vec4 v_tile_settings;
+
+// N64 overflow behaviour of one coordinate.  coordinate is in N64 orientation ( 0 is the top of the texture ) and in units of the texture's size.  mode is 2 for clamp plus 1 for mirror, and period is the length of the tile mask.
+float overflow( float coordinate, float mode, float period )
+{
+    bool clamped = mode > 1.5;
+    bool mirrored = mod( mode, 2.0 ) > 0.5;
+    if ( clamped )
+    {
+        coordinate = clamp( coordinate, 0.0, 1.0 );
+        if ( period >= 1.0 )
+        {
+            return coordinate;
+        }
+    }
+    if ( mirrored )
+    {
+        float position = mod( coordinate, 2.0 * period );
+        return position > period ? 2.0 * period - position : position;
+    }
+    return mod( coordinate, period );
+}
+
+void main()
+{
+    if ( !texture_enable )
+    {
+        gl_FragColor = gl_Color;
+        return;
+    }
+
+    vec2 uv = gl_TexCoord[ 0 ].st;
+    float s = overflow( uv.x, v_tile_settings.x, v_tile_settings.z );
+    float t = overflow( 1.0 - uv.y, v_tile_settings.y, v_tile_settings.w );
+    uv = v_tile_rect.xy + vec2( s, 1.0 - t ) * v_tile_rect.zw;
+
+    // Keep filtering from reading the neighbouring textures in the atlas.
+    uv = clamp( uv, v_tile_rect.xy + half_texel, v_tile_rect.xy + v_tile_rect.zw - half_texel );
+    gl_FragColor = texture2D( atlas, uv ) * gl_Color;
+}
+'''
+
+
+
+class ShaderProgram():
+    """A linked GLSL program.  attribute_locations maps attribute name -> generic attribute index, and is bound before linking so pyglet's generic vertex formats line up with the shader.  Raises RuntimeError with the driver's log if the program doesn't compile or link."""
+    def __init__( self, vertex_source, fragment_source, attribute_locations ):
+        self.id = glCreateProgram()
+        shaders = [ self.compile( GL_VERTEX_SHADER, vertex_source ), self.compile( GL_FRAGMENT_SHADER, fragment_source ) ]
+        for each_shader in shaders:
+            glAttachShader( self.id, each_shader )
+        for each_name, each_index in attribute_locations.items():
+            glBindAttribLocation( self.id, each_index, each_name.encode() )
+        glLinkProgram( self.id )
+        for each_shader in shaders:
+            glDetachShader( self.id, each_shader )
+            glDeleteShader( each_shader )
+
+        status = GLint( 0 )
+        glGetProgramiv( self.id, GL_LINK_STATUS, ctypes.byref( status ) )
+        if not status.value:
+            raise RuntimeError( "Couldn't link shader program:\n" + self.get_log( self.id, glGetProgramiv, glGetProgramInfoLog ) )
+
+        self.uniform_locations = {}
+
+
+    def get_log( self, object_id, get_iv, get_info_log ):
+        length = GLint( 0 )
+        get_iv( object_id, GL_INFO_LOG_LENGTH, ctypes.byref( length ) )
+        log = ctypes.create_string_buffer( max( length.value, 1 ) )
+        get_info_log( object_id, length.value, None, log )
+        return log.value.decode( errors='replace' )
+
+
+    def compile( self, shader_type, source ):
+        shader = glCreateShader( shader_type )
+        source_buffer = ctypes.create_string_buffer( source.encode() )
+        source_pointer = ctypes.cast( ctypes.pointer( ctypes.pointer( source_buffer ) ), ctypes.POINTER( ctypes.POINTER( GLchar ) ) )
+        glShaderSource( shader, 1, source_pointer, None )
+        glCompileShader( shader )
+
+        status = GLint( 0 )
+        glGetShaderiv( shader, GL_COMPILE_STATUS, ctypes.byref( status ) )
+        if not status.value:
+            log = self.get_log( shader, glGetShaderiv, glGetShaderInfoLog )
+            glDeleteShader( shader )
+            raise RuntimeError( "Couldn't compile shader:\n" + log )
+        return shader
+
+
+    def get_uniform_location( self, name ):
+        location = self.uniform_locations.get( name )
+        if location is None:
+            location = glGetUniformLocation( self.id, name.encode() )
+            self.uniform_locations[ name ] = location
+        return location
+
+
+
+def make_atlas_program():
+    """Compiles the atlas shader.  Returns None if the driver can't, in which case everything is drawn with the fixed function pipeline."""
+    try:
+        return ShaderProgram( ATLAS_VERTEX_SOURCE, ATLAS_FRAGMENT_SOURCE, { 'tile_rect' : TILE_RECT_INDEX, 'tile_settings' : TILE_SETTINGS_INDEX } )
+    except Exception as e:
+        print( "Atlas shader unavailable, drawing without shaders.", e )
+        return None
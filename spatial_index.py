@@ -0,0 +1,151 @@
+import numpy as np
+
+
+## Nodes with this many items or fewer aren't split.
+LEAF_SIZE = 4
+## Names of the arrays of a SpatialIndex other than the item boxes, in the order they're stored.
+SPATIAL_INDEX_ARRAYS = [ 'node_boxes', 'node_children', 'node_starts', 'node_counts', 'items' ]
+
+
+def get_box_distances( boxes, planes, nearest=False ):
+    """Signed distances of ( n, 2, 3 ) boxes of ( min, max ) corners from ( p, 4 ) planes of ( a, b, c, d ), as a ( p, n ) array.  Each plane is measured to the corner of each box furthest along its normal, or with nearest=True to the corner furthest against it."""
+    normals = planes[ :, None, : 3 ]
+    corners = np.where( ( normals > 0 ) != nearest, boxes[ None, :, 1 ], boxes[ None, :, 0 ] )
+    return ( corners * normals ).sum( axis=2 ) + planes[ :, None, 3 ]
+
+
+def boxes_in_frustum( boxes, planes ):
+    """Tests ( n, 2, 3 ) boxes of ( min, max ) corners against frustum planes with their normals pointing inwards.  Returns a bool array, True for boxes at least partly inside.  A box is only rejected when it's entirely outside one plane, so a few boxes near the corners of the frustum are kept when they're actually out of view."""
+    return ( get_box_distances( boxes, planes ) >= 0 ).all( axis=0 )
+
+
+def get_ranges( starts, counts ):
+    """Concatenation of np.arange( start, start + count ) for each start and count."""
+    ends = np.cumsum( counts )
+    if not len( ends ):
+        return np.zeros( 0, dtype=np.intp )
+    return np.arange( ends[ -1 ], dtype=np.intp ) + np.repeat( starts - ( ends - counts ), counts )
+
+
+def build_spatial_index( boxes, leaf_size=LEAF_SIZE ):
+    """Builds a bounding volume hierarchy over ( n, 2, 3 ) boxes of ( min, max ) corners, such as the cull units of a baked level.  Nodes are split top down at the median of their items' centres along the longest axis of those centres, which keeps the tree balanced no matter how the boxes are spread out.  Empty boxes ( min > max ) are left out, since nothing can find them."""
+    boxes = np.asarray( boxes, dtype=np.float32 ).reshape( -1, 2, 3 )
+    items = np.flatnonzero( ( boxes[ :, 0 ] <= boxes[ :, 1 ] ).all( axis=1 ) )
+    if not len( items ):
+        return SpatialIndex( boxes, np.zeros( ( 0, 2, 3 ), dtype=np.float32 ), np.zeros( 0, dtype=np.int32 ), np.zeros( 0, dtype=np.int32 ), np.zeros( 0, dtype=np.int32 ), items.astype( np.int32 ) )
+    centres = boxes[ items ].mean( axis=1 )
+
+    ## Nodes are added breadth first, so both children of a node are next to each other and come after it.  Each node covers a contiguous range of items, which are reordered in place as nodes are split.
+    node_starts = [ 0 ]
+    node_counts = [ len( items ) ]
+    node_children = [ -1 ]
+    ind = 0
+    while ind < len( node_starts ):
+        start, count = node_starts[ ind ], node_counts[ ind ]
+        if count > leaf_size:
+            node_centres = centres[ start : start + count ]
+            axis = np.argmax( node_centres.max( axis=0 ) - node_centres.min( axis=0 ) )
+            half = count // 2
+            order = np.argpartition( node_centres[ :, axis ], half )
+            items[ start : start + count ] = items[ start : start + count ][ order ]
+            centres[ start : start + count ] = node_centres[ order ]
+            node_children[ ind ] = len( node_starts )
+            node_starts += [ start, start + half ]
+            node_counts += [ half, count - half ]
+            node_children += [ -1, -1 ]
+        ind += 1
+
+    ## The box of every node at once, reducing over each node's range of items.  reduceat reduces between consecutive indices, so every other result is a node and the ones between are thrown away.  The extra row lets a range end at the last item.
+    node_starts = np.array( node_starts, dtype=np.int32 )
+    node_counts = np.array( node_counts, dtype=np.int32 )
+    item_boxes = boxes[ items ]
+    item_boxes = np.concatenate( [ item_boxes, item_boxes[ : 1 ] ] )
+    bounds = np.stack( [ node_starts, node_starts + node_counts ], axis=1 ).ravel()
+    node_boxes = np.empty( ( len( node_starts ), 2, 3 ), dtype=np.float32 )
+    node_boxes[ :, 0 ] = np.minimum.reduceat( item_boxes[ :, 0 ], bounds )[ : : 2 ]
+    node_boxes[ :, 1 ] = np.maximum.reduceat( item_boxes[ :, 1 ], bounds )[ : : 2 ]
+
+    return SpatialIndex( boxes, node_boxes, np.array( node_children, dtype=np.int32 ), node_starts, node_counts, items.astype( np.int32 ) )
+
+
+
+class SpatialIndex():
+    """A bounding volume hierarchy over a set of item boxes, built by build_spatial_index.  Queries return the indices of the items whose boxes are hit, in ascending order.
+
+    The tree is stored flat: node_boxes is the ( min, max ) box of each node, node 0 is the root, and node_children is the index of a node's first child, with the second right after it, or -1 for a leaf.  Each node covers items[ node_starts : node_starts + node_counts ].  Queries walk the tree a level at a time, testing every node of a level at once, so a query costs a few numpy calls per level rather than a python call per node."""
+    def __init__( self, boxes, node_boxes, node_children, node_starts, node_counts, items ):
+        self.boxes = boxes
+        self.node_boxes = node_boxes
+        self.node_children = node_children
+        self.node_starts = node_starts
+        self.node_counts = node_counts
+        self.items = items
+
+
+    def find( self, box_test, contained_test=None ):
+        """Indices of the items whose boxes pass box_test, which takes ( n, 2, 3 ) boxes and returns a bool array.  If contained_test is given, it's True for boxes whose items all pass box_test, and every item under a node that passes it is found without testing further."""
+        found = []
+        nodes = np.zeros( 1 if len( self.node_boxes ) else 0, dtype=np.intp )
+        while len( nodes ):
+            node_boxes = self.node_boxes[ nodes ]
+            hit = box_test( node_boxes )
+            nodes = nodes[ hit ]
+            if contained_test is not None and len( nodes ):
+                contained = contained_test( node_boxes[ hit ] )
+                found.append( self.items[ get_ranges( self.node_starts[ nodes[ contained ] ], self.node_counts[ nodes[ contained ] ] ) ] )
+                nodes = nodes[ ~contained ]
+
+            children = self.node_children[ nodes ]
+            leaves = nodes[ children < 0 ]
+            if len( leaves ):
+                leaf_items = self.items[ get_ranges( self.node_starts[ leaves ], self.node_counts[ leaves ] ) ]
+                found.append( leaf_items[ box_test( self.boxes[ leaf_items ] ) ] )
+            children = children[ children >= 0 ]
+            nodes = np.concatenate( [ children, children + 1 ] )
+
+        if not found:
+            return np.zeros( 0, dtype=np.intp )
+        return np.sort( np.concatenate( found ) ).astype( np.intp )
+
+
+    def query_frustum( self, planes ):
+        """Items whose boxes are at least partly inside frustum planes, as made by culling.get_frustum_planes."""
+        planes = np.asarray( planes, dtype=np.float64 )
+        return self.find( lambda boxes: boxes_in_frustum( boxes, planes ), lambda boxes: ( get_box_distances( boxes, planes, nearest=True ) >= 0 ).all( axis=0 ) )
+
+
+    def query_box( self, box_min, box_max ):
+        """Items whose boxes overlap the box from box_min to box_max."""
+        box_min = np.asarray( box_min, dtype=np.float32 )
+        box_max = np.asarray( box_max, dtype=np.float32 )
+        return self.find( lambda boxes: ( ( boxes[ :, 0 ] <= box_max ) & ( boxes[ :, 1 ] >= box_min ) ).all( axis=1 ), lambda boxes: ( ( boxes[ :, 0 ] >= box_min ) & ( boxes[ :, 1 ] <= box_max ) ).all( axis=1 ) )
+
+
+    def query_radius( self, centre, radius ):
+        """Items whose boxes are within radius of centre."""
+        centre = np.asarray( centre, dtype=np.float64 )
+        def box_test( boxes ):
+            nearest_points = np.clip( centre, boxes[ :, 0 ], boxes[ :, 1 ] )
+            return ( ( nearest_points - centre ) ** 2 ).sum( axis=1 ) <= radius * radius
+        return self.find( box_test )
+
+
+    def get_ray_distances( self, boxes, origin, inverse_direction, max_distance ):
+        """Distance along the ray to where it enters each box, or inf where it misses the box or only reaches it past max_distance.  A ray starting inside a box enters it at 0."""
+        with np.errstate( invalid='ignore' ):
+            slab_distances = ( boxes - origin ) * inverse_direction
+        ## A ray parallel to an axis and inside that axis' slab gives nan for one side, which mustn't decide anything.
+        near = np.nanmax( np.fmax( np.minimum( slab_distances[ :, 0 ], slab_distances[ :, 1 ] ), 0.0 ), axis=1 )
+        far = np.nanmin( np.fmin( np.maximum( slab_distances[ :, 0 ], slab_distances[ :, 1 ] ), max_distance ), axis=1 )
+        return np.where( near <= far, near, np.inf )
+
+
+    def query_ray( self, origin, direction, max_distance=np.inf ):
+        """Items whose boxes a ray from origin along direction hits within max_distance ( in multiples of direction's length ).  Returns ( items, distances ) ordered from the nearest hit to the furthest, with the distance to where the ray enters each box."""
+        origin = np.asarray( origin, dtype=np.float64 )
+        with np.errstate( divide='ignore' ):
+            inverse_direction = 1 / np.asarray( direction, dtype=np.float64 )
+        items = self.find( lambda boxes: np.isfinite( self.get_ray_distances( boxes, origin, inverse_direction, max_distance ) ) )
+        distances = self.get_ray_distances( self.boxes[ items ], origin, inverse_direction, max_distance )
+        order = np.argsort( distances, kind='stable' )
+        return items[ order ], distances[ order ]
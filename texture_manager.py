@@ -0,0 +1,161 @@
+from collections import OrderedDict
+from pathlib import Path
+import hashlib
+import os
+import struct
+
+import pyglet
+from pyglet.gl import *
+
+
+## Decoded textures are stored as this header ( magic, width, height ) followed by width * height * 4 bytes of RGBA, bottom row first.
+RGBA_HEADER = struct.Struct( '<4sII' )
+RGBA_MAGIC = b'RGBA'
+
+
+
+class ResidentTexture():
+    """A texture's decoded image, along with wherever it's been uploaded to.  texture is its own texture, with its wrap settings applied, and atlas_region is its region of the shared atlas.  Either is None until the texture is first placed there."""
+    def __init__( self, image ):
+        self.image = image
+        self.texture = None
+        self.atlas_region = None
+        self.width = image.width
+        self.height = image.height
+        self.s_setting = None
+        self.t_setting = None
+
+
+
+class TextureManager():
+    """Keeps textures on the GPU across level loads, so that switching levels only uploads the textures the new level adds.
+
+    Each level decides per texture whether it lives in the atlas or in a texture of its own ( see LevelBaker.place_textures ), and a texture is only uploaded to the places some level has needed it.  PNGs are decoded once and the RGBA data is saved in cache_dir, so later sessions don't decode them again.  Resident textures are kept in least recently used order.  Once there are more than max_resident, the textures that went unused the longest are released, never including textures the current level uses.  The atlas is shared by every level.  Regions of an atlas can't be freed, so when it fills up it's rebuilt with only the current level's textures."""
+    def __init__( self, cache_dir, max_resident=1024 ):
+        self.cache_dir = Path( cache_dir )
+        self.max_resident = max_resident
+        self.resident = OrderedDict()
+        self.texture_atlas = None
+        self.uploaded = 0
+        self.decoded = 0
+
+
+    def get_cache_path( self, texture_filename ):
+        stat = os.stat( texture_filename )
+        key = hashlib.sha1( '{}\0{}\0{}'.format( os.path.abspath( texture_filename ), stat.st_size, stat.st_mtime_ns ).encode() ).hexdigest()
+        return self.cache_dir / ( key + '.rgba' )
+
+
+    def load_image( self, texture_filename ):
+        """Returns the RGBA ImageData of a texture, from the decoded cache if it's there and by decoding the png ( and saving the result to the cache ) otherwise."""
+        cache_path = self.get_cache_path( texture_filename )
+        try:
+            with open( cache_path, 'rb' ) as f:
+                data = f.read()
+            magic, width, height = RGBA_HEADER.unpack_from( data )
+            if magic == RGBA_MAGIC and len( data ) == RGBA_HEADER.size + width * height * 4:
+                return pyglet.image.ImageData( width, height, 'RGBA', data[ RGBA_HEADER.size : ], pitch=width * 4 )
+        except:
+            pass
+
+        image = pyglet.image.load( texture_filename ).get_image_data()
+        data = image.get_data( 'RGBA', image.width * 4 )
+        self.decoded += 1
+        try:
+            os.makedirs( self.cache_dir, exist_ok=True )
+            temp_path = cache_path.with_suffix( '.tmp' )
+            with open( temp_path, 'wb' ) as f:
+                f.write( RGBA_HEADER.pack( RGBA_MAGIC, image.width, image.height ) + data )
+            os.replace( temp_path, cache_path )
+        except OSError:
+            pass
+
+        return pyglet.image.ImageData( image.width, image.height, 'RGBA', data, pitch=image.width * 4 )
+
+
+    def set_wrap( self, resident_texture, s_setting, t_setting ):
+        ## Bind the texture and change texture coordinate overflow settings
+        resident_texture.s_setting = s_setting
+        resident_texture.t_setting = t_setting
+        glEnable( GL_TEXTURE_2D )
+        glBindTexture( GL_TEXTURE_2D, resident_texture.texture.id )
+
+        if 'G_TX_CLAMP' in s_setting:
+            glTexParameteri( GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE )
+        elif 'G_TX_MIRROR' in s_setting:
+            glTexParameteri( GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_MIRRORED_REPEAT )
+        else:
+            glTexParameteri( GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_REPEAT )
+        if 'G_TX_CLAMP' in t_setting:
+            glTexParameteri( GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE )
+        elif 'G_TX_MIRROR' in t_setting:
+            glTexParameteri( GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_MIRRORED_REPEAT )
+        else:
+            glTexParameteri( GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_REPEAT )
+
+
+    def rebuild_atlas( self, texture_filenames ):
+        self.texture_atlas = pyglet.image.atlas.TextureAtlas()
+        for each_resident_texture in self.resident.values():
+            each_resident_texture.atlas_region = None
+        for each_filename in texture_filenames:
+            each_resident_texture = self.resident[ each_filename ]
+            each_resident_texture.atlas_region = self.texture_atlas.add( each_resident_texture.image )
+
+
+    def begin_level( self, textures ):
+        """Makes every texture a level uses resident.  textures maps png filename -> ( width, height, s_setting, t_setting, atlas, standalone ), as in BakedLevel.  Each texture is uploaded only to where the level placed it, the atlas and/or a texture of its own, and only if it isn't there already.  Returns the number of uploads."""
+        uploaded = 0
+        if self.texture_atlas is None:
+            self.texture_atlas = pyglet.image.atlas.TextureAtlas()
+
+        for texture_filename, ( _, _, s_setting, t_setting, _, standalone ) in textures.items():
+            resident_texture = self.resident.get( texture_filename )
+            if resident_texture is None:
+                resident_texture = ResidentTexture( self.load_image( texture_filename ) )
+                self.resident[ texture_filename ] = resident_texture
+            else:
+                self.resident.move_to_end( texture_filename )
+
+            if standalone:
+                if resident_texture.texture is None:
+                    resident_texture.texture = resident_texture.image.get_texture()
+                    uploaded += 1
+                if resident_texture.s_setting != s_setting or resident_texture.t_setting != t_setting:
+                    self.set_wrap( resident_texture, s_setting, t_setting )
+
+        atlas_filenames = [ texture_filename for texture_filename, each_texture in textures.items() if each_texture[ 4 ] ]
+        for texture_filename in atlas_filenames:
+            resident_texture = self.resident[ texture_filename ]
+            if resident_texture.atlas_region is None:
+                try:
+                    resident_texture.atlas_region = self.texture_atlas.add( resident_texture.image )
+                    uploaded += 1
+                except pyglet.image.atlas.AllocatorException:
+                    ## The atlas is full of textures from earlier levels.  Start over with just this level's.
+                    self.rebuild_atlas( atlas_filenames )
+                    uploaded += len( atlas_filenames )
+                    break
+
+        ## Release the least recently used textures that this level doesn't use.
+        while len( self.resident ) > self.max_resident:
+            oldest_filename = next( iter( self.resident ) )
+            if oldest_filename in textures:
+                break
+            del self.resident[ oldest_filename ]
+
+        self.uploaded += uploaded
+        return uploaded
+
+
+    def get_texture( self, texture_filename ):
+        return self.resident[ texture_filename ].texture
+
+
+    def get_atlas_region( self, texture_filename ):
+        return self.resident[ texture_filename ].atlas_region
+
+
+    def get_size( self, texture_filename ):
+        resident_texture = self.resident[ texture_filename ]
+        return resident_texture.width, resident_texture.height
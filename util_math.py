@@ -72,13 +72,16 @@ def rotate_around_vec( angle, x, y, z ):
                       [        0,                 0,              0,        1 ] )
 
 def positions_to_mat( positions ):
-    ret_mat = np.ones( ( len( positions ) // 3, 4 ) )
-    ret_mat[ :, : -1 ] = np.array( positions ).reshape( ( -1, 3 ) )
+    """Takes either a flat list x1, y1, z1, x2, ... or an array of shape ( -1, 3 ) and returns homogeneous coordinates of shape ( -1, 4 )."""
+    positions = np.asarray( positions ).reshape( ( -1, 3 ) )
+    ret_mat = np.ones( ( len( positions ), 4 ) )
+    ret_mat[ :, : -1 ] = positions
     return ret_mat
 
 def normals_to_mat( normals ):
-    ret_mat = np.zeros( ( len( normals ) // 3, 4 ) )
-    ret_mat[ :, : -1 ] = np.array( normals ).reshape( ( -1, 3 ) )
+    normals = np.asarray( normals ).reshape( ( -1, 3 ) )
+    ret_mat = np.zeros( ( len( normals ), 4 ) )
+    ret_mat[ :, : -1 ] = normals
     return ret_mat
 
 
@@ -122,6 +125,12 @@ def convert_twos_comp_list( arr ):
     return ret_list
 
 
+def convert_twos_comp_array( arr ):
+    """Same as convert_twos_comp_list, but for a numpy array of uint8 values of any shape.  Returns an array of floats of the same shape."""
+    signed_arr = np.asarray( arr, dtype=np.uint8 ).view( np.int8 ).astype( np.float64 )
+    return np.where( signed_arr < 0, signed_arr / 128.0, signed_arr / 127.0 )
+
+
 ##########################
 ### PNG WRITE FUNCTION ###
 ##########################